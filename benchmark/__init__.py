@@ -0,0 +1,3 @@
+"""
+This package provides offline benchmarks of the DST-GPT pipeline.
+"""
@@ -0,0 +1,161 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,R0914
+"""
+This module benchmarks chunking strategies on the sample corpus.
+
+For every strategy, the corpus is chunked and embedded with local hash
+embeddings, and each labelled question retrieves its top-k chunks. The
+benchmark reports the number of chunks, the hit rate (a retrieved chunk
+contains the expected answer), the mean reciprocal rank of the first hit,
+and the prompt tokens per answer.
+
+    python -m benchmark.chunking --k 4 --json chunking.json
+"""
+import os
+import re
+import json
+import argparse
+import numpy as np
+from src.config import config_store
+from src.chunkers import get_chunker
+from src.ingest import iter_source_files, load_documents
+from src.tokens import count_tokens, count_message_tokens
+from benchmark.local_models import HashEmbeddings
+
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(__file__), "questions.jsonl")
+DEFAULT_TEMPLATE = "Answer the question based on the context.\n{context}\n\nQuestion: {input}"
+
+
+def load_questions(questions_filepath=DEFAULT_QUESTIONS):
+    """
+    Loads the labelled questions.
+
+    Args:
+        questions_filepath (str): The path of the JSONL file of questions.
+
+    Returns:
+        list: The questions as dictionaries with 'id', 'question', 'source'
+        and 'answer', the text a relevant chunk must contain.
+    """
+    with open(questions_filepath, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def normalize(text):
+    """Lower-cases a text and collapses its whitespace for answer matching."""
+    return re.sub(r"\s+", " ", text.lower())
+
+
+def chunk_corpus(file_paths, strategy, **kwargs):
+    """
+    Chunks source files with a strategy.
+
+    Args:
+        file_paths (list): The paths of the source files.
+        strategy (str): The chunking strategy, 'fixed' or 'structure'.
+        **kwargs: The settings passed to get_chunker.
+
+    Returns:
+        list: The (source, chunk) pairs.
+    """
+    chunks = []
+    for file_path in file_paths:
+        chunker = get_chunker(os.path.splitext(file_path)[1], strategy, **kwargs)
+        for text, metadata in load_documents(file_path, keep_markup=chunker.markup):
+            chunks.extend((file_path, chunk) for chunk in chunker.split(text, metadata))
+    return chunks
+
+
+def evaluate(chunks, questions, embeddings, k=4, prompt_template=DEFAULT_TEMPLATE):
+    """
+    Retrieves the top-k chunks for every question and scores them.
+
+    Args:
+        chunks (list): The (source, chunk) pairs.
+        questions (list): The labelled questions.
+        embeddings (Embeddings): The embedding function.
+        k (int): The number of retrieved chunks.
+        prompt_template (str): The prompt with {context} and {input} placeholders.
+
+    Returns:
+        dict: The scores of the chunking.
+    """
+    texts = [chunk for _, chunk in chunks]
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+    chunk_tokens = [count_tokens(text) for text in texts]
+
+    hits = 0
+    reciprocal_ranks = 0.0
+    prompt_tokens = []
+    answer_tokens = []
+    for question in questions:
+        query = np.asarray(embeddings.embed_query(question["question"]), dtype=np.float32)
+        top = np.argsort(-(matrix @ query))[:k]
+        context = "\n\n".join(texts[i] for i in top)
+        prompt = prompt_template.replace("{context}", context).replace(
+            "{input}", question["question"]
+        )
+        prompt_tokens.append(count_message_tokens(prompt))
+
+        answer = normalize(question["answer"])
+        for rank, index in enumerate(top, start=1):
+            if answer in normalize(texts[index]):
+                hits += 1
+                reciprocal_ranks += 1 / rank
+                # The context tokens needed to reach the chunk holding the answer
+                answer_tokens.append(sum(chunk_tokens[i] for i in top[:rank]))
+                break
+
+    num_questions = len(questions) or 1
+    return {
+        "chunks": len(chunks),
+        "mean_chunk_tokens": round(float(np.mean(chunk_tokens)), 1) if chunks else 0.0,
+        "max_chunk_tokens": max(chunk_tokens, default=0),
+        f"hit_rate@{k}": round(hits / num_questions, 4),
+        "mrr": round(reciprocal_ranks / num_questions, 4),
+        "prompt_tokens_per_answer": round(float(np.mean(prompt_tokens)), 1),
+        "context_tokens_to_hit": (
+            round(float(np.mean(answer_tokens)), 1) if answer_tokens else None
+        ),
+    }
+
+
+def main(argv=None):
+    """Runs the chunking benchmark and prints one line per strategy."""
+    config = config_store
+    parser = argparse.ArgumentParser(description="Compare chunking strategies.")
+    parser.add_argument("--data", default="data", help="The corpus file or folder.")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS)
+    parser.add_argument("--k", type=int, default=4, help="The number of retrieved chunks.")
+    parser.add_argument(
+        "--chunk-tokens", type=int, default=config.get_int("CHUNK_TOKENS", 350)
+    )
+    parser.add_argument(
+        "--overlap-tokens", type=int, default=config.get_int("CHUNK_OVERLAP_TOKENS", 35)
+    )
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    file_paths = list(iter_source_files(args.data))
+    questions = load_questions(args.questions)
+    prompt_template = config.get_str("PROMPT_TEMPLATE") or DEFAULT_TEMPLATE
+    results = {}
+    for strategy in ["fixed", "structure"]:
+        chunks = chunk_corpus(
+            file_paths,
+            strategy,
+            chunk_tokens=args.chunk_tokens,
+            overlap_tokens=args.overlap_tokens,
+        )
+        results[strategy] = evaluate(
+            chunks, questions, HashEmbeddings(), args.k, prompt_template
+        )
+        print(f"{strategy:>10}: {results[strategy]}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
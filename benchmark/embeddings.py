@@ -0,0 +1,194 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,R0914
+"""
+This module benchmarks the throughput of the embedding models.
+
+The corpus is chunked as it would be ingested, and every model embeds all
+chunks and then the labelled questions one by one, as the retriever does.
+The local hash embeddings are included as an offline baseline:
+
+    python -m benchmark.embeddings --models all-MiniLM-L6-v2 text-embedding-3-small
+
+The benchmark reports the chunks and tokens embedded per second, the query
+latency, the estimated cost of the corpus, and the hit rate@k and MRR of
+the questions against the chunks, so a faster model is not picked at the
+expense of retrieval. The OpenAI models need OPENAI_API_KEY; a model that
+fails, e.g. offline, is reported with its error.
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from dotenv import load_dotenv
+from src.config import config_store
+from src.ingest import iter_source_files
+from src.tokens import count_tokens
+from src.embeddings import EMBEDDING_MODELS, get_embeddings
+from benchmark.chunking import DEFAULT_QUESTIONS, load_questions, normalize, chunk_corpus
+from benchmark.local_models import HashEmbeddings
+from benchmark.retrieval import latency_summary
+
+BASELINE_MODEL = "hash"
+
+
+def measure_model(embeddings, texts, questions, k=5):
+    """
+    Embeds the chunks and the questions with a model.
+
+    Args:
+        embeddings (Embeddings): The embedding function.
+        texts (list): The chunk texts.
+        questions (list): The labelled questions.
+        k (int): The number of retrieved chunks scored per question.
+
+    Returns:
+        dict: The throughput, latency and retrieval scores.
+    """
+    start = time.perf_counter()
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+
+    latencies = []
+    hits = 0
+    reciprocal_ranks = 0.0
+    for question in questions:
+        start = time.perf_counter()
+        query = np.asarray(embeddings.embed_query(question["question"]), dtype=np.float32)
+        latencies.append(time.perf_counter() - start)
+        answer = normalize(question["answer"])
+        top = np.argsort(-(matrix @ query))[:k]
+        for rank, i in enumerate(top, 1):
+            if answer in normalize(texts[i]):
+                hits += 1
+                reciprocal_ranks += 1 / rank
+                break
+
+    tokens = sum(count_tokens(text) for text in texts)
+    return {
+        "dimension": int(matrix.shape[1]),
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(len(texts) / elapsed, 1),
+        "tokens_per_second": round(tokens / elapsed, 1),
+        "query": latency_summary(latencies),
+        f"hit_rate@{k}": round(hits / max(1, len(questions)), 4),
+        f"mrr@{k}": round(reciprocal_ranks / max(1, len(questions)), 4),
+    }
+
+
+def run(data_path, questions, models, dimensions=0, batch_size=0, threads=0, k=5, **chunking):
+    """
+    Runs the benchmark on every model.
+
+    Args:
+        data_path (str): The corpus file or folder.
+        questions (list): The labelled questions.
+        models (list): The embedding models, and 'hash' for the baseline.
+        dimensions (int): The shortened dimension of the models that support it.
+        batch_size (int): The texts per request or batch; 0 is the provider's default.
+        threads (int): The inference threads of local models; 0 uses every core.
+        k (int): The number of retrieved chunks scored per question.
+        **chunking: The settings passed to get_chunker.
+
+    Returns:
+        dict: The results.
+    """
+    load_dotenv()
+    file_paths = list(iter_source_files(data_path))
+    sources = {os.path.normpath(file_path) for file_path in file_paths}
+    questions = [
+        question
+        for question in questions
+        if os.path.normpath(question.get("source", "")) in sources
+    ]
+    texts = [chunk for _, chunk in chunk_corpus(file_paths, "structure", **chunking)]
+    tokens = sum(count_tokens(text) for text in texts)
+
+    results = {}
+    for model in models:
+        try:
+            if model == BASELINE_MODEL:
+                embeddings = HashEmbeddings()
+            else:
+                info = EMBEDDING_MODELS[model]
+                embeddings = get_embeddings(
+                    model,
+                    dimensions if info.get("shortenable") else 0,
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    base_url=os.getenv("OPENAI_BASE_URL") or None,
+                    batch_size=batch_size,
+                    threads=threads,
+                )
+            result = measure_model(embeddings, texts, questions, k)
+        except Exception as e:  # pylint: disable=W0703
+            result = {"error": f"{type(e).__name__}: {e}"}
+        if model in EMBEDDING_MODELS:
+            result["corpus_cost"] = round(
+                tokens / 1000 * EMBEDDING_MODELS[model]["cost_per_1k_tokens"], 6
+            )
+        results[model] = result
+        print(f"{model:>24}: {result}")
+    return {
+        "settings": {
+            "data": data_path,
+            "chunks": len(texts),
+            "tokens": tokens,
+            "questions": len(questions),
+            "dimensions": dimensions,
+            "batch_size": batch_size,
+            "threads": threads,
+        },
+        "models": results,
+    }
+
+
+def main(argv=None):
+    """Runs the benchmark and prints or writes its results."""
+    config = config_store
+    parser = argparse.ArgumentParser(description="Benchmark the embedding models.")
+    parser.add_argument(
+        "--data", default="data/sample_data.json", help="The corpus file or folder."
+    )
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=[BASELINE_MODEL] + list(EMBEDDING_MODELS),
+        choices=[BASELINE_MODEL] + list(EMBEDDING_MODELS),
+    )
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        default=config.get_int("EMBEDDING_DIMENSIONS", 0),
+        help="The shortened dimension of the models that support it; 0 keeps the full one.",
+    )
+    parser.add_argument("--batch-size", type=int, default=config.get_int("EMBEDDING_BATCH_SIZE", 0))
+    parser.add_argument("--threads", type=int, default=config.get_int("EMBEDDING_THREADS", 0))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument(
+        "--chunk-tokens", type=int, default=config.get_int("CHUNK_TOKENS", 350)
+    )
+    parser.add_argument(
+        "--overlap-tokens", type=int, default=config.get_int("CHUNK_OVERLAP_TOKENS", 35)
+    )
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.data,
+        load_questions(args.questions),
+        args.models,
+        args.dimensions,
+        args.batch_size,
+        args.threads,
+        args.k,
+        chunk_tokens=args.chunk_tokens,
+        overlap_tokens=args.overlap_tokens,
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
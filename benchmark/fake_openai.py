@@ -0,0 +1,257 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides a local fake of the OpenAI API, so that the server and
+the benchmarks run against the real HTTP clients offline and for free.
+
+Chat completions echo the last user message, streamed or not, after an
+optional delay; embeddings are the local hash embeddings, shortened to
+the requested `dimensions`.
+
+Like the real API, it can answer with 429 errors: when more than
+`--rate-limit` requests to an endpoint arrive within `--window` seconds
+(the limits of chat and embedding models are separate), with a
+Retry-After-Ms header of the time until the next one is allowed, and at
+random for a share `--error-rate` of the requests:
+
+    python -m benchmark.fake_openai --port 8001 --delay 0.2
+    python -m benchmark.fake_openai --port 8001 --rate-limit 20 --window 1 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 python server.py
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from aiohttp import web
+from benchmark.local_models import HashEmbeddings, terms
+
+ANSWER_PREFIX = "Fake answer: "
+
+
+def completion_text(messages):
+    """Returns the fake answer to the messages of a chat completion."""
+    question = messages[-1].get("content", "") if messages else ""
+    return ANSWER_PREFIX + question[-200:]
+
+
+def rate_limited(request):
+    """
+    Decides whether a request is refused with a 429 error.
+
+    Args:
+        request (web.Request): The request.
+
+    Returns:
+        web.Response: The 429 response, or None to serve the request.
+    """
+    app = request.app
+    now = time.monotonic()
+    arrivals = app["arrivals"].setdefault(request.path, deque())
+    while arrivals and arrivals[0] <= now - app["window"]:
+        arrivals.popleft()
+    retry_after = None
+    if app["rate_limit"] and len(arrivals) >= app["rate_limit"]:
+        retry_after = arrivals[0] + app["window"] - now
+    elif app["error_rate"] and random.random() < app["error_rate"]:
+        retry_after = app["retry_after"]
+    else:
+        arrivals.append(now)
+        return None
+    app["stats"]["rate_limited"] += 1
+    headers = {"retry-after-ms": str(round(1000 * retry_after))} if retry_after else {}
+    return web.json_response(
+        {
+            "error": {
+                "message": "Rate limit reached. Please try again later.",
+                "type": "requests",
+                "param": None,
+                "code": "rate_limit_exceeded",
+            }
+        },
+        status=429,
+        headers=headers,
+    )
+
+
+async def handle_chat_completions(request):
+    """Answers a chat completion request, streamed when asked."""
+    body = await request.json()
+    app = request.app
+    refusal = rate_limited(request)
+    if refusal is not None:
+        return refusal
+    app["stats"]["chat_completions"] += 1
+    await asyncio.sleep(app["delay"])
+    text = completion_text(body.get("messages", []))
+    prompt_tokens = sum(
+        len(terms(message.get("content", ""))) for message in body.get("messages", [])
+    )
+    completion_tokens = len(text.split())
+    created = int(time.time())
+    model = body.get("model", "gpt-3.5-turbo")
+
+    if not body.get("stream"):
+        return web.json_response(
+            {
+                "id": f"chatcmpl-fake-{created}",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        )
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    words = text.split(" ")
+    for index, word in enumerate(words):
+        chunk = {
+            "id": f"chatcmpl-fake-{created}",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": word if index == 0 else " " + word},
+                    "finish_reason": "stop" if index == len(words) - 1 else None,
+                }
+            ],
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await asyncio.sleep(app["token_delay"])
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def handle_embeddings(request):
+    """Embeds the input texts with the hash embeddings."""
+    body = await request.json()
+    app = request.app
+    refusal = rate_limited(request)
+    if refusal is not None:
+        return refusal
+    app["stats"]["embeddings"] += 1
+    texts = body.get("input", [])
+    if isinstance(texts, str):
+        texts = [texts]
+    # The clients may send token IDs instead of texts
+    texts = [
+        text if isinstance(text, str) else " ".join(str(token) for token in text)
+        for text in texts
+    ]
+    tokens = sum(len(terms(text)) for text in texts)
+    vectors = app["embeddings"].embed_documents(texts)
+    if body.get("dimensions"):
+        # Shortened like the text-embedding-3 models: truncated, then renormalized
+        vectors = [vector[: body["dimensions"]] for vector in vectors]
+        vectors = [
+            [value / (sum(x * x for x in vector) ** 0.5 or 1.0) for value in vector]
+            for vector in vectors
+        ]
+    return web.json_response(
+        {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": index, "embedding": vector}
+                for index, vector in enumerate(vectors)
+            ],
+            "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+    )
+
+
+async def handle_stats(request):
+    """Returns the number of requests served."""
+    return web.json_response(request.app["stats"])
+
+
+def create_app(
+    delay=0.0,
+    token_delay=0.0,
+    dimension=1536,
+    rate_limit=0,
+    window=60.0,
+    error_rate=0.0,
+    retry_after=1.0,
+):
+    """
+    Creates the fake API application.
+
+    Args:
+        delay (float): The seconds a chat completion waits before answering.
+        token_delay (float): The seconds between streamed tokens.
+        dimension (int): The number of dimensions of the embeddings.
+        rate_limit (int): The requests per endpoint served per window; 0 is unlimited.
+        window (float): The seconds of the rate limit window.
+        error_rate (float): The share of requests refused at random.
+        retry_after (float): The Retry-After seconds of the random refusals;
+            0 sends no header.
+
+    Returns:
+        web.Application: The application.
+    """
+    app = web.Application()
+    app["delay"] = delay
+    app["token_delay"] = token_delay
+    app["embeddings"] = HashEmbeddings(dimension)
+    app["rate_limit"] = rate_limit
+    app["window"] = window
+    app["error_rate"] = error_rate
+    app["retry_after"] = retry_after
+    app["arrivals"] = {}
+    app["stats"] = {"chat_completions": 0, "embeddings": 0, "rate_limited": 0}
+    app.router.add_post("/v1/chat/completions", handle_chat_completions)
+    app.router.add_post("/v1/embeddings", handle_embeddings)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+def main(argv=None):
+    """Runs the fake API."""
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--dim", type=int, default=1536, help="The embedding dimension.")
+    parser.add_argument(
+        "--rate-limit", type=int, default=0, help="Requests per window; 0 is unlimited."
+    )
+    parser.add_argument("--window", type=float, default=60.0)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="The share of random 429 errors."
+    )
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args(argv)
+    web.run_app(
+        create_app(
+            args.delay,
+            args.token_delay,
+            args.dim,
+            rate_limit=args.rate_limit,
+            window=args.window,
+            error_rate=args.error_rate,
+            retry_after=args.retry_after,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides local stand-ins for the OpenAI models, so that
+benchmarks run offline, deterministically and without API costs.
+"""
+import re
+import hashlib
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from src.tokens import count_message_tokens
+
+# Latin words and numbers, or single CJK characters
+_TERM_PATTERN = re.compile(r"[a-z0-9_]+|[\u3400-\u4dbf\u4e00-\u9fff]")
+
+
+def terms(text):
+    """
+    Splits a text into lower-case terms.
+
+    Args:
+        text (str): The text to be split.
+
+    Returns:
+        list: The words and numbers, plus the bigrams of CJK characters.
+    """
+    tokens = _TERM_PATTERN.findall(text.lower())
+    cjk = [token for token in tokens if not token.isascii()]
+    return tokens + [a + b for a, b in zip(cjk, cjk[1:])]
+
+
+class HashEmbeddings(Embeddings):
+    """
+    This class embeds texts as L2-normalized, signed feature-hashed term
+    frequency vectors. Texts sharing terms get similar vectors, which is
+    enough to compare retrieval setups relative to each other.
+
+    Args:
+        dimension (int): The number of vector dimensions.
+    """
+
+    def __init__(self, dimension=1024):
+        self.dimension = dimension
+        self.calls = 0
+
+    def _embed(self, text):
+        """Embeds one text."""
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for term in terms(text):
+            digest = hashlib.md5(term.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        """Embed search docs."""
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        """Embed query text."""
+        self.calls += 1
+        return self._embed(text)
+
+
+class EchoChatModel(BaseChatModel):
+    """
+    This class answers with the first line of the knowledge in its prompt,
+    instantly and deterministically, and records the prompt tokens of every
+    call, so that a retrieval chain can be run and measured offline.
+    """
+
+    prompt_tokens: list = []
+
+    @property
+    def _llm_type(self):
+        """Returns the type of the model."""
+        return "echo"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        """Answers the messages."""
+        prompt = "\n".join(str(message.content) for message in messages)
+        self.prompt_tokens.append(count_message_tokens(prompt))
+        lines = [line.strip() for line in prompt.splitlines() if line.strip()]
+        answer = lines[1] if len(lines) > 1 else prompt
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
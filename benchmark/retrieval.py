@@ -0,0 +1,500 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,R0914
+"""
+This module benchmarks the retrieval quality and latency of the RAG pipeline.
+
+The corpus is ingested by the real pipeline into a temporary Chroma store
+with local hash embeddings, the labelled questions are retrieved from it
+and answered through the real retrieval chain with a local chat model
+stand-in, so the suite runs offline and deterministically:
+
+    python -m benchmark.retrieval --k 1 3 5 --json results.json
+
+The results are written as JSON with sorted keys: "quality" holds the
+deterministic scores (recall@k, hit rate@k, MRR, prompt tokens per answer),
+which can be diffed between commits as they are, and "latency" and
+"ingest" hold the timings, which vary from run to run.
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from langchain_community.vectorstores import Chroma
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain.chains import create_retrieval_chain
+from langchain_core.prompts import ChatPromptTemplate
+from src.config import config_store
+from src.chunkers import get_chunker
+from src.ingest import BulkIngestor, iter_source_files
+from src.retriever import ConfiguredRetriever, RetrieverStats
+from src.context_packer import ContextPacker, PackerStats
+from src.tokens import count_tokens
+from src.manifest import chunk_id
+from src.lexical_index import LEXICAL_INDEX_FILENAME, LexicalIndex
+from src.vector_backends import VECTOR_BACKENDS, LocalCollection, LocalVectorStore
+from benchmark.chunking import DEFAULT_QUESTIONS, DEFAULT_TEMPLATE, load_questions, normalize
+from benchmark.local_models import HashEmbeddings, EchoChatModel
+
+LATENCY_PERCENTILES = [50, 95, 99]
+
+
+def latency_summary(seconds):
+    """
+    Summarizes latencies.
+
+    Args:
+        seconds (list): The latencies in seconds.
+
+    Returns:
+        dict: The mean and the p50, p95 and p99 in milliseconds.
+    """
+    if not seconds:
+        return {}
+    milliseconds = 1000 * np.asarray(seconds)
+    summary = {"mean_ms": round(float(milliseconds.mean()), 3)}
+    for q, value in zip(
+        LATENCY_PERCENTILES, np.percentile(milliseconds, LATENCY_PERCENTILES)
+    ):
+        summary[f"p{q}_ms"] = round(float(value), 3)
+    return summary
+
+
+def build_store(
+    file_paths, directory, embeddings, chunker_factory, lexical_index=None, backend="chroma"
+):
+    """
+    Ingests source files into a new vector store with the bulk ingestion pipeline.
+
+    Args:
+        file_paths (list): The paths of the source files.
+        directory (str): The directory of the store.
+        embeddings (Embeddings): The embedding function.
+        chunker_factory (callable): Returns the chunker of a file extension.
+        lexical_index (LexicalIndex): The keyword index built alongside, if given.
+        backend (str): The vector store backend, 'chroma', 'hnsw' or 'numpy'.
+
+    Returns:
+        VectorStore: The store.
+        IngestReport: The throughput report of the ingestion.
+    """
+    if backend == "chroma":
+        store = Chroma(
+            collection_name="benchmark",
+            embedding_function=embeddings,
+            persist_directory=directory,
+        )
+    else:
+        store = LocalVectorStore(LocalCollection(directory, backend), embeddings)
+
+    def write(texts, vectors, metadatas, ids):
+        # pylint: disable=W0212
+        store._collection.upsert(
+            ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas
+        )
+        if lexical_index is not None:
+            lexical_index.add(ids, texts, metadatas)
+
+    ingestor = BulkIngestor(embeddings, write, chunker_factory=chunker_factory)
+    return store, ingestor.ingest(file_paths)
+
+
+def relevant_ids(stored, answer):
+    """
+    Returns the IDs of the chunks that contain an answer.
+
+    Args:
+        stored (dict): The 'ids' and 'documents' of the chunks in the store.
+        answer (str): The expected answer text.
+
+    Returns:
+        set: The IDs of the relevant chunks.
+    """
+    answer = normalize(answer)
+    return {
+        key
+        for key, text in zip(stored["ids"], stored["documents"])
+        if answer in normalize(text)
+    }
+
+
+def evaluate_retrieval(store, questions, ks, repeat=3, hybrid_settings=None):
+    """
+    Retrieves the top chunks for every question and scores them.
+
+    Args:
+        store (Chroma): The store.
+        questions (list): The labelled questions.
+        ks (list): The numbers of retrieved chunks to score.
+        repeat (int): The number of timed retrievals per question.
+        hybrid_settings (dict): The 'lexical_index' and further settings of a
+            hybrid ConfiguredRetriever, or None for plain vector search.
+
+    Returns:
+        dict: The quality scores.
+        list: The retrieval latencies in seconds.
+    """
+    max_k = max(ks)
+    recall = {k: 0.0 for k in ks}
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks = 0.0
+    unanswerable = []
+    latencies = []
+    stats = RetrieverStats()
+    retriever = None
+    if hybrid_settings is not None:
+        retriever = ConfiguredRetriever(
+            vectorstore=store,
+            k=max_k,
+            fetch_k=max(20, max_k),
+            stats=stats,
+            **hybrid_settings,
+        )
+
+    def retrieve(query):
+        if retriever is not None:
+            return [
+                chunk_id(document.metadata.get("source_path", ""), document.page_content)
+                for document in retriever.invoke(query)
+            ]
+        vector = store._embedding_function.embed_query(query)
+        return store._collection.query(
+            query_embeddings=[vector], n_results=max_k, include=[]
+        )["ids"][0]
+
+    # pylint: disable=W0212
+    stored = store._collection.get(include=["documents"])
+    for question in questions:
+        relevant = relevant_ids(stored, question["answer"])
+        # Warm up once, then time the retrievals
+        retrieve(question["question"])
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            retrieved = retrieve(question["question"])
+            latencies.append(time.perf_counter() - started)
+
+        if not relevant:
+            unanswerable.append(question["id"])
+            continue
+        for k in ks:
+            found = relevant.intersection(retrieved[:k])
+            recall[k] += len(found) / len(relevant)
+            hits[k] += bool(found)
+        for rank, key in enumerate(retrieved, start=1):
+            if key in relevant:
+                reciprocal_ranks += 1 / rank
+                break
+
+    num_questions = len(questions) or 1
+    quality = {"questions": len(questions), "unanswerable": unanswerable}
+    for k in ks:
+        quality[f"recall@{k}"] = round(recall[k] / num_questions, 4)
+        quality[f"hit_rate@{k}"] = round(hits[k] / num_questions, 4)
+    quality[f"mrr@{max_k}"] = round(reciprocal_ranks / num_questions, 4)
+    if retriever is not None:
+        # Every question was retrieved once to warm up and `repeat` times timed
+        quality["lexical_only_rate"] = round(stats.lexical_only / (stats.queries or 1), 4)
+    return quality, latencies
+
+
+def evaluate_answers(
+    store,
+    questions,
+    k,
+    prompt_template,
+    retriever_settings=None,
+    packer_settings=None,
+    hybrid_settings=None,
+):
+    """
+    Answers every question through the retrieval chain with the local chat model.
+
+    Args:
+        store (Chroma): The store.
+        questions (list): The labelled questions.
+        k (int): The number of retrieved chunks.
+        prompt_template (str): The prompt with {context} and {input} placeholders.
+        retriever_settings (dict): Further settings of the ConfiguredRetriever,
+            e.g. {"search_type": "mmr", "score_threshold": 0.3}.
+        packer_settings (dict): The settings of the ContextPacker, e.g.
+            {"model_name": "gpt-3.5-turbo-0125", "budget_tokens": 1000}, or
+            None to stuff the retrieved chunks verbatim.
+        hybrid_settings (dict): The 'lexical_index' and further settings of
+            hybrid search, or None for plain vector search.
+
+    Returns:
+        dict: The prompt and context tokens per answer.
+        list: The answer latencies in seconds.
+    """
+    model = EchoChatModel()
+    stats = RetrieverStats()
+    packer_stats = PackerStats()
+    packer = None
+    if packer_settings is not None:
+        packer = ContextPacker(
+            prompt_tokens=count_tokens(
+                ChatPromptTemplate.from_template(prompt_template)
+                .format_messages(context="", input="")[0]
+                .content
+            ),
+            stats=packer_stats,
+            **packer_settings,
+        )
+    chain = create_retrieval_chain(
+        ConfiguredRetriever(
+            vectorstore=store,
+            k=k,
+            stats=stats,
+            packer=packer,
+            **(retriever_settings or {}),
+            **(hybrid_settings or {}),
+        ),
+        create_stuff_documents_chain(
+            llm=model, prompt=ChatPromptTemplate.from_template(prompt_template)
+        ),
+    )
+    latencies = []
+    for question in questions:
+        started = time.perf_counter()
+        chain.invoke({"input": question["question"]})
+        latencies.append(time.perf_counter() - started)
+    retrieval = stats.as_dict()
+    answers = {
+        "answer_k": k,
+        "prompt_tokens_per_answer": round(float(np.mean(model.prompt_tokens)), 1),
+        "max_prompt_tokens": max(model.prompt_tokens),
+        "context_tokens_per_answer": retrieval["context_tokens_per_query"],
+        "saved_context_tokens_per_answer": retrieval["saved_tokens_per_query"],
+    }
+    if packer is not None:
+        packing = packer_stats.as_dict()
+        answers.update(
+            packed_saved_tokens_per_answer=packing["saved_tokens_per_request"],
+            packed_merged_chunks=packing["merged_chunks"],
+            packed_duplicate_chunks=packing["duplicate_chunks"],
+            packed_dropped_chunks=packing["dropped_chunks"],
+        )
+    return answers, latencies
+
+
+def run(
+    data_path,
+    questions,
+    ks,
+    answer_k,
+    strategy="structure",
+    chunk_tokens=350,
+    overlap_tokens=35,
+    prompt_template=DEFAULT_TEMPLATE,
+    repeat=3,
+    retriever_settings=None,
+    packer_settings=None,
+    lexical_margin=None,
+    backend="chroma",
+):
+    """
+    Runs the benchmark suite.
+
+    Args:
+        data_path (str): The corpus file or folder.
+        questions (list): The labelled questions.
+        ks (list): The numbers of retrieved chunks to score.
+        answer_k (int): The number of chunks in the prompt of an answer.
+        strategy (str): The chunking strategy, 'fixed' or 'structure'.
+        chunk_tokens (int): The maximum number of tokens per chunk.
+        overlap_tokens (int): The maximum number of overlapping tokens.
+        prompt_template (str): The prompt with {context} and {input} placeholders.
+        repeat (int): The number of timed retrievals per question.
+        retriever_settings (dict): Further settings of the answer retriever.
+        packer_settings (dict): The settings of the context packer, or None to
+            stuff the retrieved chunks verbatim.
+        lexical_margin (float): Search hybrid with a BM25 index, answering
+            from keywords alone when the best match scores this many times
+            the runner-up (0 never does), or None for plain vector search.
+        backend (str): The vector store backend, 'chroma', 'hnsw' or 'numpy'.
+
+    Returns:
+        dict: The results.
+    """
+    file_paths = list(iter_source_files(data_path))
+    sources = {os.path.normpath(file_path) for file_path in file_paths}
+    questions = [
+        question
+        for question in questions
+        if os.path.normpath(question.get("source", "")) in sources
+    ]
+
+    def chunker_factory(file_type):
+        return get_chunker(
+            file_type,
+            strategy,
+            chunk_tokens=chunk_tokens,
+            overlap_tokens=overlap_tokens,
+        )
+
+    directory = tempfile.mkdtemp(prefix="dstgpt-benchmark-")
+    try:
+        hybrid_settings = None
+        if lexical_margin is not None:
+            hybrid_settings = {
+                "lexical_index": LexicalIndex(
+                    os.path.join(directory, LEXICAL_INDEX_FILENAME)
+                ),
+                "lexical_margin": lexical_margin,
+            }
+        store, report = build_store(
+            file_paths,
+            directory,
+            HashEmbeddings(),
+            chunker_factory,
+            hybrid_settings and hybrid_settings["lexical_index"],
+            backend,
+        )
+        quality, retrieval_latencies = evaluate_retrieval(
+            store, questions, ks, repeat, hybrid_settings
+        )
+        answers, answer_latencies = evaluate_answers(
+            store,
+            questions,
+            answer_k,
+            prompt_template,
+            retriever_settings,
+            packer_settings,
+            hybrid_settings,
+        )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    quality.update(answers)
+    return {
+        "settings": {
+            "data": data_path,
+            "files": len(file_paths),
+            "chunking": strategy,
+            "chunk_tokens": chunk_tokens,
+            "overlap_tokens": overlap_tokens,
+            "chunks": report.chunks,
+            "ks": ks,
+            "retriever": retriever_settings or {},
+            "context_packer": packer_settings,
+            "lexical_margin": lexical_margin,
+            "backend": backend,
+        },
+        "quality": quality,
+        "latency": {
+            "retrieval": latency_summary(retrieval_latencies),
+            "answer": latency_summary(answer_latencies),
+        },
+        "ingest": {
+            "elapsed_seconds": round(report.elapsed, 3),
+            "chunks_per_second": round(report.rate(report.chunks), 1),
+            "tokens_per_second": round(report.rate(report.tokens), 1),
+        },
+    }
+
+
+def main(argv=None):
+    """Runs the benchmark suite and prints or writes its results."""
+    config = config_store
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency.")
+    parser.add_argument(
+        "--data", default="data/sample_data.json", help="The corpus file or folder."
+    )
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS)
+    parser.add_argument(
+        "--k", type=int, nargs="+", default=[1, 3, 5], help="The numbers of chunks to score."
+    )
+    parser.add_argument(
+        "--answer-k", type=int, default=4, help="The number of chunks in an answer prompt."
+    )
+    parser.add_argument("--chunking", default=config.get_str("CHUNKING", "structure"))
+    parser.add_argument(
+        "--chunk-tokens", type=int, default=config.get_int("CHUNK_TOKENS", 350)
+    )
+    parser.add_argument(
+        "--overlap-tokens", type=int, default=config.get_int("CHUNK_OVERLAP_TOKENS", 35)
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="The timed retrievals per question."
+    )
+    parser.add_argument(
+        "--search-type", default="similarity", choices=["similarity", "mmr"]
+    )
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument(
+        "--score-threshold",
+        type=float,
+        default=None,
+        help="The minimum cosine similarity of a chunk in an answer prompt.",
+    )
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="Fuse vector search with a BM25 keyword index.",
+    )
+    parser.add_argument(
+        "--lexical-margin",
+        type=float,
+        default=config.get_float("RETRIEVER_LEXICAL_MARGIN", 2.0),
+        help="How clearly the best keyword match must win to skip vector search.",
+    )
+    parser.add_argument(
+        "--no-packing",
+        action="store_true",
+        help="Stuff the retrieved chunks into the answer prompts verbatim.",
+    )
+    parser.add_argument(
+        "--context-budget",
+        type=int,
+        default=config.get_int("CONTEXT_BUDGET_TOKENS", 0),
+        help="The most context tokens per answer; 0 fills the context window.",
+    )
+    parser.add_argument(
+        "--backend",
+        default=config.get_str("VECTORSTORE_BACKEND", "chroma"),
+        choices=VECTOR_BACKENDS,
+        help="The vector store backend.",
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.data,
+        load_questions(args.questions),
+        sorted(set(args.k)),
+        args.answer_k,
+        args.chunking,
+        args.chunk_tokens,
+        args.overlap_tokens,
+        config.get_str("PROMPT_TEMPLATE") or DEFAULT_TEMPLATE,
+        args.repeat,
+        {
+            "search_type": args.search_type,
+            "fetch_k": args.fetch_k,
+            "score_threshold": args.score_threshold,
+        },
+        None
+        if args.no_packing
+        else {
+            "model_name": config.get_str("BASE_MODEL", "gpt-3.5-turbo"),
+            "budget_tokens": args.context_budget,
+            "reserved_tokens": config.get_int("CONTEXT_RESERVED_TOKENS", 1024),
+            "duplicate_similarity": config.get_float("CONTEXT_DUPLICATE_SIMILARITY", 0.9),
+        },
+        args.lexical_margin if args.hybrid else None,
+        args.backend,
+    )
+    text = json.dumps(results, indent=4, sort_keys=True, ensure_ascii=False)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+        print(f"quality: {results['quality']}")
+        print(f"latency: {results['latency']}")
+        print(f" ingest: {results['ingest']}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,R0914
+"""
+This module benchmarks the request scheduler against a rate-limited API.
+
+The fake OpenAI API is started in a process of its own with a limit of
+requests per second per endpoint. A bulk ingestion sends embedding batches
+as fast as it can while questions arrive at a steady pace, each embedding
+its query and asking for a chat completion, as the app does:
+
+    python -m benchmark.scheduler --rate-limit 20 --questions 20 --batches 200
+
+Each mode runs against a fresh API: 'client' sends the requests directly,
+left to the retries of the OpenAI client, and 'scheduler' sends them
+through the schedulers of the app, paced below the limit, with the
+ingestion in the bulk lane. The benchmark reports the 429 errors served,
+the failed requests, the latency of the questions and the time the
+ingestion took, and the counters of the schedulers.
+"""
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import httpx
+import openai
+from src.scheduler import RequestScheduler, AsyncScheduledResource, request_lane
+from benchmark.retrieval import latency_summary
+
+MODES = ["client", "scheduler"]
+
+
+def start_api(rate_limit, error_rate, timeout=30):
+    """
+    Starts the fake API on a free local port.
+
+    Args:
+        rate_limit (int): The requests per second of each endpoint.
+        error_rate (float): The share of requests refused at random.
+        timeout (float): The seconds to wait for it to come up.
+
+    Returns:
+        subprocess.Popen: The process of the API, to be terminated.
+        str: The URL of the API.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmark.fake_openai",
+            f"--port={port}",
+            f"--rate-limit={rate_limit}",
+            "--window=1",
+            f"--error-rate={error_rate}",
+            "--retry-after=0.5",
+            # Small vectors keep the clients from being the bottleneck
+            "--dim=64",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(f"{url}/stats")
+            return process, url
+        except httpx.TransportError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.terminate()
+                raise
+            time.sleep(0.1)
+
+
+async def run_mode(mode, rate_limit, questions, batches, batch_size, interval, error_rate):
+    """
+    Runs the ingestion and the questions in one mode.
+
+    Args:
+        mode (str): 'client' or 'scheduler'.
+        rate_limit (int): The requests per second of each endpoint of the API.
+        questions (int): The number of questions.
+        batches (int): The number of embedding batches of the ingestion.
+        batch_size (int): The texts per embedding batch.
+        interval (float): The seconds between questions.
+        error_rate (float): The share of requests refused at random.
+
+    Returns:
+        dict: The results.
+    """
+    process, url = start_api(rate_limit, error_rate)
+    client = openai.AsyncOpenAI(
+        api_key="fake", base_url=f"{url}/v1", max_retries=2 if mode == "client" else 0
+    )
+    chat, embeddings = client.chat.completions, client.embeddings
+    schedulers = {}
+    if mode == "scheduler":
+        # Paced a little below the limit of the API
+        schedulers = {
+            kind: RequestScheduler(requests_per_minute=int(0.9 * 60 * rate_limit))
+            for kind in ("chat", "embeddings")
+        }
+        chat = AsyncScheduledResource(chat, schedulers["chat"])
+        embeddings = AsyncScheduledResource(embeddings, schedulers["embeddings"])
+
+    failures = {"bulk": 0, "questions": 0}
+    latencies = []
+
+    async def ingest():
+        async def embed(batch):
+            try:
+                await embeddings.create(
+                    model="text-embedding-ada-002",
+                    input=[f"chunk {batch} {i} of the corpus" for i in range(batch_size)],
+                )
+            except openai.APIError:
+                failures["bulk"] += 1
+
+        start = time.perf_counter()
+        with request_lane("bulk"):
+            await asyncio.gather(*(embed(batch) for batch in range(batches)))
+        return time.perf_counter() - start
+
+    async def ask(number):
+        await asyncio.sleep(number * interval)
+        start = time.perf_counter()
+        try:
+            await embeddings.create(
+                model="text-embedding-ada-002", input=[f"question {number}"]
+            )
+            await chat.create(
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": f"question {number}"}],
+            )
+        except openai.APIError:
+            failures["questions"] += 1
+            return
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        ingest_seconds, *_ = await asyncio.gather(
+            ingest(), *(ask(number) for number in range(questions))
+        )
+        rate_limited = httpx.get(f"{url}/stats").json()["rate_limited"]
+    finally:
+        await client.close()
+        process.terminate()
+        process.wait()
+    return {
+        "rate_limited": rate_limited,
+        "failed_batches": failures["bulk"],
+        "failed_questions": failures["questions"],
+        "ingest_seconds": round(ingest_seconds, 3),
+        "question": latency_summary(latencies),
+        "schedulers": {
+            kind: scheduler.stats.as_dict() for kind, scheduler in schedulers.items()
+        },
+    }
+
+
+def run(
+    modes=None,
+    rate_limit=20,
+    questions=20,
+    batches=200,
+    batch_size=16,
+    interval=0.25,
+    error_rate=0.0,
+):
+    """
+    Runs the benchmark in every mode. See run_mode() for the arguments.
+
+    Returns:
+        dict: The results.
+    """
+    results = {}
+    for mode in modes or MODES:
+        results[mode] = asyncio.run(
+            run_mode(mode, rate_limit, questions, batches, batch_size, interval, error_rate)
+        )
+        print(f"{mode:>9}: {results[mode]}")
+    return {
+        "settings": {
+            "rate_limit": rate_limit,
+            "questions": questions,
+            "batches": batches,
+            "batch_size": batch_size,
+            "interval": interval,
+            "error_rate": error_rate,
+        },
+        "modes": results,
+    }
+
+
+def main(argv=None):
+    """Runs the benchmark and prints or writes its results."""
+    parser = argparse.ArgumentParser(description="Benchmark the request scheduler.")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument(
+        "--rate-limit", type=int, default=20, help="Requests per second per endpoint."
+    )
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument(
+        "--batches", type=int, default=200, help="Embedding batches ingested."
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument(
+        "--interval", type=float, default=0.25, help="Seconds between questions."
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of random 429s."
+    )
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.modes,
+        args.rate_limit,
+        args.questions,
+        args.batches,
+        args.batch_size,
+        args.interval,
+        args.error_rate,
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
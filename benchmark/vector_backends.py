@@ -0,0 +1,336 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,R0914,C0415
+"""
+This module benchmarks the vector store backends at scale.
+
+Synthetic unit vectors, clustered like the embeddings of a real corpus,
+or the vectors of an existing Chroma store, are loaded into every backend,
+which is then queried with perturbed copies of stored vectors. Each
+backend runs in a process of its own, so its memory is measured in
+isolation:
+
+    python -m benchmark.vector_backends --vectors 100000 --dim 1536 --json backends.json
+    python -m benchmark.vector_backends --store database
+
+The benchmark reports the build time, the query latency, the recall@k of
+the approximate backends against an exact search, the resident and the
+private memory, and the size on disk of every backend. The memory-mapped
+backends are given as 'mmap:bfloat16' and 'mmap:int8'; the pages of their
+files are shared by the processes of a host, so only the private memory
+grows with every instance.
+"""
+import os
+import gc
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import psutil
+from src.vector_backends import VECTOR_BACKENDS, MMAP_DTYPES, LocalCollection
+from benchmark.retrieval import latency_summary
+
+DEFAULT_BACKENDS = VECTOR_BACKENDS[:-1] + [f"mmap:{dtype}" for dtype in MMAP_DTYPES]
+
+
+def synthetic_vectors(count, dimension, clusters=100, noise=0.5, seed=0):
+    """
+    Generates clustered unit vectors.
+
+    Args:
+        count (int): The number of vectors.
+        dimension (int): The dimension of the vectors.
+        clusters (int): The number of clusters.
+        noise (float): The spread of a cluster relative to its center.
+        seed (int): The random seed.
+
+    Returns:
+        np.ndarray: The float32 vectors, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)]
+    vectors += noise * rng.standard_normal((count, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def stored_vectors(vectorstore_directory, limit=None, batch_size=5000):
+    """
+    Reads the vectors of a Chroma store.
+
+    Args:
+        vectorstore_directory (str): The directory holding chroma.sqlite3.
+        limit (int): The most vectors read, or None for all.
+        batch_size (int): The number of vectors read at once.
+
+    Returns:
+        np.ndarray: The float32 unit vectors, one per row.
+    """
+    import chromadb
+
+    client = chromadb.PersistentClient(path=vectorstore_directory)
+    batches = []
+    for collection in client.list_collections():
+        total = collection.count() if limit is None else min(limit, collection.count())
+        for offset in range(0, total, batch_size):
+            batch = collection.get(
+                include=["embeddings"], limit=min(batch_size, total - offset), offset=offset
+            )
+            batches.append(np.asarray(batch["embeddings"], dtype=np.float32))
+    vectors = np.concatenate(batches)[:limit]
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def exact_neighbours(vectors, queries, k, batch_size=256):
+    """
+    Finds the true nearest neighbours of the queries.
+
+    Args:
+        vectors (np.ndarray): The stored unit vectors.
+        queries (np.ndarray): The unit query vectors.
+        k (int): The number of neighbours.
+        batch_size (int): The number of queries compared at once.
+
+    Returns:
+        list: The sets of the row numbers of the neighbours, per query.
+    """
+    neighbours = []
+    for i in range(0, len(queries), batch_size):
+        similarities = queries[i : i + batch_size] @ vectors.T
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        neighbours.extend(set(row.tolist()) for row in top)
+    return neighbours
+
+
+def open_collection(backend, directory, index_settings, create=False):
+    """
+    Opens the collection of a backend, following the Chroma API.
+
+    Args:
+        backend (str): The backend, e.g. 'hnsw', or 'mmap:int8' for the
+            memory-mapped backend with a vector type.
+        directory (str): The directory of the store.
+        index_settings (dict): The settings of the HNSW and memory-mapped
+            indexes.
+        create (bool): Whether to create an empty collection.
+
+    Returns:
+        Collection: The collection.
+    """
+    backend, _, dtype = backend.partition(":")
+    if backend == "chroma":
+        import chromadb
+
+        client = chromadb.PersistentClient(path=directory)
+        if create:
+            return client.create_collection("benchmark")
+        return client.get_collection("benchmark")
+    if backend == "hnsw":
+        settings = {key: index_settings[key] for key in ("M", "ef_construction", "ef")}
+    elif backend == "mmap":
+        settings = {"dtype": dtype or "int8", "rescore": index_settings["rescore"]}
+    else:
+        settings = {}
+    return LocalCollection(directory, backend, **settings)
+
+
+def build_backend(backend, directory, vectors, batch_size, index_settings):
+    """
+    Stores vectors in a new collection of a backend.
+
+    Args:
+        backend (str): The backend, e.g. 'chroma', or 'mmap:int8'.
+        directory (str): The directory of the store.
+        vectors (np.ndarray): The vectors to store.
+        batch_size (int): The number of vectors added at once.
+        index_settings (dict): The settings of the HNSW and memory-mapped indexes.
+
+    Returns:
+        float: The seconds it took.
+    """
+    start = time.perf_counter()
+    collection = open_collection(backend, directory, index_settings, create=True)
+    for offset in range(0, len(vectors), batch_size):
+        batch = vectors[offset : offset + batch_size]
+        collection.upsert(
+            ids=[str(offset + i) for i in range(len(batch))],
+            embeddings=batch.tolist(),
+            documents=[""] * len(batch),
+            metadatas=[{"row": offset + i} for i in range(len(batch))],
+        )
+    if hasattr(collection, "persist"):
+        collection.persist()
+    return time.perf_counter() - start
+
+
+def query_backend(backend, directory, queries, k, index_settings):
+    """
+    Opens a stored collection, as a new instance of the app does, and queries it.
+
+    Args:
+        backend (str): The backend, e.g. 'chroma', or 'mmap:int8'.
+        directory (str): The directory of the store.
+        queries (np.ndarray): The query vectors.
+        k (int): The number of neighbours per query.
+        index_settings (dict): The settings of the HNSW and memory-mapped indexes.
+
+    Returns:
+        list: The latencies of the queries in seconds.
+        list: The row numbers retrieved per query.
+        dict: The resident and the private memory the store added, in MB.
+    """
+    process = psutil.Process()
+    baseline = process.memory_info()
+    collection = open_collection(backend, directory, index_settings)
+    latencies = []
+    retrieved = []
+    for query in queries:
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+        latencies.append(time.perf_counter() - start)
+        retrieved.append([int(key) for key in result["ids"][0]])
+    memory = process.memory_info()
+    # Pages of a file are shared with the other processes that map it
+    shared = getattr(memory, "shared", 0) - getattr(baseline, "shared", 0)
+    return (
+        latencies,
+        retrieved,
+        {
+            "rss_mb": round((memory.rss - baseline.rss) / 2**20, 1),
+            "private_mb": round((memory.rss - baseline.rss - shared) / 2**20, 1),
+        },
+    )
+
+
+def run(
+    vectors,
+    backends=None,
+    queries=200,
+    k=10,
+    batch_size=4096,
+    index_settings=None,
+):
+    """
+    Runs the benchmark on every backend.
+
+    Args:
+        vectors (np.ndarray): The unit vectors to store.
+        backends (list): The backends to measure; all by default.
+        queries (int): The number of queries.
+        k (int): The number of neighbours per query.
+        batch_size (int): The number of vectors added at once.
+        index_settings (dict): The M, ef_construction and ef of the HNSW
+            index, and the rescore of the memory-mapped one.
+
+    Returns:
+        dict: The results.
+    """
+    index_settings = index_settings or {}
+    rng = np.random.default_rng(1)
+    query_vectors = vectors[rng.integers(0, len(vectors), queries)]
+    query_vectors = query_vectors + 0.05 * rng.standard_normal(query_vectors.shape).astype(
+        np.float32
+    )
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    truth = exact_neighbours(vectors, query_vectors, k)
+
+    results = {}
+    # A fresh interpreter per step keeps the memory of the others out of its RSS
+    context = multiprocessing.get_context("spawn")
+    for backend in backends or DEFAULT_BACKENDS:
+        directory = tempfile.mkdtemp(prefix=f"dstgpt-{backend.replace(':', '-')}-")
+        try:
+            with context.Pool(1) as pool:
+                build_seconds = pool.apply(
+                    build_backend, (backend, directory, vectors, batch_size, index_settings)
+                )
+            with context.Pool(1) as pool:
+                latencies, retrieved, memory = pool.apply(
+                    query_backend, (backend, directory, query_vectors, k, index_settings)
+                )
+            disk = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(directory)
+                for name in names
+            )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        recall = np.mean([len(truth[i] & set(rows)) / k for i, rows in enumerate(retrieved)])
+        results[backend] = {
+            "build_seconds": round(build_seconds, 3),
+            "vectors_per_second": round(len(vectors) / build_seconds, 1),
+            "query": latency_summary(latencies),
+            f"recall@{k}": round(float(recall), 4),
+            "disk_mb": round(disk / 2**20, 1),
+            **memory,
+        }
+    return {
+        "settings": {
+            "vectors": len(vectors),
+            "dimension": vectors.shape[1],
+            "queries": queries,
+            "k": k,
+            "index": index_settings,
+        },
+        "backends": results,
+    }
+
+
+def main(argv=None):
+    """Runs the benchmark and prints or writes its results."""
+    parser = argparse.ArgumentParser(description="Benchmark the vector store backends.")
+    parser.add_argument(
+        "--store", help="Benchmark the vectors of this Chroma store instead of synthetic ones."
+    )
+    parser.add_argument(
+        "--vectors",
+        type=int,
+        help="The synthetic vectors (20000 by default), or the most read from the store.",
+    )
+    parser.add_argument("--dim", type=int, default=1536, help="The synthetic vector dimension.")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=DEFAULT_BACKENDS,
+        choices=VECTOR_BACKENDS + DEFAULT_BACKENDS[len(VECTOR_BACKENDS) - 1 :],
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef", type=int, default=64)
+    parser.add_argument("--rescore", type=int, default=4)
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    if args.store:
+        vectors = stored_vectors(args.store, args.vectors)
+    else:
+        vectors = synthetic_vectors(args.vectors or 20000, args.dim)
+    results = run(
+        vectors,
+        args.backends,
+        args.queries,
+        args.k,
+        args.batch_size,
+        {
+            "M": args.M,
+            "ef_construction": args.ef_construction,
+            "ef": args.ef,
+            "rescore": args.rescore,
+        },
+    )
+    results["settings"]["store"] = args.store
+    text = json.dumps(results, indent=4, sort_keys=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-# pylint: disable=E0611,C0103,C0303
+# pylint: disable=E0611,C0103,C0303,C0413
 """
 This module provides a PyQt5 application for a chat window.
 """
@@ -7,7 +7,10 @@ import asyncio
 from qasync import QEventLoop
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QApplication
-from src.main_window import MainWindow
+from src.startup import startup_timer
+
+with startup_timer.phase("import gui"):
+    from src.main_window import MainWindow
 
 
 def main():
@@ -20,8 +23,9 @@ def main():
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
 
-    mainWindow = MainWindow()
-    mainWindow.show()
+    with startup_timer.phase("window"):
+        mainWindow = MainWindow()
+        mainWindow.show()
 
     with loop:
         loop.run_forever()
@@ -0,0 +1,9 @@
+# pylint: disable=E0611,C0103,C0303
+"""
+This module starts the headless HTTP server of DST-GPT.
+"""
+from src.server import main
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913
+"""
+This module provides a semantic cache for LLM answers.
+"""
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_question(question):
+    """
+    Normalizes a question for exact-match lookups.
+
+    Args:
+        question (str): The question asked by the user.
+
+    Returns:
+        str: The question in lower case, with collapsed whitespace and
+        without trailing punctuation.
+    """
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!.。？！ ")
+
+
+class AnswerCache:
+    """
+    This class caches answers by their exact normalized question and by
+    the similarity of question embeddings.
+
+    Entries are scoped, e.g. by model, temperature, prompt template and RAG
+    mode, and answers that depend on the vector store remember the store
+    version they were produced from, so they are dropped when the store changes.
+
+    Args:
+        max_entries (int): The maximum number of cached answers (LRU eviction).
+        ttl (float): The number of seconds an answer stays valid.
+        similarity_threshold (float): The minimum cosine similarity between
+            question embeddings for a semantic hit. 1 disables semantic hits.
+    """
+
+    def __init__(self, max_entries=512, ttl=86400, similarity_threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def semantic(self):
+        """bool: Whether lookups by question embedding are enabled."""
+        return self.similarity_threshold < 1
+
+    def _is_valid(self, entry, store_version, now):
+        """Checks an entry against its TTL and the current store version."""
+        if now - entry["created"] > self.ttl:
+            return False
+        return entry["store_version"] is None or entry["store_version"] == store_version
+
+    def lookup(self, scope, question, question_vector=None, store_version=None):
+        """
+        Looks up the answer to a question.
+
+        Args:
+            scope (tuple): The settings the answer must have been produced with.
+            question (str): The question asked by the user.
+            question_vector (list): The embedding of the question, for semantic lookups.
+            store_version (int): The current version of the vector store.
+
+        Returns:
+            The cached answer, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            answer = self._lookup_exact(scope, question, store_version, now)
+            if answer is not None:
+                return answer
+
+            if self.semantic and question_vector is not None:
+                candidates = [
+                    (candidate_key, candidate)
+                    for candidate_key, candidate in self._entries.items()
+                    if candidate_key[0] == scope
+                    and candidate["vector"] is not None
+                    and self._is_valid(candidate, store_version, now)
+                ]
+                if candidates:
+                    query = np.asarray(question_vector, dtype=np.float32)
+                    query /= np.linalg.norm(query) or 1.0
+                    matrix = np.stack([candidate["vector"] for _, candidate in candidates])
+                    similarities = matrix @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        candidate_key, candidate = candidates[best]
+                        self._entries.move_to_end(candidate_key)
+                        self.semantic_hits += 1
+                        return candidate["answer"]
+
+            self.misses += 1
+            return None
+
+    def lookup_exact(self, scope, question, store_version=None):
+        """
+        Looks up the answer to the exact normalized question only.
+
+        A miss is not counted, since a lookup() is expected to follow it,
+        e.g. once the question has been embedded.
+
+        Args:
+            scope (tuple): The settings the answer must have been produced with.
+            question (str): The question asked by the user.
+            store_version (int): The current version of the vector store.
+
+        Returns:
+            The cached answer, or None on a miss.
+        """
+        with self._lock:
+            return self._lookup_exact(scope, question, store_version, time.time())
+
+    def _lookup_exact(self, scope, question, store_version, now):
+        """Looks up an exact match; the lock must be held."""
+        key = (scope, normalize_question(question))
+        entry = self._entries.get(key)
+        if entry is None or not self._is_valid(entry, store_version, now):
+            return None
+        self._entries.move_to_end(key)
+        self.exact_hits += 1
+        return entry["answer"]
+
+    def store(self, scope, question, answer, question_vector=None, store_version=None):
+        """
+        Stores the answer to a question.
+
+        Args:
+            scope (tuple): The settings the answer was produced with.
+            question (str): The question asked by the user.
+            answer: The answer to be cached.
+            question_vector (list): The embedding of the question.
+            store_version (int): The version of the vector store the answer
+                depends on, or None if it does not depend on the store.
+        """
+        vector = None
+        if question_vector is not None:
+            vector = np.asarray(question_vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._entries[key] = {
+                "answer": answer,
+                "vector": vector,
+                "store_version": store_version,
+                "created": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, store_version=None):
+        """
+        Drops the answers that depend on an outdated vector store.
+
+        Args:
+            store_version (int): The current version of the vector store.
+            Default None drops all answers.
+        """
+        with self._lock:
+            if store_version is None:
+                self._entries.clear()
+                return
+            for key in [
+                key
+                for key, entry in self._entries.items()
+                if entry["store_version"] not in (None, store_version)
+            ]:
+                del self._entries[key]
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: The number of exact hits, semantic hits, misses and entries.
+        """
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
@@ -0,0 +1,292 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,W0703
+"""
+This module answers a JSONL file of questions without the GUI, e.g. to
+rerun the reference questions after changing the prompt template or corpus:
+
+    python -m src.batch_qa benchmark/questions.jsonl answers.jsonl --concurrency 4
+
+Every line of the input holds a question, and optionally its 'id', 'mode'
+('rag', 'pure' or 'both') and 'where' filter. Every answered question is
+appended to the output as soon as it completes, with the retrieved chunk IDs,
+token counts, cost and latency. The output doubles as the checkpoint: a rerun
+skips the questions already answered, so an interrupted run resumes without
+paying for them twice. Failed questions are retried.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from src.manifest import chunk_id
+from src.llm import LLM, ANSWER_MODES
+from src.scheduler import request_lane
+
+
+def load_questions(questions_filepath):
+    """
+    Reads the questions to be answered.
+
+    Args:
+        questions_filepath (str): The path of the JSONL file of questions.
+
+    Returns:
+        list: The questions as dictionaries. Questions without an 'id' are
+        numbered by their line.
+    """
+    questions = []
+    with open(questions_filepath, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            question = json.loads(line)
+            if isinstance(question, str):
+                question = {"question": question}
+            question.setdefault("id", str(line_number))
+            questions.append(question)
+    return questions
+
+
+def load_checkpoint(output_filepath):
+    """
+    Reads the answers of an earlier run.
+
+    Args:
+        output_filepath (str): The path of the JSONL file of answers.
+
+    Returns:
+        set: The IDs of the questions answered without an error. A line cut
+        off by a crash is ignored.
+    """
+    answered = set()
+    if not os.path.exists(output_filepath):
+        return answered
+    with open(output_filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("error") is None:
+                answered.add(str(result.get("id")))
+    return answered
+
+
+def context_chunk_ids(documents):
+    """
+    Returns the vector store IDs of retrieved documents.
+
+    Args:
+        documents (list): The retrieved documents.
+
+    Returns:
+        list: The chunk IDs, derived like the IDs the chunks were stored with,
+        including every chunk the context packer merged into a document.
+    """
+    ids = []
+    for document in documents:
+        if "chunk_ids" in document.metadata:
+            ids.extend(document.metadata["chunk_ids"])
+        else:
+            ids.append(
+                chunk_id(document.metadata.get("source_path", ""), document.page_content)
+            )
+    return ids
+
+
+class BatchAnswerer:
+    """
+    This class answers questions with at most `concurrency` questions in
+    flight, appending each result to the output file as soon as it completes.
+
+    Args:
+        llm (LLM): The LLM answering the questions.
+        output_file (file): The JSONL file the results are appended to.
+        concurrency (int): The maximum number of questions answered at once.
+        default_mode (str): The RAG mode of questions without a 'mode'.
+    """
+
+    def __init__(self, llm, output_file, concurrency=4, default_mode="enabled"):
+        self.llm = llm
+        self.output_file = output_file
+        self.concurrency = concurrency
+        self.default_mode = default_mode
+        self.results = []
+
+    async def answer(self, question):
+        """
+        Answers one question.
+
+        Args:
+            question (dict): The question.
+
+        Returns:
+            dict: The result to be written.
+        """
+        mode = ANSWER_MODES.get(str(question.get("mode", self.default_mode)))
+        result = {"id": str(question["id"]), "question": question["question"]}
+        answer = None
+        usage = {}
+        context = {}
+        started = time.perf_counter()
+        if mode is None:
+            result["error"] = f"Invalid mode: {question.get('mode')}"
+        else:
+            try:
+                answer = await self.llm.get_answer_async(
+                    question["question"], mode, question.get("where"), usage, context
+                )
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+        latency = time.perf_counter() - started
+        try:
+            cost = sum(self.llm.calculate_cost(item) for item in usage.values())
+        except ValueError as e:
+            # A model without a price; the answer is kept, so a rerun does not pay again
+            cost = None
+            result["warning"] = f"Unknown cost: {e}"
+
+        documents = context.get("rag", [])
+        result.update(
+            mode=mode,
+            answer=answer,
+            chunk_ids=context_chunk_ids(documents),
+            sources=[document.metadata.get("source_path") for document in documents],
+            usage=usage,
+            tokens=sum(
+                item["prompt_tokens"] + item["completion_tokens"] for item in usage.values()
+            ),
+            cost=cost,
+            latency_ms=round(1000 * latency, 1),
+        )
+        result.setdefault("error", None)
+        result.setdefault("warning", None)
+        # Keep the labels of the question, e.g. the expected answer
+        for key, value in question.items():
+            result.setdefault(key, value)
+        return result
+
+    def write(self, result):
+        """Appends a result to the output and makes it durable."""
+        self.output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.output_file.flush()
+        os.fsync(self.output_file.fileno())
+        self.results.append(result)
+
+    async def worker(self, questions):
+        """Answers queued questions until the queue is empty."""
+        while True:
+            try:
+                question = questions.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            result = await self.answer(question)
+            self.write(result)
+            status = "failed" if result["error"] else f"{result['latency_ms']:.0f} ms"
+            if result["warning"]:
+                status += f"; {result['warning']}"
+            print(f"[{len(self.results)}] {result['id']}: {status}")
+
+    async def run(self, questions):
+        """
+        Answers the questions.
+
+        Args:
+            questions (list): The questions to be answered.
+
+        Returns:
+            list: The results of this run.
+        """
+        queue = asyncio.Queue()
+        for question in questions:
+            queue.put_nowait(question)
+        # Questions asked meanwhile, e.g. in the server, go first
+        with request_lane("bulk"):
+            await asyncio.gather(
+                *(self.worker(queue) for _ in range(max(1, self.concurrency)))
+            )
+        return self.results
+
+
+def summarize(results, skipped):
+    """
+    Summarizes the results of a run.
+
+    Args:
+        results (list): The results of this run.
+        skipped (int): The number of questions answered by an earlier run.
+
+    Returns:
+        str: The counts, total cost and latencies.
+    """
+    failed = sum(1 for result in results if result["error"])
+    latencies = sorted(result["latency_ms"] for result in results if not result["error"])
+    line = (
+        f"Answered {len(results) - failed} questions, {failed} failed, "
+        f"{skipped} already answered; "
+        f"cost ${sum(r['cost'] for r in results if r['cost'] is not None):.4f}"
+    )
+    unpriced = sum(1 for result in results if result["cost"] is None)
+    if unpriced:
+        line += f" (+{unpriced} answers of unknown cost)"
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        line += (
+            f", latency mean {sum(latencies) / len(latencies):.0f} ms"
+            f" / p95 {p95:.0f} ms"
+        )
+    return line
+
+
+def main(argv=None):
+    """
+    Answers a JSONL file of questions, resuming from the output file.
+    """
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions.")
+    parser.add_argument("questions", help="The JSONL file of questions.")
+    parser.add_argument("output", help="The JSONL file the answers are appended to.")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Questions answered at once."
+    )
+    parser.add_argument(
+        "--mode",
+        default="rag",
+        choices=["rag", "pure", "both"],
+        help="The mode of questions without their own.",
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore the answers of earlier runs."
+    )
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.questions)
+    answered = set() if args.restart else load_checkpoint(args.output)
+    pending = [question for question in questions if str(question["id"]) not in answered]
+    skipped = len(questions) - len(pending)
+    if skipped:
+        print(f"Resuming: {skipped} of {len(questions)} questions already answered.")
+    if not pending:
+        return 0
+
+    llm = LLM()
+    # Every question is sent to the model, so the run measures the current
+    # prompt and corpus rather than answers cached by earlier questions
+    llm.answer_cache = None
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, "w" if args.restart else "a", encoding="utf-8") as file:
+        answerer = BatchAnswerer(
+            llm, file, args.concurrency, ANSWER_MODES[args.mode]
+        )
+        try:
+            asyncio.run(answerer.run(pending))
+        except KeyboardInterrupt:
+            print("Interrupted; rerun the same command to resume.")
+        print(summarize(answerer.results, skipped))
+        print(f"Chat requests: {llm.schedulers['chat'].stats.as_dict()['bulk']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
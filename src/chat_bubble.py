@@ -4,7 +4,7 @@ This module provides a chat bubble widget for displaying text messages.
 """
 from PyQt5.QtWidgets import QLabel, QWidget, QVBoxLayout, QSizePolicy
 from PyQt5.QtGui import QFont
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 
 
 class ChatBubble(QWidget):
@@ -12,9 +12,18 @@ class ChatBubble(QWidget):
     Represents a chat bubble widget for displaying text messages.
     """
 
+    # Emitted after streamed text has been painted into the label
+    textFlushed = pyqtSignal()
+
+    # Minimum interval between repaints of a streaming bubble
+    REPAINT_INTERVAL_MS = 50
+
     def __init__(self, text, parent=None):
         super(ChatBubble, self).__init__(parent)
         self.text = text
+        self.repaintTimer = QTimer(self)
+        self.repaintTimer.setSingleShot(True)
+        self.repaintTimer.timeout.connect(self.flushText)
 
         self.initUI()
 
@@ -26,7 +35,7 @@ class ChatBubble(QWidget):
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
 
-        label = QLabel(self.text)
+        self.label = label = QLabel(self.text)
         label.setTextInteractionFlags(Qt.TextSelectableByMouse)
         label.setWordWrap(True)
         label.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
@@ -50,3 +59,25 @@ class ChatBubble(QWidget):
             "}"
         )
         self.adjustSize()  # Adjust the size of the chat bubble to fit the contents
+
+    def appendText(self, text):
+        """
+        Appends streamed text to the bubble, repainting at most once per
+        REPAINT_INTERVAL_MS however fast the text arrives.
+
+        Args:
+            text (str): The text to be appended.
+        """
+        self.text += text
+        if not self.repaintTimer.isActive():
+            self.repaintTimer.start(self.REPAINT_INTERVAL_MS)
+
+    def flushText(self):
+        """
+        Paints all appended text into the label immediately.
+        """
+        self.repaintTimer.stop()
+        if self.label.text() != self.text:
+            self.label.setText(self.text)
+            self.adjustSize()
+            self.textFlushed.emit()
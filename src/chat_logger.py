@@ -1,54 +1,156 @@
 # pylint: disable=E0611,W0611,C0103,C0303,R0903
 """
 This module provides functinalities for logging.
+
+Chat logs are append-only JSONL files with one event per line, so logging a
+message costs the same whether the log holds 10 or 100,000 entries. A small
+metadata file next to the log keeps the running totals, and the Markdown
+view of a log is rendered on demand:
+
+    python -m src.chat_logger log/chatlog_20240214120000.jsonl
 """
 import datetime
+import json
+import math
 import os
-from src.config import load_config
+import queue
+import sys
+import threading
+import time
+from src.config import config_store
+
+# The speaker prefixes of the Markdown view, by chat side
+SIDE_PREFIXES = {
+    "left": "DST-GPT: ",
+    "left-rag": "DST-GPT: ",
+    "left-pure": "OpenAI GPT: ",
+}
+USER_PREFIX = "User:"
+META_SUFFIX = ".meta.json"
+
+# Stops the writer thread once the events before it are written
+_CLOSE = object()
+
+
+def _now():
+    """Returns the current local time as text."""
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _number(value):
+    """Returns a token count or cost as a number, or None if it is not one."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value if math.isfinite(value) else None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
 
 
 class ChatLogger:
     """
     This class provides functionalities for logging chat messages.
+
+    Logging a message only puts an event into a bounded queue, so the GUI
+    thread never waits on the filesystem. A writer thread appends the events
+    to a buffered file in batches, flushing when a batch is full or
+    `flush_interval` seconds have passed, and fsyncs the log and updates the
+    metadata file at most every `fsync_interval` seconds. When the writer
+    falls `queue_size` events behind, logging blocks instead of losing events.
+
+    Args:
+        log_filepath (str): The path of the JSONL log file.
+        fsync_interval (float): The maximum number of seconds between fsyncs.
+        flush_interval (float): The maximum number of seconds an event waits
+            in the writer before it is flushed to the file.
+        batch_size (int): The maximum number of events written per flush.
+        queue_size (int): The maximum number of events waiting for the writer.
     """
 
-    def __init__(self, log_filepath):
-        self.config = load_config()
+    def __init__(
+        self,
+        log_filepath,
+        fsync_interval=None,
+        flush_interval=None,
+        batch_size=None,
+        queue_size=None,
+    ):
         self.log_filepath = log_filepath
+        self.meta_filepath = log_filepath + META_SUFFIX
+        self.fsync_interval = (
+            fsync_interval
+            if fsync_interval is not None
+            else config_store.get_float("LOG_FSYNC_INTERVAL", 5)
+        )
+        self.flush_interval = (
+            flush_interval
+            if flush_interval is not None
+            else config_store.get_float("LOG_FLUSH_INTERVAL", 0.5)
+        )
+        self.batch_size = batch_size or config_store.get_int("LOG_BATCH_SIZE", 256)
         self.log_meta = {
-            "start_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "start_time": _now(),
             "message_counts": 0,
             # "base_model": config.get("BASE_MODEL"),
-            "knowledge_sources": self.config.get("KNOWLEDGE_SOURCES", []),
+            "knowledge_sources": config_store.get_list("KNOWLEDGE_SOURCES"),
             "chat_tokens": 0,
             "cost": 0,
         }
+        self.file = None
+        self.last_sync = time.monotonic()
+        self.events = queue.Queue(
+            maxsize=queue_size or config_store.get_int("LOG_QUEUE_SIZE", 10000)
+        )
+        self.writer = None
         self.start_log_chat()
 
     def start_log_chat(self):
         """
-        Creates the log directory if it does not exist.
+        Creates the log directory if it does not exist, opens the log and
+        starts the writer thread.
         """
         check_log_directory = os.path.dirname(self.log_filepath)
-        if not os.path.isdir(check_log_directory):
+        if check_log_directory and not os.path.isdir(check_log_directory):
             os.makedirs(check_log_directory)
+        self.file = open(  # pylint: disable=R1732
+            self.log_filepath, "a", encoding="utf-8", buffering=1 << 16
+        )
         self.write_initial_meta()
+        self.writer = threading.Thread(
+            target=self.run_writer, name="chat-log-writer", daemon=True
+        )
+        self.writer.start()
 
     def write_initial_meta(self):
         """
-        Writes the initial metadata to the log file.
+        Writes the session metadata as the first event of the log.
         """
-        with open(self.log_filepath, "w", encoding="utf-8") as file:
-            self.write_meta_info(file)
-            file.write("## Chat Log\n")
+        self.write_events([dict(self.log_meta, type="meta")])
+        self.sync()
 
-    def write_meta_info(self, file):
+    def write_meta_info(self):
         """
-        Writes the initial metadata to the log file.
+        Writes the running totals to the metadata file atomically.
         """
-        for key, value in self.log_meta.items():
-            value_str = ", ".join(value) if isinstance(value, list) else str(value)
-            file.write(f"- {key.replace('_', ' ').title()}: {value_str}\n")
+        temp_filepath = self.meta_filepath + ".tmp"
+        with open(temp_filepath, "w", encoding="utf-8") as file:
+            json.dump(self.log_meta, file, ensure_ascii=False, indent=4)
+        os.replace(temp_filepath, self.meta_filepath)
+
+    def write_events(self, events):
+        """
+        Appends events to the log and flushes it.
+
+        Args:
+            events (list): The events to be appended.
+        """
+        self.file.write(
+            "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+        )
+        self.file.flush()
 
     def add_chat_to_log(self, message, side, chat_tokens, cost):
         """
@@ -58,40 +160,174 @@ class ChatLogger:
             message (str): The message to be added to the log.
             side (str): The side of the chat (e.g., 'left' or 'right').
             chat_tokens (int): The number of chat tokens used.
-            cost (float): The cost associated with the chat message.
+            cost (float): The cost associated with the chat message, or None
+            if it is unknown. Other values that are not numbers are logged
+            as None too, so they never reach the running totals.
         """
         if message == "Thinking...":
             return
 
-        # 更新元信息
-        self.log_meta["message_counts"] += 1
-        self.log_meta["chat_tokens"] += chat_tokens
-        self.log_meta["cost"] += cost
-        self.log_meta["end_time"] = datetime.datetime.now().strftime(
-            "%Y-%m-%d %H:%M:%S"
+        # 追加新的聊天消息，由写入线程写入文件
+        self.events.put(
+            {
+                "type": "message",
+                "time": _now(),
+                "side": str(side),
+                "text": str(message),
+                "tokens": int(_number(chat_tokens) or 0),
+                "cost": _number(cost),
+            }
         )
 
-        # 读取文件内容
-        with open(self.log_filepath, "r+", encoding="utf-8") as file:
-            content = file.readlines()
-
-        # 查找聊天记录开始的位置
-        chat_log_index = content.index("## Chat Log\n") + 1
-
-        # 重新写入元信息和聊天记录
-        with open(self.log_filepath, "w", encoding="utf-8") as file:
-            self.write_meta_info(file)
-            file.write("## Chat Log\n")
-            for line in content[chat_log_index:]:
-                file.write(line)
-
-            # 追加新的聊天消息
-            if side == "left":
-                prefix = "DST-GPT: "
-            elif side == "left-pure":
-                prefix = "OpenAI GPT: "
-            elif side == "left-rag":
-                prefix = "DST-GPT: "
-            else:
-                prefix = "User:"
-            file.write(prefix + message + "\n")
+    def run_writer(self):
+        """
+        Writes queued events in batches until the log is closed.
+        """
+        closing = False
+        while not closing:
+            batch = [self.events.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not _CLOSE and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.events.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is _CLOSE:
+                batch.pop()
+                closing = True
+
+            try:
+                # 更新元信息
+                for event in batch:
+                    self.log_meta["message_counts"] += 1
+                    self.log_meta["chat_tokens"] += event["tokens"]
+                    if event["cost"] is not None:
+                        self.log_meta["cost"] += event["cost"]
+                    self.log_meta["end_time"] = event["time"]
+                if batch:
+                    self.write_events(batch)
+                if closing or time.monotonic() - self.last_sync >= self.fsync_interval:
+                    self.sync()
+            # The writer must outlive a bad batch, or logging would block once
+            # the queue fills up
+            except Exception as e:  # pylint: disable=W0703
+                print(f"Failed to write the chat log: {e}")
+            finally:
+                for _ in range(len(batch) + closing):
+                    self.events.task_done()
+
+    def flush(self):
+        """
+        Waits until all queued events are written to the file.
+        """
+        self.events.join()
+
+    def sync(self):
+        """
+        Forces the log to disk and updates the metadata file.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.write_meta_info()
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        """
+        Drains the queue, syncs and closes the log.
+        """
+        if self.writer is not None and self.writer.is_alive():
+            self.events.put(_CLOSE)
+            self.writer.join()
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+
+    def export_markdown(self, output_filepath=None):
+        """
+        Renders the log in the Markdown view.
+
+        Args:
+            output_filepath (str): The path of the Markdown file. Default
+            is the log path with a .md extension.
+
+        Returns:
+            str: The path of the Markdown file.
+        """
+        self.flush()
+        return export_markdown(self.log_filepath, output_filepath)
+
+
+def read_events(log_filepath):
+    """
+    Reads the events of a log.
+
+    Args:
+        log_filepath (str): The path of the JSONL log file.
+
+    Yields:
+        dict: Every complete event, skipping a line cut off by a crash.
+    """
+    with open(log_filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def render_markdown(events):
+    """
+    Renders log events in the Markdown view.
+
+    Args:
+        events (iterable): The events of a log.
+
+    Returns:
+        str: The metadata list followed by the chat log.
+    """
+    log_meta = {}
+    lines = []
+    for event in events:
+        if event.get("type") == "meta":
+            log_meta = {key: value for key, value in event.items() if key != "type"}
+            log_meta.update(message_counts=0, chat_tokens=0, cost=0)
+            continue
+        log_meta["message_counts"] = log_meta.get("message_counts", 0) + 1
+        log_meta["chat_tokens"] = log_meta.get("chat_tokens", 0) + (
+            _number(event.get("tokens")) or 0
+        )
+        log_meta["cost"] = log_meta.get("cost", 0) + (_number(event.get("cost")) or 0)
+        log_meta["end_time"] = event["time"]
+        prefix = SIDE_PREFIXES.get(event["side"], USER_PREFIX)
+        lines.append(prefix + event["text"] + "\n")
+
+    header = []
+    for key, value in log_meta.items():
+        value_str = ", ".join(value) if isinstance(value, list) else str(value)
+        header.append(f"- {key.replace('_', ' ').title()}: {value_str}\n")
+    return "".join(header) + "## Chat Log\n" + "".join(lines)
+
+
+def export_markdown(log_filepath, output_filepath=None):
+    """
+    Renders a log file in the Markdown view.
+
+    Args:
+        log_filepath (str): The path of the JSONL log file.
+        output_filepath (str): The path of the Markdown file. Default is the
+        log path with a .md extension.
+
+    Returns:
+        str: The path of the Markdown file.
+    """
+    output_filepath = output_filepath or os.path.splitext(log_filepath)[0] + ".md"
+    with open(output_filepath, "w", encoding="utf-8") as file:
+        file.write(render_markdown(read_events(log_filepath)))
+    return output_filepath
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(f"Exported {export_markdown(path)}")
@@ -20,7 +20,6 @@ from PyQt5.QtCore import Qt, QTimer
 from src.config import load_config
 from src.chat_bubble import ChatBubble
 from src.chat_logger import ChatLogger
-from src.llm import LLM
 
 
 class ChatWindow(QScrollArea):
@@ -38,7 +37,7 @@ class ChatWindow(QScrollArea):
         self.avatar_user = self.config.get("AVATAR_USER")
 
         current_datetime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        self.log_filepath = f"log/chatlog_{current_datetime}.txt"
+        self.log_filepath = f"log/chatlog_{current_datetime}.jsonl"
         if self.config.get("LOG") == "enabled":
             self.chat_logger = ChatLogger(self.log_filepath)
 
@@ -118,6 +117,71 @@ class ChatWindow(QScrollArea):
         if text == "":
             return
 
+        self.createMessage(text, side)
+
+        if self.config.get("LOG") == "enabled":
+            # Add the message to the log and update
+            self.chat_logger.add_chat_to_log(text, side, tokens, cost)
+
+    def closeLog(self):
+        """
+        Syncs and closes the chat log, if logging is enabled.
+        """
+        if self.config.get("LOG") == "enabled":
+            self.chat_logger.close()
+
+    def addStreamingMessage(self, side):
+        """
+        Adds an empty message whose text is streamed in with appendToMessage().
+
+        Args:
+            side (str): The side of the chat window where the message should be displayed.
+
+        Returns:
+            ChatBubble: The bubble of the message.
+        """
+        bubble = self.createMessage("", side)
+        bubble.textFlushed.connect(self.scrollToBottom)
+        return bubble
+
+    def appendToMessage(self, bubble, text):
+        """
+        Appends streamed text to a message added by addStreamingMessage().
+
+        Args:
+            bubble (ChatBubble): The bubble of the message.
+            text (str): The text to be appended.
+        """
+        bubble.appendText(text)
+
+    def finishStreamingMessage(self, bubble, side, tokens=0, cost=0):
+        """
+        Paints the complete text of a streamed message and logs it.
+
+        Args:
+            bubble (ChatBubble): The bubble of the message.
+            side (str): The side of the chat window where the message is displayed.
+            tokens (int): Number of tokens used by the message (optional).
+            cost (float): Cost of the message (optional).
+
+        Returns:
+            None
+        """
+        bubble.flushText()
+        if self.config.get("LOG") == "enabled" and bubble.text != "":
+            self.chat_logger.add_chat_to_log(bubble.text, side, tokens, cost)
+
+    def createMessage(self, text, side):
+        """
+        Creates the bubble and avatar of a message and adds them to the chat window.
+
+        Args:
+            text (str): The text of the message.
+            side (str): The side of the chat window where the message should be displayed.
+
+        Returns:
+            ChatBubble: The bubble of the message.
+        """
         bubble = ChatBubble(text)
         hbox = QHBoxLayout()
         avatar = QLabel(self)
@@ -169,9 +233,7 @@ class ChatWindow(QScrollArea):
         # Call scrollToBottom after 100 milliseconds
         QTimer.singleShot(100, self.scrollToBottom)
 
-        if self.config.get("LOG") == "enabled":
-            # Add the message to the log and update
-            self.chat_logger.add_chat_to_log(text, side, tokens, cost)
+        return bubble
 
     def scrollToBottom(self):
         """
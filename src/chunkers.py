@@ -0,0 +1,516 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913
+"""
+This module provides structure-aware text chunkers for the supported source files.
+
+Chunk sizes are measured in model tokens. Text is cut at the natural
+boundaries of each format (Markdown headings, top-level Lua/Python
+functions, paragraphs and sentences, including CJK sentence punctuation),
+and only falls back to hard cuts for single units that exceed the budget.
+"""
+import os
+import re
+import hashlib
+from src.tokens import count_tokens
+from src.manifest import chunk_id
+
+# Splits after sentence-ending punctuation, keeping it with its sentence
+_SENTENCE_PATTERN = re.compile(r"(?<=[。！？；\n])|(?<=[.!?;]\s)")
+_PARAGRAPH_PATTERN = re.compile(r"(?<=\n\n)")
+_HEADING_PATTERN = re.compile(r"^#{1,6}\s")
+_FENCE_PATTERN = re.compile(r"^(```|~~~)")
+
+
+class ChunkRecord:
+    """
+    This class holds a chunk of a source together with where it comes from.
+
+    Args:
+        text (str): The chunk text.
+        source_path (str): The path of the source file.
+        chunk_index (int): The position of the chunk within its source file.
+        start_byte (int): The UTF-8 byte offset where the chunk starts in its document.
+        end_byte (int): The UTF-8 byte offset where the chunk ends in its document.
+        title (str): The title of the record or file the chunk belongs to.
+        extra (dict): Further metadata of the document, e.g. its URL.
+    """
+
+    def __init__(
+        self, text, source_path, chunk_index, start_byte, end_byte, title="", extra=None
+    ):
+        self.text = text
+        self.source_path = os.path.normpath(source_path) if source_path else ""
+        self.chunk_index = chunk_index
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.title = title
+        self.extra = extra or {}
+        self.id = chunk_id(self.source_path, text)
+        self.content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def metadata(self):
+        """
+        Returns the flat metadata stored with the chunk in the vector store.
+
+        Returns:
+            dict: The metadata, keeping only the extra values Chroma can index.
+        """
+        metadata = {
+            key: value
+            for key, value in self.extra.items()
+            if isinstance(value, (str, int, float, bool))
+        }
+        metadata.update(
+            source_path=self.source_path,
+            title=self.title,
+            chunk_index=self.chunk_index,
+            start_byte=self.start_byte,
+            end_byte=self.end_byte,
+            content_hash=self.content_hash,
+        )
+        return metadata
+
+
+class Chunker:
+    """
+    This class packs the structural segments of a text into chunks of at
+    most `chunk_tokens` tokens, overlapping by up to `overlap_tokens` tokens
+    of whole trailing segments.
+
+    Subclasses override `segments` to split a text at the boundaries of its
+    format, and `pieces` to split a single segment that is too large.
+
+    Args:
+        chunk_tokens (int): The maximum number of tokens per chunk.
+        overlap_tokens (int): The maximum number of tokens repeated from the
+            end of a chunk at the start of the next one.
+        model_name (str): The model whose tokenizer measures the chunks.
+    """
+
+    name = "text"
+    # Whether the chunker wants the raw markup of a file rather than plain text
+    markup = False
+
+    def __init__(self, chunk_tokens=350, overlap_tokens=35, model_name="gpt-3.5-turbo"):
+        self.chunk_tokens = max(16, chunk_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.chunk_tokens // 2))
+        self.model_name = model_name
+
+    @property
+    def signature(self):
+        """str: Identifies the chunking settings, so changes trigger a re-ingestion."""
+        return f"{self.name}:{self.chunk_tokens}:{self.overlap_tokens}"
+
+    def count(self, text):
+        """Returns the number of model tokens in a text."""
+        return count_tokens(text, self.model_name)
+
+    def segments(self, text, metadata):
+        """Splits a text into structural segments, by default its paragraphs."""
+        return _PARAGRAPH_PATTERN.split(text)
+
+    def pieces(self, segment):
+        """Splits a segment that exceeds the chunk budget, by default into sentences."""
+        return _SENTENCE_PATTERN.split(segment)
+
+    def prefix(self, metadata):
+        """Returns the text put in front of every chunk, e.g. a record title."""
+        return ""
+
+    def split(self, text, metadata=None):
+        """
+        Splits a text into chunks.
+
+        Args:
+            text (str): The text to be split.
+            metadata (dict): The metadata of the document the text belongs to.
+
+        Returns:
+            list: The text chunks.
+        """
+        return [chunk for chunk, _, _ in self.spans(text, metadata)]
+
+    def spans(self, text, metadata=None):
+        """
+        Splits a text into chunks, keeping where each chunk comes from.
+
+        Args:
+            text (str): The text to be split.
+            metadata (dict): The metadata of the document the text belongs to.
+
+        Returns:
+            list: The (chunk, start, end) tuples, where text[start:end] is the
+            part of the text the chunk covers, without any repeated prefix.
+        """
+        metadata = metadata or {}
+        prefix = self.prefix(metadata)
+        budget = self.chunk_tokens - self.count(prefix)
+        units = []
+        start = 0
+        for segment in self.segments(text, metadata):
+            end = start + len(segment)
+            tokens = self.count(segment)
+            if tokens <= budget and (not prefix or self._fits(segment, prefix)):
+                units.append((segment, tokens, start, end))
+            else:
+                units.extend(self._split_segment(segment, budget, start, prefix))
+            start = end
+        return [
+            (prefix + chunk, start, end)
+            for chunk, start, end in self._pack(units, budget, prefix=prefix)
+        ]
+
+    def records(self, text, source_path, metadata=None, first_index=0):
+        """
+        Splits a document of a source file into chunk records.
+
+        Args:
+            text (str): The text of the document.
+            source_path (str): The path of the source file.
+            metadata (dict): The metadata of the document.
+            first_index (int): The chunk index of the first chunk, for files
+                holding several documents.
+
+        Returns:
+            list: The ChunkRecord of every chunk.
+        """
+        metadata = metadata or {}
+        title = (
+            metadata.get("title")
+            or metadata.get("filename")
+            or os.path.basename(source_path or "")
+        )
+        records = []
+        # Chunk starts never decrease, so byte offsets can be accumulated
+        char_position = 0
+        byte_position = 0
+        for index, (chunk, start, end) in enumerate(self.spans(text, metadata)):
+            byte_position += len(text[char_position:start].encode("utf-8"))
+            char_position = start
+            end_byte = byte_position + len(text[start:end].encode("utf-8"))
+            records.append(
+                ChunkRecord(
+                    chunk,
+                    source_path,
+                    first_index + index,
+                    byte_position,
+                    end_byte,
+                    title,
+                    metadata,
+                )
+            )
+        return records
+
+    def _fits(self, text, prefix=""):
+        """Checks whether a text, with the prefix put in front of it, fits a chunk."""
+        return self.count(prefix + text) <= self.chunk_tokens
+
+    def _split_segment(self, segment, budget, offset, prefix=""):
+        """Splits an oversized segment into units that fit the budget."""
+        units = []
+        start = offset
+        for piece in self.pieces(segment):
+            end = start + len(piece)
+            tokens = self.count(piece)
+            if tokens <= budget and (not prefix or self._fits(piece, prefix)):
+                units.append((piece, tokens, start, end))
+            else:
+                units.extend(self._hard_split(piece, tokens, budget, start, prefix))
+            start = end
+        # Keep small pieces of one segment together, without any overlap
+        return [
+            (chunk, self.count(chunk), start, end)
+            for chunk, start, end in self._pack(units, budget, 0, False, prefix)
+        ]
+
+    def _hard_split(self, text, tokens, budget, offset, prefix=""):
+        """Cuts a text without any natural boundary into pieces that fit the budget."""
+        # Cut by characters rather than tokens, so multi-byte characters stay whole
+        size = max(1, int(len(text) * budget / max(tokens, 1) * 0.9))
+        units = []
+        i = 0
+        while i < len(text):
+            piece = text[i : i + size]
+            # The estimate misses where the tokens of the text are denser
+            while len(piece) > 1 and not self._fits(piece, prefix):
+                piece = piece[: len(piece) * 9 // 10]
+            units.append((piece, self.count(piece), offset + i, offset + i + len(piece)))
+            i += len(piece)
+        return units
+
+    def _pack(self, units, budget, overlap_tokens=None, strip=True, prefix=""):
+        """
+        Greedily packs (text, tokens, start, end) units into (chunk, start, end).
+
+        Units are added while their token counts add up to at most the
+        budget. The tokens of joined units do not always add up, e.g. where
+        a word spans two units, so every chunk is counted again once joined,
+        with its prefix, and trailing units that do not fit are moved to the
+        next chunk.
+        """
+        if overlap_tokens is None:
+            overlap_tokens = self.overlap_tokens
+        chunks = []
+        current = []
+        current_tokens = 0
+        carried = 0  # The overlap units at the start of the current chunk
+        index = 0
+        while index < len(units) or len(current) > carried:
+            if index < len(units) and (
+                not current or current_tokens + units[index][1] <= budget
+            ):
+                current.append(units[index])
+                current_tokens += units[index][1]
+                index += 1
+                continue
+            kept = self._fitting(current, strip, prefix)
+            if kept <= carried:
+                # Without the overlap, the chunk keeps at least one new unit
+                current = current[carried:]
+                kept = self._fitting(current, strip, prefix)
+            chunks.append(self._join(current[:kept], strip))
+            index -= len(current) - kept
+            # Carry whole trailing units over as overlap
+            overlap = []
+            overlap_size = 0
+            for previous in reversed(current[:kept]):
+                if overlap_size + previous[1] > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous[1]
+            if index == len(units) or overlap_size + units[index][1] > budget:
+                overlap, overlap_size = [], 0
+            current, current_tokens, carried = overlap, overlap_size, len(overlap)
+        return [chunk for chunk in chunks if chunk[0]]
+
+    def _fitting(self, units, strip=True, prefix=""):
+        """Returns how many leading units fit a chunk once joined, at least one."""
+        kept = len(units)
+        while kept > 1 and not self._fits(self._join(units[:kept], strip)[0], prefix):
+            kept -= 1
+        return kept
+
+    @staticmethod
+    def _join(units, strip=True):
+        """Joins units into a (chunk, start, end) tuple."""
+        chunk = "".join(unit[0] for unit in units)
+        return (chunk.strip() if strip else chunk), units[0][2], units[-1][3]
+
+
+class JsonRecordChunker(Chunker):
+    """
+    This class splits the text of a JSON wiki record into paragraphs and
+    sentences, and puts the record title in front of every chunk so that
+    each chunk still names the entity it is about.
+    """
+
+    name = "json"
+
+    def prefix(self, metadata):
+        title = metadata.get("title") or metadata.get("filename")
+        return f"{title}: " if title else ""
+
+    def segments(self, text, metadata):
+        return _SENTENCE_PATTERN.split(text)
+
+
+class MarkdownChunker(Chunker):
+    """
+    This class splits Markdown at its headings, so that sections are kept
+    whole where possible, and repeats the section heading in front of every
+    chunk of a section that has to be split.
+    """
+
+    name = "markdown"
+    markup = True
+
+    def segments(self, text, metadata):
+        sections = []
+        lines = []
+        in_fence = False
+        for line in text.splitlines(keepends=True):
+            if _FENCE_PATTERN.match(line):
+                in_fence = not in_fence
+            if not in_fence and _HEADING_PATTERN.match(line) and lines:
+                sections.append("".join(lines))
+                lines = []
+            lines.append(line)
+        if lines:
+            sections.append("".join(lines))
+        return sections
+
+    def _split_segment(self, segment, budget, offset, prefix=""):
+        heading = ""
+        if _HEADING_PATTERN.match(segment):
+            heading, _, segment = segment.partition("\n")
+            heading += "\n"
+        chunks = super()._split_segment(
+            segment, budget - self.count(heading), offset + len(heading), prefix + heading
+        )
+        return [
+            (heading + chunk, self.count(heading + chunk), start, end)
+            for chunk, _, start, end in chunks
+        ]
+
+    def pieces(self, segment):
+        pieces = []
+        for paragraph in _PARAGRAPH_PATTERN.split(segment):
+            if self.count(paragraph) <= self.chunk_tokens:
+                pieces.append(paragraph)
+            else:
+                pieces.extend(_SENTENCE_PATTERN.split(paragraph))
+        return pieces
+
+
+class CodeChunker(Chunker):
+    """
+    This class splits source code at its top-level definitions, keeping the
+    comments and decorators right above a definition with it, and splits
+    definitions that are too large at line boundaries.
+
+    Args:
+        boundary (str): The regular expression of a line starting a definition.
+        comment (str): The prefix of comment lines.
+        decorator (str): The prefix of decorator lines, if the language has any.
+    """
+
+    name = "code"
+
+    def __init__(self, boundary, comment, decorator=None, **kwargs):
+        super().__init__(**kwargs)
+        self.boundary = re.compile(boundary)
+        self.comment = comment
+        self.decorator = decorator
+
+    def _is_attached(self, line):
+        """Checks whether a line belongs to the definition below it."""
+        line = line.strip()
+        return line.startswith(self.comment) or bool(
+            self.decorator and line.startswith(self.decorator)
+        )
+
+    def segments(self, text, metadata):
+        segments = []
+        lines = []
+        for line in text.splitlines(keepends=True):
+            if self.boundary.match(line) and lines:
+                # Move the comments and decorators above the definition to it
+                attached = []
+                while lines and self._is_attached(lines[-1]):
+                    attached.insert(0, lines.pop())
+                if lines:
+                    segments.append("".join(lines))
+                lines = attached
+            lines.append(line)
+        if lines:
+            segments.append("".join(lines))
+        return segments
+
+    def pieces(self, segment):
+        return segment.splitlines(keepends=True)
+
+
+class LuaChunker(CodeChunker):
+    """This class splits Lua scripts at their top-level functions."""
+
+    name = "lua"
+
+    def __init__(self, **kwargs):
+        super().__init__(r"(local\s+)?function\b", "--", **kwargs)
+
+
+class PythonChunker(CodeChunker):
+    """This class splits Python modules at their top-level functions and classes."""
+
+    name = "python"
+
+    def __init__(self, **kwargs):
+        super().__init__(r"((async\s+)?def|class)\s", "#", decorator="@", **kwargs)
+
+
+class FixedSizeChunker(Chunker):
+    """
+    This class cuts text at fixed character offsets with a fixed character
+    overlap, regardless of its structure. It is kept as a baseline.
+
+    Args:
+        chunk_size (int): The number of characters per chunk.
+        overlap (int): The number of characters shared by neighbouring chunks.
+    """
+
+    name = "fixed"
+
+    def __init__(self, chunk_size=1500, overlap=100, **kwargs):
+        super().__init__(**kwargs)
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    @property
+    def signature(self):
+        return f"{self.name}:{self.chunk_size}:{self.overlap}"
+
+    def spans(self, text, metadata=None):
+        step = self.chunk_size - self.overlap
+        return [
+            (text[i : i + self.chunk_size], i, min(i + self.chunk_size, len(text)))
+            for i in range(0, len(text), step)
+        ]
+
+
+# Structure-aware chunkers by file type; other types are split as plain text
+CHUNKERS = {
+    ".json": JsonRecordChunker,
+    ".md": MarkdownChunker,
+    ".lua": LuaChunker,
+    ".py": PythonChunker,
+}
+
+
+def get_chunker(
+    file_type,
+    strategy="structure",
+    chunk_tokens=350,
+    overlap_tokens=35,
+    chunk_size=1500,
+    overlap=100,
+    model_name="gpt-3.5-turbo",
+):
+    """
+    Creates the chunker for a file type.
+
+    Args:
+        file_type (str): The extension of the source file, e.g. '.md'.
+        strategy (str): 'structure' for structure-aware, token-measured chunks,
+            or 'fixed' for fixed character offsets.
+        chunk_tokens (int): The maximum number of tokens per structure-aware chunk.
+        overlap_tokens (int): The maximum overlap of structure-aware chunks in tokens.
+        chunk_size (int): The number of characters per fixed chunk.
+        overlap (int): The number of overlapping characters of fixed chunks.
+        model_name (str): The model whose tokenizer measures the chunks.
+
+    Returns:
+        Chunker: The chunker.
+    """
+    if strategy == "fixed":
+        return FixedSizeChunker(chunk_size, overlap, model_name=model_name)
+    if strategy != "structure":
+        raise ValueError(f"Invalid chunking strategy: {strategy}!")
+    chunker_class = CHUNKERS.get(file_type, Chunker)
+    return chunker_class(
+        chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens, model_name=model_name
+    )
+
+
+def split_source(text, source="", metadata=None, **kwargs):
+    """
+    Splits the text of a source with the chunker of its file type.
+
+    Args:
+        text (str): The text to be split.
+        source (str): The path of the source, whose extension selects the chunker.
+        metadata (dict): The metadata of the document.
+        **kwargs: The settings passed to get_chunker.
+
+    Returns:
+        list: The text chunks.
+    """
+    return get_chunker(os.path.splitext(source)[1], **kwargs).split(text, metadata)
@@ -1,52 +1,350 @@
 # pylint: disable=E0611,W0611,C0103,C0303,R0903,E1101,E1102
 """
 This module provides functionality for configurations.
+
+Qt is optional: without PyQt5, e.g. for the HTTP server or the benchmarks,
+the change signals are plain Python callbacks called on the updating thread.
 """
 
+import atexit
+import contextlib
 import json
 import os
-from PyQt5.QtCore import pyqtSignal, QObject
+import threading
+
+try:
+    from PyQt5.QtCore import pyqtSignal, QObject, Qt
+except ImportError:  # The server and the benchmarks run without the GUI
+    pyqtSignal = QObject = Qt = None
 
 
-class ConfigUpdater(QObject):
+class Signal:
     """
-    This class provides functionality for updating configurations.
-    It emits a signal whenever the configuration is updated.
+    This class stands in for a Qt signal without arguments when PyQt5 is
+    not installed. Its slots are called directly, in the order connected.
     """
 
-    configChanged = pyqtSignal()
-    llm_configChanged = pyqtSignal()
+    def __init__(self):
+        self._slots = []
+        self._lock = threading.Lock()
+
+    def connect(self, slot):
+        """Connects a slot."""
+        with self._lock:
+            self._slots.append(slot)
+
+    def disconnect(self, slot):
+        """Disconnects a slot, raising TypeError if it is not connected like Qt."""
+        with self._lock:
+            if slot not in self._slots:
+                raise TypeError("disconnect() failed between signal and slot")
+            self._slots.remove(slot)
+
+    def emit(self):
+        """Calls the connected slots."""
+        with self._lock:
+            slots = list(self._slots)
+        for slot in slots:
+            slot()
+
+
+if QObject is not None:
+
+    class ConfigUpdater(QObject):
+        """
+        This class provides functionality for updating configurations.
+        It emits a signal whenever the configuration is updated.
+        """
+
+        configChanged = pyqtSignal()
+        llm_configChanged = pyqtSignal()
+
+else:
+
+    class ConfigUpdater:
+        """
+        This class provides functionality for updating configurations.
+        It emits a signal whenever the configuration is updated.
+        """
+
+        def __init__(self):
+            self.configChanged = Signal()
+            self.llm_configChanged = Signal()
+
+
+def connect_direct(signal, slot):
+    """
+    Connects a slot that is called on the emitting thread, even one without
+    a Qt event loop, where a queued slot would never run.
+
+    Args:
+        signal: A signal of configUpdater.
+        slot (callable): The slot.
+    """
+    if Qt is None:
+        signal.connect(slot)
+    else:
+        signal.connect(slot, Qt.DirectConnection)
 
 
 # Global instance of ConfigUpdater to emit signals from anywhere
 configUpdater = ConfigUpdater()
 
+# Keys whose changes require the LLM to reload its configurations
+LLM_CONFIG_KEYS = [
+    "BASE_MODEL",
+    "TEMPERATURE",
+    "VECTORSTORE_FILEPATH",
+    "VECTORSTORE_BACKEND",
+    "VECTORSTORE_HNSW_M",
+    "VECTORSTORE_HNSW_EF_CONSTRUCTION",
+    "VECTORSTORE_HNSW_EF",
+    "VECTORSTORE_MMAP_DTYPE",
+    "VECTORSTORE_MMAP_RESCORE",
+    "EMBEDDING_MODEL",
+    "EMBEDDING_DIMENSIONS",
+    "EMBEDDING_BATCH_SIZE",
+    "EMBEDDING_THREADS",
+    "RATE_LIMIT_CHAT_RPM",
+    "RATE_LIMIT_CHAT_TPM",
+    "RATE_LIMIT_EMBEDDING_RPM",
+    "RATE_LIMIT_EMBEDDING_TPM",
+    "RATE_LIMIT_MAX_RETRIES",
+    "RATE_LIMIT_BACKOFF_BASE",
+    "RATE_LIMIT_BACKOFF_MAX",
+    "PROMPT_TEMPLATE",
+    "KNOWLEDGE_SOURCES",
+    "RETRIEVER_K",
+    "RETRIEVER_SEARCH_TYPE",
+    "RETRIEVER_FETCH_K",
+    "RETRIEVER_MMR_LAMBDA",
+    "RETRIEVER_SCORE_THRESHOLD",
+    "RETRIEVER_FILTER",
+    "RETRIEVER_HYBRID",
+    "RETRIEVER_RRF_K",
+    "RETRIEVER_LEXICAL_MARGIN",
+    "CONTEXT_PACKING",
+    "CONTEXT_BUDGET_TOKENS",
+    "CONTEXT_RESERVED_TOKENS",
+    "CONTEXT_DUPLICATE_SIMILARITY",
+]
+
+CONFIG_PATH = "./config/configs.json"
+
+
+class ConfigStore:
+    """
+    This class keeps the parsed configuration in memory for the whole process.
+
+    Reads are dictionary lookups. Updates are applied in memory at once and
+    written back atomically (temporary file + rename) after `write_delay`
+    seconds, so bursts of updates cost a single write. External edits of
+    the file are picked up by watch().
+
+    Args:
+        config_path (str): The path of the JSON configuration file.
+        write_delay (float): The number of seconds writes are delayed to batch them.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, write_delay=0.2):
+        self.config_path = config_path
+        self.write_delay = write_delay
+        self._lock = threading.RLock()
+        self._dirty_keys = set()
+        self._write_timer = None
+        self._watcher = None
+        self._data = self._read()
+
+    def _read(self):
+        """Reads and parses the configuration file."""
+        try:
+            with open(self.config_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            print(
+                f"Configuration file not found at '{self.config_path}'. Returning empty configuration."
+            )
+            return {}
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON from configuration file: {e}")
+            return {}
+
+    def snapshot(self):
+        """
+        Returns a copy of the configuration.
+
+        Values are never mutated in place, so a shallow copy is safe.
+
+        Returns:
+            dict: The configuration.
+        """
+        with self._lock:
+            return dict(self._data)
+
+    def get(self, key, default=None):
+        """Returns the value of a key, or default if it is not set."""
+        return self._data.get(key, default)
+
+    def get_str(self, key, default=""):
+        """Returns the value of a key as a string."""
+        value = self._data.get(key)
+        return default if value is None else str(value)
+
+    def get_int(self, key, default=0):
+        """Returns the value of a key as an integer, or default if it is not one."""
+        try:
+            return int(self._data.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    def get_float(self, key, default=0.0):
+        """Returns the value of a key as a float, or default if it is not one."""
+        try:
+            return float(self._data.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    def get_bool(self, key, default=False):
+        """Returns the value of a key as a boolean, accepting 'enabled'/'disabled'."""
+        value = self._data.get(key)
+        if value is None:
+            return default
+        if isinstance(value, str):
+            return value.strip().lower() in ("enabled", "true", "yes", "on", "1")
+        return bool(value)
+
+    def get_list(self, key, default=None):
+        """Returns a copy of the value of a key as a list."""
+        value = self._data.get(key)
+        if not isinstance(value, list):
+            return list(default or [])
+        return list(value)
+
+    def update(self, key, value):
+        """
+        Applies an update in memory and schedules the write.
+
+        Args:
+            key (str): The key to be updated.
+            value (any): The new value, or an item to append to a list value.
+        """
+        with self._lock:
+            data = dict(self._data)
+            _apply_update(data, key, value)
+            self._data = data
+            self._dirty_keys.add(key)
+            self._schedule_write()
+
+    def _schedule_write(self):
+        """Starts the timer of a batched write, unless one is pending."""
+        if self.write_delay <= 0:
+            self.flush()
+            return
+        if self._write_timer is None:
+            self._write_timer = threading.Timer(self.write_delay, self.flush)
+            self._write_timer.daemon = True
+            self._write_timer.start()
+
+    def flush(self):
+        """
+        Writes pending updates to the file atomically.
+
+        Returns:
+            bool: Whether the file is up to date.
+        """
+        with self._lock:
+            if self._write_timer is not None:
+                self._write_timer.cancel()
+                self._write_timer = None
+            if not self._dirty_keys:
+                return True
+            temp_path = self.config_path + ".tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump(self._data, file, indent=4)
+                os.replace(temp_path, self.config_path)
+            except OSError as e:
+                print(f"Failed to write to configuration file: {e}")
+                return False
+            self._dirty_keys.clear()
+            return True
+
+    def reload(self):
+        """
+        Re-reads the file after an external edit, keeping pending updates.
+
+        Returns:
+            set: The keys whose values changed.
+        """
+        data = self._read()
+        if not data:
+            # A half-written or deleted file; keep the current settings
+            return set()
+        with self._lock:
+            for key in self._dirty_keys:
+                data[key] = self._data.get(key)
+            changed = {
+                key
+                for key in set(data) | set(self._data)
+                if data.get(key) != self._data.get(key)
+            }
+            self._data = data
+        return changed
+
+    def watch(self):
+        """
+        Watches the file for external edits and signals the changed keys.
+
+        Requires a running Qt event loop; the signals are emitted on the GUI thread.
+        """
+        # pylint: disable=C0415
+        from PyQt5.QtCore import QFileSystemWatcher
+
+        if self._watcher is not None:
+            return
+        self._watcher = QFileSystemWatcher([self.config_path], configUpdater)
+        self._watcher.fileChanged.connect(self._on_file_changed)
+
+    def _on_file_changed(self, path):
+        """Reloads the file and emits the change signals."""
+        # Replacing the file drops it from the watcher, so watch it again
+        if path not in self._watcher.files() and os.path.exists(path):
+            self._watcher.addPath(path)
+        changed = self.reload()
+        if changed:
+            _emit_config_changed(changed)
+
+
+# Global instance of ConfigStore holding the configuration of the process
+config_store = ConfigStore()
+atexit.register(config_store.flush)
+
+# Keys changed in the currently open config_transaction(), shared by all threads
+_transaction = {"depth": 0, "keys": set()}
+_transaction_lock = threading.RLock()
+
 
 def load_config():
     """
     Load the configuration from the 'configs.json' file within the 'config' directory.
 
+    The file is parsed once per process; this returns a copy of the
+    configuration held in memory.
+
     Returns:
         dict: The loaded configuration, or an empty dictionary if the file does not exist.
     """
-    config_path = "./config/configs.json"
-    try:
-        with open(config_path, "r", encoding="utf-8") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        print(
-            f"Configuration file not found at '{config_path}'. Returning empty configuration."
-        )
-        return {}
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from configuration file: {e}")
-        return {}
+    return config_store.snapshot()
 
 
 def update_config(key, value):
     """
     Update the configuration by appending the given key-value pair and save the changes to the file.
 
+    The change is applied in memory at once, and writes are batched. Inside
+    a config_transaction(), the change signals are emitted together with
+    those of the other changes when the transaction ends.
+
     Args:
         key (str): The key to be updated.
         value (any): The value to be appended to the key.
@@ -54,26 +352,59 @@ def update_config(key, value):
     Returns:
         None
     """
-    config = load_config()
+    config_store.update(key, value)
+    with _transaction_lock:
+        if _transaction["depth"] > 0:
+            _transaction["keys"].add(key)
+            return
+    _emit_config_changed([key])
+
+
+@contextlib.contextmanager
+def config_transaction():
+    """
+    Batch update_config() calls into a single write and a single change signal.
+
+    Transactions may be nested; the changes are written to the file and the
+    coalesced signals are emitted once the outermost transaction ends.
+
+    Example:
+        with config_transaction():
+            for file_path in file_paths:
+                update_config("KNOWLEDGE_SOURCES", file_path)
+    """
+    with _transaction_lock:
+        if _transaction["depth"] == 0:
+            _transaction["keys"] = set()
+        _transaction["depth"] += 1
+    try:
+        yield
+    finally:
+        with _transaction_lock:
+            _transaction["depth"] -= 1
+            outermost = _transaction["depth"] == 0
+            if outermost:
+                keys = _transaction["keys"]
+                _transaction["keys"] = set()
+        if outermost and keys:
+            config_store.flush()
+            _emit_config_changed(keys)
+
+
+def _apply_update(config, key, value):
+    """Apply a single update to the configuration dictionary."""
     if key in config:
-        if isinstance(config[key], list):
-            config[key].append(value)
+        if isinstance(config[key], list) and not isinstance(value, list):
+            # Build a new list, so that copies of the configuration stay unchanged
+            config[key] = config[key] + [value]
         else:
             config[key] = value
     else:
         config[key] = value
-    try:
-        with open("./config/configs.json", "w", encoding="utf-8") as file:
-            json.dump(config, file, indent=4)
-        # Emit the signal to indicate config change
-        configUpdater.configChanged.emit()
-        if key in [
-            "BASE_MODEL",
-            "TEMPERATURE",
-            "VECTORSTORE_FILEPATH",
-            "PROMPT_TEMPLATE",
-            "KNOWLEDGE_SOURCES",
-        ]:
-            configUpdater.llm_configChanged.emit()
-    except IOError as e:
-        print(f"Failed to write to configuration file: {e}")
+
+
+def _emit_config_changed(keys):
+    """Emit the signals that indicate a change of the given keys."""
+    configUpdater.configChanged.emit()
+    if any(key in LLM_CONFIG_KEYS for key in keys):
+        configUpdater.llm_configChanged.emit()
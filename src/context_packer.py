@@ -0,0 +1,349 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913
+"""
+This module assembles the retrieved chunks into the context of a prompt.
+
+The chunks are stuffed into `{context}` verbatim otherwise, so neighbouring
+chunks of a section repeat their overlap and their title, near-identical
+chunks of different sources are both paid for, and a large k can overflow
+the context window of the model. The packer merges adjacent or overlapping
+chunks of the same document, drops near-duplicates, orders the chunks by
+their retrieval score and keeps as many as fit the token budget.
+"""
+import re
+import threading
+from langchain_core.documents import Document
+from src.manifest import chunk_id
+from src.tokens import count_tokens, count_message_tokens, context_window
+
+# The separator create_stuff_documents_chain puts between the documents
+DOCUMENT_SEPARATOR = "\n\n"
+
+# Words, or single CJK characters, compared when looking for near-duplicates
+_TERM_PATTERN = re.compile(
+    r"[\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+"
+)
+
+# The shortest overlap of two chunks that is trusted to be the same text
+_MIN_OVERLAP_CHARS = 8
+
+
+def shingles(text, size=3):
+    """
+    Returns the overlapping term n-grams of a text.
+
+    Args:
+        text (str): The text.
+        size (int): The number of terms per n-gram.
+
+    Returns:
+        set: The n-grams, or the single terms of a text shorter than `size`.
+    """
+    terms = _TERM_PATTERN.findall(text.lower())
+    if len(terms) < size:
+        return {tuple(terms)} if terms else set()
+    return {tuple(terms[i : i + size]) for i in range(len(terms) - size + 1)}
+
+
+def containment(a, b):
+    """
+    Returns the share of the smaller n-gram set that the other one contains.
+
+    Args:
+        a (set): The n-grams of a text.
+        b (set): The n-grams of another text.
+
+    Returns:
+        float: From 0 (nothing shared) to 1 (one text is within the other).
+    """
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _shared_prefix_length(a, b):
+    """Returns the length of the title or heading that two chunks both start with."""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    prefix = a[:length]
+    # Only a whole 'Title: ' or heading line counts as a repeated prefix
+    return max(prefix.rfind(": ") + 2 if ": " in prefix else 0, prefix.rfind("\n") + 1)
+
+
+def merge_texts(first, second, overlapping=True):
+    """
+    Joins the texts of two consecutive chunks of a document.
+
+    Args:
+        first (str): The text of the earlier chunk.
+        second (str): The text of the later chunk.
+        overlapping (bool): Whether the chunks overlap in the document.
+
+    Returns:
+        str: The joined text, with the prefix and the overlap of the later
+        chunk only once.
+    """
+    body = second[_shared_prefix_length(first, second) :]
+    if overlapping and len(body) >= _MIN_OVERLAP_CHARS:
+        anchor = body[:_MIN_OVERLAP_CHARS]
+        position = first.find(anchor)
+        # The earliest match that runs to the end of the first chunk is the overlap
+        while position != -1:
+            overlap = len(first) - position
+            if overlap >= _MIN_OVERLAP_CHARS and body.startswith(first[position:]):
+                return first + body[overlap:]
+            position = first.find(anchor, position + 1)
+    # The whitespace between the chunks was stripped; keep lines apart in code and markup
+    return first + ("\n" if "\n" in first else " ") + body
+
+
+class PackerStats:
+    """
+    This class counts the context tokens of the retrieved chunks before and
+    after packing, and what the packer did to them.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retrieved_tokens = 0
+        self.packed_tokens = 0
+        self.merged = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def record(self, retrieved_tokens, packed_tokens, merged, duplicates, dropped):
+        """Records a packed context."""
+        with self._lock:
+            self.requests += 1
+            self.retrieved_tokens += retrieved_tokens
+            self.packed_tokens += packed_tokens
+            self.merged += merged
+            self.duplicates += duplicates
+            self.dropped += dropped
+
+    def as_dict(self):
+        """
+        Returns the counters.
+
+        Returns:
+            dict: The totals, and the prompt tokens saved per request compared
+            to stuffing the retrieved chunks verbatim.
+        """
+        with self._lock:
+            requests = self.requests or 1
+            return {
+                "requests": self.requests,
+                "merged_chunks": self.merged,
+                "duplicate_chunks": self.duplicates,
+                "dropped_chunks": self.dropped,
+                "packed_tokens_per_request": round(self.packed_tokens / requests, 1),
+                "saved_tokens_per_request": round(
+                    (self.retrieved_tokens - self.packed_tokens) / requests, 1
+                ),
+            }
+
+
+class ContextPacker:
+    """
+    This class packs retrieved chunks into the context of a prompt.
+
+    The budget is the context window of the model, less the tokens of the
+    prompt template, the question and the reserved answer tokens, and at
+    most `budget_tokens` if that is set.
+
+    Args:
+        model_name (str): The chat model the prompt is sent to.
+        budget_tokens (int): The most context tokens; 0 fills the context window.
+        reserved_tokens (int): The tokens kept free for the answer.
+        prompt_tokens (int): The tokens of the prompt template without context
+            and question.
+        duplicate_similarity (float): The share of shared word 3-grams from
+            which the lower-ranked of two chunks is dropped.
+        stats (PackerStats): Counts the packed contexts, if given.
+    """
+
+    def __init__(
+        self,
+        model_name="gpt-3.5-turbo",
+        budget_tokens=0,
+        reserved_tokens=1024,
+        prompt_tokens=0,
+        duplicate_similarity=0.9,
+        stats=None,
+    ):
+        self.model_name = model_name
+        self.budget_tokens = budget_tokens
+        self.reserved_tokens = reserved_tokens
+        self.prompt_tokens = prompt_tokens
+        self.duplicate_similarity = duplicate_similarity
+        self.stats = stats
+
+    def budget(self, question=""):
+        """
+        Returns the number of context tokens available for a question.
+
+        Args:
+            question (str): The question.
+
+        Returns:
+            int: The token budget of the context.
+        """
+        available = (
+            context_window(self.model_name)
+            - self.reserved_tokens
+            - self.prompt_tokens
+            - count_message_tokens(question, self.model_name)
+        )
+        if self.budget_tokens:
+            available = min(available, self.budget_tokens)
+        return max(0, available)
+
+    def count(self, text):
+        """Counts the tokens of a text with the tokenizer of the model."""
+        return count_tokens(text, self.model_name)
+
+    def merge(self, documents):
+        """
+        Merges the adjacent or overlapping chunks of the same document.
+
+        Args:
+            documents (list): The retrieved chunks.
+
+        Returns:
+            list: The documents, each with the IDs of its chunks in 'chunk_ids'
+            and the best retrieval score of its chunks in 'score'.
+        """
+        runs = {}
+        for document in documents:
+            metadata = document.metadata
+            key = (metadata.get("source_path"), metadata.get("title"))
+            runs.setdefault(key, []).append(document)
+
+        merged = []
+        for run in runs.values():
+            if "chunk_index" in run[0].metadata:
+                run.sort(key=lambda document: document.metadata["chunk_index"])
+            current = None
+            for document in run:
+                metadata = document.metadata
+                if current is not None and self._follows(current.metadata, metadata):
+                    current.page_content = merge_texts(
+                        current.page_content,
+                        document.page_content,
+                        metadata["start_byte"] < current.metadata["end_byte"],
+                    )
+                    current.metadata["chunk_index"] = metadata["chunk_index"]
+                    current.metadata["end_byte"] = metadata["end_byte"]
+                    current.metadata["chunk_ids"].append(self._chunk_id(document))
+                    current.metadata["score"] = max(
+                        current.metadata["score"], metadata.get("score", 0.0)
+                    )
+                    continue
+                current = Document(
+                    page_content=document.page_content,
+                    metadata=dict(
+                        metadata,
+                        chunk_ids=[self._chunk_id(document)],
+                        score=metadata.get("score", 0.0),
+                    ),
+                )
+                merged.append(current)
+        return merged
+
+    @staticmethod
+    def _follows(previous, metadata):
+        """Whether a chunk continues the (merged) chunk before it in a document."""
+        try:
+            return (
+                metadata["chunk_index"] == previous["chunk_index"] + 1
+                and previous["start_byte"] <= metadata["start_byte"] <= previous["end_byte"]
+            )
+        except (KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _chunk_id(document):
+        """Derives the vector store ID of a retrieved chunk."""
+        return chunk_id(document.metadata.get("source_path", ""), document.page_content)
+
+    def deduplicate(self, documents):
+        """
+        Drops the documents that are near-duplicates of a higher-ranked one.
+
+        Args:
+            documents (list): The documents, best first.
+
+        Returns:
+            list: The documents that are kept.
+        """
+        kept = []
+        kept_shingles = []
+        for document in documents:
+            document_shingles = shingles(document.page_content)
+            if any(
+                containment(document_shingles, other) >= self.duplicate_similarity
+                for other in kept_shingles
+            ):
+                continue
+            kept.append(document)
+            kept_shingles.append(document_shingles)
+        return kept
+
+    def truncate(self, text, budget):
+        """Cuts a text to at most `budget` tokens."""
+        tokens = self.count(text)
+        while text and tokens > budget:
+            text = text[: max(0, int(len(text) * budget / tokens * 0.95))].rstrip()
+            tokens = self.count(text)
+        return text
+
+    def pack(self, documents, question=""):
+        """
+        Packs retrieved chunks into a context that fits the budget.
+
+        Args:
+            documents (list): The retrieved chunks, with their retrieval score
+                in 'score' if known.
+            question (str): The question, whose tokens count against the budget.
+
+        Returns:
+            list: The documents of the context, best first.
+        """
+        retrieved_tokens = sum(self.count(document.page_content) for document in documents)
+        retrieved_tokens += self.count(DOCUMENT_SEPARATOR) * max(0, len(documents) - 1)
+
+        merged = self.merge(documents)
+        # sorted() is stable, so equally scored chunks keep their retrieval order
+        ranked = sorted(
+            merged, key=lambda document: document.metadata["score"], reverse=True
+        )
+        unique = self.deduplicate(ranked)
+
+        budget = self.budget(question)
+        separator_tokens = self.count(DOCUMENT_SEPARATOR)
+        packed = []
+        used = 0
+        for document in unique:
+            tokens = self.count(document.page_content)
+            cost = tokens + (separator_tokens if packed else 0)
+            if used + cost <= budget:
+                packed.append(document)
+                used += cost
+            elif not packed and budget > 0:
+                # Never leave the context empty because the best chunk is too long
+                document.page_content = self.truncate(document.page_content, budget)
+                packed.append(document)
+                used += self.count(document.page_content)
+
+        if self.stats is not None:
+            self.stats.record(
+                retrieved_tokens,
+                used,
+                len(documents) - len(merged),
+                len(merged) - len(unique),
+                len(unique) - len(packed),
+            )
+        return packed
@@ -0,0 +1,217 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides a persistent cache for text embeddings.
+"""
+import os
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+from langchain_core.embeddings import Embeddings
+
+
+def text_hash(text):
+    """Returns the SHA-256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    This class stores embedding vectors on disk in SQLite, keyed by
+    (model, sha256(text)), and evicts the least recently used entries
+    once it holds more than `max_entries` vectors.
+
+    Args:
+        cache_filepath (str): The path of the SQLite file.
+        max_entries (int): The maximum number of cached vectors.
+    """
+
+    def __init__(self, cache_filepath, max_entries=200000):
+        self.cache_filepath = cache_filepath
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(cache_filepath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, "
+            "text_hash TEXT NOT NULL, "
+            "vector BLOB NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._connection.commit()
+        self._entries = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, model, texts):
+        """
+        Looks up the vectors of the given texts.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (list): The texts to be looked up.
+
+        Returns:
+            list: The cached vector of each text, or None where it is not cached.
+        """
+        keys = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's limit on the number of host parameters
+            for i in range(0, len(keys), 500):
+                key_subset = keys[i : i + 500]
+                rows = self._connection.execute(
+                    "SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({', '.join('?' * len(key_subset))})",
+                    [model, *key_subset],
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, key) for key in found],
+                )
+                self._connection.commit()
+            vectors = [
+                array.array("f", found[key]).tolist() if key in found else None
+                for key in keys
+            ]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        """
+        Stores the vectors of the given texts, evicting old entries if needed.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (list): The embedded texts.
+            vectors (list): The embedding vectors of the texts.
+        """
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array.array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._entries += self._connection.total_changes - before
+            if self._entries > self.max_entries:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """Deletes the least recently used entries down to 90% of max_entries."""
+        excess = self._entries - int(self.max_entries * 0.9)
+        cursor = self._connection.execute(
+            "DELETE FROM embeddings WHERE (model, text_hash) IN ("
+            "SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._entries -= cursor.rowcount
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: The number of hits, misses and entries, and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": self._entries,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        """Closes the SQLite connection."""
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    This class wraps an embedding function so that documents and queries
+    are only sent to it when their vectors are not in the cache yet.
+
+    Args:
+        embeddings (Embeddings): The underlying embedding function.
+        cache (EmbeddingCache): The cache of embedding vectors.
+        model_name (str): The name of the embedding model, which scopes the cache.
+    """
+
+    def __init__(self, embeddings, cache, model_name):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def _missing(self, texts):
+        """Returns the cached vectors and the unique texts that are not cached."""
+        vectors = self.cache.get_many(self.model_name, texts)
+        missing = list(
+            dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None)
+        )
+        return vectors, missing
+
+    def _merge(self, texts, vectors, missing, missing_vectors):
+        """Stores the new vectors and fills them into the result."""
+        self.cache.put_many(self.model_name, missing, missing_vectors)
+        new_vectors = dict(zip(missing, missing_vectors))
+        return [
+            vector if vector is not None else new_vectors[text]
+            for text, vector in zip(texts, vectors)
+        ]
+
+    def embed_documents(self, texts):
+        """Embed search docs, using cached vectors where available."""
+        vectors, missing = self._missing(texts)
+        if not missing:
+            return vectors
+        missing_vectors = self.embeddings.embed_documents(missing)
+        return self._merge(texts, vectors, missing, missing_vectors)
+
+    def embed_query(self, text):
+        """Embed query text, using the cached vector if available."""
+        vector = self.cache.get_many(self.model_name, [text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model_name, [text], [vector])
+        return vector
+
+    async def aembed_documents(self, texts):
+        """Asynchronous embed search docs, using cached vectors where available."""
+        vectors, missing = self._missing(texts)
+        if not missing:
+            return vectors
+        missing_vectors = await self.embeddings.aembed_documents(missing)
+        return self._merge(texts, vectors, missing, missing_vectors)
+
+    async def aembed_query(self, text):
+        """Asynchronous embed query text, using the cached vector if available."""
+        vector = self.cache.get_many(self.model_name, [text])[0]
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self.cache.put_many(self.model_name, [text], [vector])
+        return vector
@@ -0,0 +1,296 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,C0415
+"""
+This module provides the embedding models a vector store can be built with.
+
+EMBEDDING_MODEL selects the model: an OpenAI model, whose newer versions
+can return shortened vectors (EMBEDDING_DIMENSIONS), or a local sentence
+embedding model that runs on the CPU with ONNX Runtime, so ingesting and
+querying cost no network round-trip and no fees.
+
+Vectors of different models are not comparable, so every store records
+the model and the dimension it was built with in `embeddings.json`, and a
+store is refused when the configured model does not match it.
+"""
+import os
+import json
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from src.scheduler import schedule_clients
+
+EMBEDDINGS_FILENAME = "embeddings.json"
+
+# The model every store was built with before the model became configurable
+LEGACY_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+EMBEDDING_MODELS = {
+    "text-embedding-ada-002": {
+        "provider": "openai",
+        "dimension": 1536,
+        "cost_per_1k_tokens": 0.0001,
+    },
+    "text-embedding-3-small": {
+        "provider": "openai",
+        "dimension": 1536,
+        "cost_per_1k_tokens": 0.00002,
+        "shortenable": True,
+    },
+    "text-embedding-3-large": {
+        "provider": "openai",
+        "dimension": 3072,
+        "cost_per_1k_tokens": 0.00013,
+        "shortenable": True,
+    },
+    "all-MiniLM-L6-v2": {
+        "provider": "local",
+        "dimension": 384,
+        "cost_per_1k_tokens": 0.0,
+    },
+}
+
+
+class EmbeddingMismatchError(ValueError):
+    """Raised when a vector store was built with another embedding model."""
+
+
+def embedding_signature(model_name, dimensions=0):
+    """
+    Returns what a store built with an embedding model records.
+
+    Args:
+        model_name (str): The name of the embedding model.
+        dimensions (int): The shortened dimension, or 0 for the full one.
+
+    Returns:
+        dict: The 'model' and the 'dimension' of its vectors.
+    """
+    if model_name not in EMBEDDING_MODELS:
+        raise ValueError(
+            f"Invalid embedding model: {model_name}! "
+            f"Choose one of {', '.join(EMBEDDING_MODELS)}."
+        )
+    info = EMBEDDING_MODELS[model_name]
+    if dimensions and dimensions != info["dimension"]:
+        if not info.get("shortenable") or not 0 < dimensions < info["dimension"]:
+            raise ValueError(
+                f"The embedding model {model_name} cannot return {dimensions} dimensions!"
+            )
+        return {"model": model_name, "dimension": dimensions}
+    return {"model": model_name, "dimension": info["dimension"]}
+
+
+def embedding_key(model_name, dimensions=0):
+    """Returns the name that scopes the cached vectors of a model and dimension."""
+    signature = embedding_signature(model_name, dimensions)
+    if signature["dimension"] == EMBEDDING_MODELS[model_name]["dimension"]:
+        return model_name
+    return f"{model_name}@{signature['dimension']}"
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    This class embeds texts on the CPU with the ONNX export of a sentence
+    embedding model, mean-pooling and L2-normalizing its token states.
+
+    The texts are tokenized in parallel, sorted by length and run in
+    batches padded only to their longest text, and ONNX Runtime spreads
+    each batch over `threads` cores. The model is downloaded to the Chroma
+    model cache on first use.
+
+    Args:
+        model_name (str): The name of the model.
+        batch_size (int): The number of texts run at once.
+        threads (int): The number of inference threads; 0 uses every core.
+        max_tokens (int): The tokens per text beyond which it is truncated.
+    """
+
+    def __init__(self, model_name="all-MiniLM-L6-v2", batch_size=32, threads=0, max_tokens=256):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.max_tokens = max_tokens
+        self._tokenizer = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Loads the tokenizer and the model, downloading them if needed."""
+        with self._lock:
+            if self._session is not None:
+                return
+            import onnxruntime
+            from tokenizers import Tokenizer
+            from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+            # pylint: disable=W0212
+            model = ONNXMiniLM_L6_V2()
+            model._download_model_if_not_exists()
+            folder = os.path.join(model.DOWNLOAD_PATH, model.EXTRACTED_FOLDER_NAME)
+            tokenizer = Tokenizer.from_file(os.path.join(folder, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=self.max_tokens)
+            tokenizer.no_padding()
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.threads
+            self._session = onnxruntime.InferenceSession(
+                os.path.join(folder, "model.onnx"),
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            )
+            self._tokenizer = tokenizer
+
+    def _run(self, encodings):
+        """Embeds a batch of tokenized texts."""
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            input_ids[row, : len(encoding.ids)] = encoding.ids
+            attention_mask[row, : len(encoding.ids)] = 1
+        states = self._session.run(
+            None,
+            {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            },
+        )[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        vectors = (states * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed_documents(self, texts):
+        """Embed search docs."""
+        if not texts:
+            return []
+        self._load()
+        encodings = self._tokenizer.encode_batch(list(texts))
+        # Texts of similar length share a batch, so little of it is padding
+        order = sorted(range(len(texts)), key=lambda i: len(encodings[i].ids))
+        dimension = EMBEDDING_MODELS[self.model_name]["dimension"]
+        vectors = np.empty((len(texts), dimension), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start : start + self.batch_size]
+            vectors[rows] = self._run([encodings[i] for i in rows])
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        """Embed query text."""
+        return self.embed_documents([text])[0]
+
+
+def get_embeddings(
+    model_name,
+    dimensions=0,
+    api_key=None,
+    base_url=None,
+    batch_size=0,
+    threads=0,
+    scheduler=None,
+    clients=None,
+):
+    """
+    Creates the embedding function of a model.
+
+    Args:
+        model_name (str): The name of the embedding model.
+        dimensions (int): The shortened dimension, or 0 for the full one.
+        api_key (str): The OpenAI API key.
+        base_url (str): The OpenAI base URL, if not the default one.
+        batch_size (int): The texts per request or batch; 0 is the
+            provider's default.
+        threads (int): The inference threads of a local model; 0 uses every core.
+        scheduler (RequestScheduler): The scheduler the requests of an
+            OpenAI model go through, which then also retries them.
+        clients (tuple): The synchronous and asynchronous OpenAI clients
+            an OpenAI model sends its requests with. Default creates new ones.
+
+    Returns:
+        Embeddings: The embedding function.
+    """
+    signature = embedding_signature(model_name, dimensions)
+    if EMBEDDING_MODELS[model_name]["provider"] == "local":
+        return LocalEmbeddings(model_name, batch_size=batch_size or 32, threads=threads)
+
+    from langchain_openai import OpenAIEmbeddings
+
+    model_kwargs = {}
+    if signature["dimension"] != EMBEDDING_MODELS[model_name]["dimension"]:
+        model_kwargs["dimensions"] = signature["dimension"]
+    resources = {}
+    if clients:
+        resources = {"client": clients[0].embeddings, "async_client": clients[1].embeddings}
+    embeddings = OpenAIEmbeddings(
+        model=model_name,
+        openai_api_key=api_key,
+        base_url=base_url,
+        chunk_size=batch_size or 1000,
+        model_kwargs=model_kwargs,
+        max_retries=2 if scheduler is None else 0,
+        **resources,
+    )
+    if scheduler is not None:
+        schedule_clients(embeddings, scheduler)
+    return embeddings
+
+
+def stored_dimension(collection):
+    """Returns the dimension of the vectors in a collection, or None if it is empty."""
+    stored = collection.get(limit=1, include=["embeddings"])
+    if not stored["ids"]:
+        return None
+    return len(stored["embeddings"][0])
+
+
+def read_signature(vectorstore_directory):
+    """Reads the embedding model a store records, or None."""
+    filepath = os.path.join(vectorstore_directory, EMBEDDINGS_FILENAME)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_signature(vectorstore_directory, signature):
+    """Records the embedding model of a store."""
+    with open(
+        os.path.join(vectorstore_directory, EMBEDDINGS_FILENAME), "w", encoding="utf-8"
+    ) as file:
+        json.dump(signature, file, indent=4)
+
+
+def check_signature(vectorstore_directory, collection, signature):
+    """
+    Makes sure a store was built with an embedding model.
+
+    A store that records no model yet is assumed to be built with the
+    legacy model if it holds vectors of its dimension, and an empty one
+    with the configured model; either is then recorded.
+
+    Args:
+        vectorstore_directory (str): The directory of the store.
+        collection (Collection): The collection of the store.
+        signature (dict): The configured model and dimension.
+
+    Raises:
+        EmbeddingMismatchError: If the store was built with another model.
+    """
+    recorded = read_signature(vectorstore_directory)
+    if recorded is None:
+        dimension = stored_dimension(collection)
+        if dimension is None:
+            recorded = signature
+        elif dimension == EMBEDDING_MODELS[LEGACY_EMBEDDING_MODEL]["dimension"]:
+            recorded = embedding_signature(LEGACY_EMBEDDING_MODEL)
+        else:
+            recorded = {"model": "an unknown model", "dimension": dimension}
+        if recorded["model"] in EMBEDDING_MODELS:
+            write_signature(vectorstore_directory, recorded)
+    if recorded != signature:
+        raise EmbeddingMismatchError(
+            f"The vector store in {vectorstore_directory} was built with "
+            f"{recorded['model']} ({recorded['dimension']} dimensions), but "
+            f"EMBEDDING_MODEL is {signature['model']} ({signature['dimension']} "
+            "dimensions). Switch the model back, or create a new vector store "
+            "and add the corpus again."
+        )
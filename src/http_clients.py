@@ -0,0 +1,208 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913
+"""
+This module provides the pooled HTTP clients shared by every OpenAI client
+of the process.
+
+ChatOpenAI and OpenAIEmbeddings are rebuilt whenever the model, the
+temperature or the embedding settings change. They are given OpenAI
+clients created once per API key and base URL, over one synchronous and
+one asynchronous HTTP client, so keep-alive connections, and with the
+optional `h2` package HTTP/2 streams, survive the rebuilds and requests
+skip the TCP and TLS handshakes.
+"""
+import asyncio
+import weakref
+import threading
+import httpx
+import openai
+from src.config import config_store
+
+try:
+    import h2  # HTTP/2 support of httpx
+except ImportError:
+    h2 = None
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class ConnectionStats:
+    """
+    This class counts the requests sent and the connections opened for
+    them, from the trace events of httpcore.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.http2_requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        """Records a trace event, e.g. 'connection.connect_tcp.complete'."""
+        with self._lock:
+            if event == "connection.connect_tcp.complete":
+                self.connections += 1
+            elif event == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            elif event.endswith(".send_request_headers.started"):
+                self.requests += 1
+                self.http2_requests += event.startswith("http2.")
+
+    def as_dict(self):
+        """
+        Returns the counters.
+
+        Returns:
+            dict: The requests, those sent over HTTP/2, the connections and
+            TLS handshakes, and the share of requests that reused a
+            connection.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "http2_requests": self.http2_requests,
+                "connections": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reuse_rate": round(
+                    1 - self.connections / self.requests if self.requests else 0.0, 4
+                ),
+            }
+
+
+class _LoopTransport(httpx.AsyncBaseTransport):
+    """
+    This class pools the connections of every event loop apart, since an
+    asynchronous connection cannot be used from another loop, e.g. after
+    asyncio.run() returned.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._transports = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _transport(self):
+        """Returns the transport of the running loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = httpx.AsyncHTTPTransport(**self._kwargs)
+                self._transports[loop] = transport
+        return transport
+
+    async def handle_async_request(self, request):
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self):
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+class HttpClients:
+    """
+    This class holds the pooled HTTP clients, and the OpenAI clients
+    created over them.
+
+    Args:
+        max_connections (int): The most connections open at once, per loop
+            for the asynchronous client.
+        max_keepalive_connections (int): The most idle connections kept open.
+        keepalive_expiry (float): The seconds an idle connection is kept open.
+        http2 (bool): Whether to negotiate HTTP/2, if `h2` is installed.
+    """
+
+    def __init__(
+        self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0, http2=True
+    ):
+        self.stats = ConnectionStats()
+        self.http2 = http2 and h2 is not None
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+
+        def trace(event, info):  # pylint: disable=W0613
+            self.stats.record(event)
+
+        async def atrace(event, info):  # pylint: disable=W0613
+            self.stats.record(event)
+
+        def on_request(request):
+            request.extensions["trace"] = trace
+
+        async def on_async_request(request):
+            request.extensions["trace"] = atrace
+
+        self.sync_client = httpx.Client(
+            limits=limits,
+            http2=self.http2,
+            timeout=openai.DEFAULT_TIMEOUT,
+            event_hooks={"request": [on_request]},
+        )
+        self.async_client = httpx.AsyncClient(
+            transport=_LoopTransport(limits=limits, http2=self.http2),
+            timeout=openai.DEFAULT_TIMEOUT,
+            event_hooks={"request": [on_async_request]},
+        )
+        self._openai_clients = {}
+        self._lock = threading.Lock()
+
+    def openai_clients(self, api_key, base_url=None):
+        """
+        Returns the OpenAI clients of an API key and base URL.
+
+        They leave the retries to the request scheduler.
+
+        Args:
+            api_key (str): The OpenAI API key.
+            base_url (str): The OpenAI base URL, if not the default one.
+
+        Returns:
+            tuple: The synchronous and the asynchronous OpenAI client.
+        """
+        with self._lock:
+            key = (api_key, base_url)
+            if key not in self._openai_clients:
+                self._openai_clients[key] = (
+                    openai.OpenAI(
+                        api_key=api_key,
+                        base_url=base_url,
+                        max_retries=0,
+                        http_client=self.sync_client,
+                    ),
+                    openai.AsyncOpenAI(
+                        api_key=api_key,
+                        base_url=base_url,
+                        max_retries=0,
+                        http_client=self.async_client,
+                    ),
+                )
+            return self._openai_clients[key]
+
+
+def shared_http_clients():
+    """
+    Returns the HTTP clients of the process, created from the configuration
+    on first use. Their pool settings apply until the process restarts.
+
+    Returns:
+        HttpClients: The clients.
+    """
+    global _shared  # pylint: disable=W0603
+    with _shared_lock:
+        if _shared is None:
+            _shared = HttpClients(
+                max_connections=config_store.get_int("HTTP_MAX_CONNECTIONS", 100),
+                max_keepalive_connections=config_store.get_int(
+                    "HTTP_MAX_KEEPALIVE_CONNECTIONS", 20
+                ),
+                keepalive_expiry=config_store.get_float("HTTP_KEEPALIVE_EXPIRY", 60),
+                http2=config_store.get_bool("HTTP2", True),
+            )
+        return _shared
@@ -0,0 +1,541 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0902,R0913,W0703
+"""
+This module provides a parallel, batched pipeline for ingesting corpus files
+into the vector store.
+"""
+import os
+import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.tokens import count_tokens
+from src.chunkers import get_chunker
+from src.manifest import file_hash
+
+SUPPORTED_FILE_TYPES = [".json", ".txt", ".md", ".py", ".lua"]
+
+# Marks the end of the chunk stream in the reader queue
+_DONE = object()
+
+
+def iter_source_files(source_path):
+    """
+    Yields all supported files under the given path.
+
+    Args:
+        source_path (str): A file or a folder to be walked recursively.
+
+    Yields:
+        str: The path of every supported source file.
+    """
+    if os.path.isfile(source_path):
+        if os.path.splitext(source_path)[1] in SUPPORTED_FILE_TYPES:
+            yield source_path
+        return
+    for root, _, files in os.walk(source_path):
+        for file in sorted(files):
+            if os.path.splitext(file)[1] in SUPPORTED_FILE_TYPES:
+                yield os.path.join(root, file)
+
+
+def load_documents(file_path, file_type=None, keep_markup=False):
+    """
+    Reads a source file and parses it into documents.
+
+    Args:
+        file_path (str): The path to the file.
+        file_type (str): The type of the file (e.g., .json, .txt, .md, .py, .lua).
+        Default is the extension of file_path.
+        keep_markup (bool): Whether Markdown is kept as is instead of being
+        converted to plain text, e.g. for chunking at its headings.
+
+    Returns:
+        list: A list of (text, metadata) tuples, one per document.
+    """
+    file_type = file_type or os.path.splitext(file_path)[1]
+    documents = []
+    if file_type == ".json":
+        with open(file_path, "r", encoding="utf-8") as file:
+            corpus_data = json.load(file)
+        # corpus_data is a list of dicts, each of which holds a 'text' key
+        for data in corpus_data:
+            metadata = {k: v for k, v in data.items() if k != "text"}
+            documents.append((data["text"], metadata))
+
+    elif file_type in [".txt", ".md", ".py", ".lua"]:
+        with open(file_path, "r", encoding="utf-8") as file:
+            text_content = file.read()
+        if file_type == ".md" and not keep_markup:
+            import markdown2
+            from bs4 import BeautifulSoup
+
+            text_content = BeautifulSoup(
+                markdown2.markdown(text_content), "html.parser"
+            ).get_text()
+        documents.append((text_content, {}))
+
+    else:
+        raise ValueError(f"Invalid source file type: {file_type}!")
+
+    return documents
+
+
+class IngestReport:
+    """
+    This class collects the progress and throughput figures of an ingestion
+    run. It is updated while the run is in progress, so it doubles as the
+    progress model of background ingestion jobs.
+    """
+
+    def __init__(self, files_total=0):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.files_total = files_total
+        self.sources = []
+        self.skipped = []
+        self.errors = {}
+        self.completed = []
+        self.cancelled = False
+        self.documents = 0
+        self.chunks = 0
+        self.tokens = 0
+        self.embedded = 0
+        self.written = 0
+        self.deleted = 0
+        self.embed_calls = 0
+        self._lock = threading.Lock()
+
+    def add_source(self, file_path, num_documents, num_chunks, num_tokens):
+        """Records a source file that has been read and chunked."""
+        with self._lock:
+            self.sources.append(file_path)
+            self.documents += num_documents
+            self.chunks += num_chunks
+            self.tokens += num_tokens
+
+    def add_skipped(self, file_path):
+        """Records a source file that is unchanged since it was last ingested."""
+        with self._lock:
+            self.skipped.append(file_path)
+
+    def add_error(self, file_path, error):
+        """Records a source file that failed to be read."""
+        with self._lock:
+            self.errors[file_path] = str(error)
+
+    def finish(self):
+        """Stops the clock of the run."""
+        self.end_time = time.perf_counter()
+
+    @property
+    def finished(self):
+        """bool: Whether the run has ended."""
+        return self.end_time is not None
+
+    @property
+    def files_done(self):
+        """int: The number of files that have been read, skipped or failed."""
+        return len(self.sources) + len(self.skipped) + len(self.errors)
+
+    @property
+    def elapsed(self):
+        """float: The wall time of the run in seconds."""
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def fraction(self):
+        """float: The estimated fraction of the run that is done."""
+        if self.finished:
+            return 1.0
+        read = self.files_done / self.files_total if self.files_total else 0.0
+        written = self.written / self.chunks if self.chunks else 1.0
+        return read * written
+
+    @property
+    def eta(self):
+        """float: The estimated number of seconds left, or None if unknown yet."""
+        if self.finished:
+            return 0.0
+        fraction = self.fraction
+        if fraction <= 0:
+            return None
+        return self.elapsed * (1 - fraction) / fraction
+
+    def rate(self, count):
+        """Returns count per second over the elapsed time."""
+        return count / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        """
+        Returns the report as a machine-readable dictionary.
+
+        Returns:
+            dict: The counters, elapsed time and per-second rates of the run.
+        """
+        return {
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "sources": len(self.sources),
+            "skipped": len(self.skipped),
+            "errors": len(self.errors),
+            "completed": len(self.completed),
+            "cancelled": self.cancelled,
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "embedded": self.embedded,
+            "written": self.written,
+            "deleted": self.deleted,
+            "embed_calls": self.embed_calls,
+            "elapsed_seconds": round(self.elapsed, 3),
+            "eta_seconds": round(self.eta, 1) if self.eta is not None else None,
+            "documents_per_second": round(self.rate(self.documents), 2),
+            "chunks_per_second": round(self.rate(self.chunks), 2),
+            "tokens_per_second": round(self.rate(self.tokens), 2),
+        }
+
+    def progress(self):
+        """
+        Returns a one-line, human-readable progress line.
+
+        Returns:
+            str: The progress of the run.
+        """
+        eta = self.eta
+        return (
+            f"Files {self.files_done}/{self.files_total} | "
+            f"chunks {self.chunks} | embedded {self.embedded} | "
+            f"written {self.written} | "
+            + (f"ETA {eta:.0f}s" if eta is not None else "ETA unknown")
+        )
+
+    def summary(self):
+        """
+        Returns a one-line, human-readable throughput summary.
+
+        Returns:
+            str: The summary of the run.
+        """
+        return (
+            ("Cancelled after ingesting " if self.cancelled else "Ingested ")
+            + f"{self.documents} documents / {self.chunks} chunks / "
+            f"{self.tokens} tokens from {len(self.sources)} files "
+            f"in {self.elapsed:.2f}s "
+            f"({self.rate(self.documents):.1f} docs/s, "
+            f"{self.rate(self.chunks):.1f} chunks/s, "
+            f"{self.rate(self.tokens):.0f} tokens/s), "
+            f"{self.embedded} chunks embedded, {self.deleted} stale chunks deleted"
+            + (f", {len(self.skipped)} unchanged files skipped" if self.skipped else "")
+            + (f", {len(self.errors)} files failed" if self.errors else "")
+        )
+
+
+class BulkIngestor:
+    """
+    This class ingests many source files into a vector store.
+
+    A pool of reader threads parses and chunks files into a bounded queue.
+    Chunks are grouped into large batches which are embedded concurrently,
+    with at most `max_inflight` embedding requests in flight, and the
+    embedded chunks are handed to `writer` in large batches.
+
+    With a manifest, files whose mtime and size or content hash are unchanged
+    are skipped without any API call, only chunks whose stable IDs are new
+    are embedded, and the stale chunks of changed files are deleted.
+
+    A run can be cancelled from another thread. Requests already in flight
+    are awaited and written, and only the files whose chunks were all
+    written are recorded in the manifest, so the store stays consistent.
+
+    Args:
+        embeddings: Any object providing `embed_documents(texts)`, e.g.
+            OpenAIEmbeddings or a local fake embedding function.
+        writer (callable): Called as `writer(texts, embeddings, metadatas, ids)`
+            to persist a batch of embedded chunks.
+        deleter (callable): Called as `deleter(ids)` to remove stale chunks.
+            Required when a manifest is given.
+        updater (callable): Called as `updater(ids, metadatas)` to refresh the
+            metadata of stored chunks whose position in a changed file moved.
+        manifest (SourceManifest): The manifest of already ingested files.
+        reader_workers (int): The number of file reader threads.
+        embed_batch_size (int): The number of chunks per embedding request.
+        max_inflight (int): The maximum number of concurrent embedding requests.
+        write_batch_size (int): The number of chunks per write to the store.
+        queue_size (int): The capacity of the chunk queue between readers
+            and embedders. Default is four embedding batches.
+        chunker_factory (callable): Called with a file extension, returns the
+            Chunker splitting files of that type. Default is get_chunker.
+        model_name (str): The model whose tokenizer counts tokens in the report.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        writer,
+        deleter=None,
+        updater=None,
+        manifest=None,
+        reader_workers=4,
+        embed_batch_size=256,
+        max_inflight=4,
+        write_batch_size=1024,
+        queue_size=None,
+        chunker_factory=None,
+        model_name="gpt-3.5-turbo",
+    ):
+        self.embeddings = embeddings
+        self.writer = writer
+        self.deleter = deleter
+        self.updater = updater
+        self.manifest = manifest
+        self.reader_workers = max(1, reader_workers)
+        self.embed_batch_size = max(1, embed_batch_size)
+        self.max_inflight = max(1, max_inflight)
+        self.write_batch_size = max(1, write_batch_size)
+        self.queue_size = queue_size or 4 * self.embed_batch_size
+        self.chunker_factory = chunker_factory or get_chunker
+        self.model_name = model_name
+        self.report = None
+        self._stop = threading.Event()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._read_files_done = {}
+        self._unwritten = {}
+
+    def cancel(self):
+        """Cancels the current run from any thread."""
+        self._cancelled.set()
+        self._stop.set()
+
+    def ingest(self, file_paths):
+        """
+        Runs the pipeline over the given files.
+
+        Args:
+            file_paths (iterable): The paths of the source files.
+
+        Returns:
+            IngestReport: The throughput report of the run.
+        """
+        file_paths = list(file_paths)
+        report = self.report = IngestReport(files_total=len(file_paths))
+        chunk_queue = queue.Queue(maxsize=self.queue_size)
+        self._stop.clear()
+        self._cancelled.clear()
+        self._read_files_done = {}
+        self._unwritten = {}
+
+        reader = threading.Thread(
+            target=self._read_files,
+            args=(file_paths, chunk_queue, report),
+            name="ingest-readers",
+            daemon=True,
+        )
+        reader.start()
+        try:
+            self._embed_and_write(chunk_queue, report)
+            self._commit_manifest(report)
+        finally:
+            # Unblock readers if the embedding stage stopped early
+            self._stop.set()
+            reader.join()
+            report.cancelled = self._cancelled.is_set()
+            report.finish()
+        return report
+
+    def _read_files(self, file_paths, chunk_queue, report):
+        """Reads all files with the reader pool and closes the queue."""
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.reader_workers, thread_name_prefix="ingest-reader"
+            ) as pool:
+                for file_path in file_paths:
+                    pool.submit(self._read_file, file_path, chunk_queue, report)
+        finally:
+            self._put(chunk_queue, _DONE)
+
+    def _read_file(self, file_path, chunk_queue, report):
+        """
+        Reads one file in the reader pool, whose futures are never awaited,
+        so any failure is recorded in the report here. A failed file is not
+        recorded in the manifest; the chunks it queued are still written.
+        """
+        if self._stop.is_set():
+            return
+        try:
+            self._chunk_file(file_path, chunk_queue, report)
+        except Exception as e:
+            print(f"Failed to read '{file_path}': {e}")
+            report.add_error(file_path, e)
+
+    def _chunk_file(self, file_path, chunk_queue, report):
+        """Parses and chunks one file, queueing the chunks that are not stored yet."""
+        chunker = self.chunker_factory(os.path.splitext(file_path)[1])
+        entry = None
+        content_hash = None
+        if self.manifest is not None:
+            if self.manifest.is_unchanged(file_path, chunker.signature):
+                report.add_skipped(file_path)
+                return
+            entry = self.manifest.get(file_path)
+            content_hash = file_hash(file_path)
+            if (
+                entry is not None
+                and entry["sha256"] == content_hash
+                and entry.get("chunker") == chunker.signature
+            ):
+                # Touched but not modified: refresh mtime, embed nothing
+                with self._lock:
+                    self._read_files_done[file_path] = (
+                        content_hash,
+                        entry["chunk_ids"],
+                        chunker.signature,
+                    )
+                report.add_skipped(file_path)
+                return
+        documents = load_documents(file_path, keep_markup=chunker.markup)
+
+        stored_ids = set(entry["chunk_ids"]) if entry is not None else set()
+        source_key = os.path.normpath(file_path)
+        chunk_ids = []
+        seen_ids = set()
+        moved = []
+        num_chunks = 0
+        num_tokens = 0
+        for text, metadata in documents:
+            for record in chunker.records(text, file_path, metadata, len(chunk_ids)):
+                if record.id in seen_ids:
+                    continue
+                seen_ids.add(record.id)
+                chunk_ids.append(record.id)
+                if record.id in stored_ids:
+                    # Stored already, but its position in the file may have changed
+                    moved.append(record)
+                    continue
+                with self._lock:
+                    self._unwritten[source_key] = self._unwritten.get(source_key, 0) + 1
+                if not self._put(chunk_queue, record):
+                    return
+                num_chunks += 1
+                num_tokens += count_tokens(record.text, self.model_name)
+        if moved and self.updater is not None:
+            for i in range(0, len(moved), self.write_batch_size):
+                records = moved[i : i + self.write_batch_size]
+                self.updater(
+                    [record.id for record in records],
+                    [record.metadata() for record in records],
+                )
+        with self._lock:
+            self._read_files_done[file_path] = (
+                content_hash,
+                chunk_ids,
+                chunker.signature,
+            )
+        report.add_source(file_path, len(documents), num_chunks, num_tokens)
+        print(f"Processed {num_chunks} new chunks from file: {file_path}")
+
+    def _put(self, chunk_queue, item):
+        """Puts an item into the queue unless the run has been stopped."""
+        while not self._stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, chunk_queue):
+        """Gets the next item from the queue, or _DONE once the run is cancelled."""
+        while not self._cancelled.is_set():
+            try:
+                return chunk_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _embed_and_write(self, chunk_queue, report):
+        """Consumes the queue, embedding and writing chunks in batches."""
+        batch = []
+        pending = set()
+        write_buffer = []
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_inflight, thread_name_prefix="ingest-embed"
+        ) as pool:
+            while True:
+                item = self._get(chunk_queue)
+                if item is _DONE:
+                    break
+                batch.append(item)
+                if len(batch) < self.embed_batch_size:
+                    continue
+                if len(pending) >= self.max_inflight:
+                    pending = self._collect(pending, write_buffer, report)
+                pending.add(pool.submit(self._embed, batch))
+                batch = []
+                if len(write_buffer) >= self.write_batch_size:
+                    self._flush(write_buffer, report)
+
+            if batch and not self._cancelled.is_set():
+                pending.add(pool.submit(self._embed, batch))
+            # Requests in flight are paid for, so their chunks are still written
+            while pending:
+                pending = self._collect(pending, write_buffer, report)
+        self._flush(write_buffer, report)
+
+    def _embed(self, batch):
+        """Embeds a batch of chunk records."""
+        texts = [record.text for record in batch]
+        return batch, self.embeddings.embed_documents(texts)
+
+    def _collect(self, pending, write_buffer, report):
+        """Waits for at least one embedding request and buffers its result."""
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch, vectors = future.result()
+            report.embedded += len(batch)
+            report.embed_calls += 1
+            write_buffer.extend(zip(batch, vectors))
+        return not_done
+
+    def _flush(self, write_buffer, report):
+        """Writes buffered chunks to the store in batches."""
+        while write_buffer:
+            items = write_buffer[: self.write_batch_size]
+            del write_buffer[: self.write_batch_size]
+            self.writer(
+                [record.text for record, _ in items],
+                [vector for _, vector in items],
+                [record.metadata() for record, _ in items],
+                [record.id for record, _ in items],
+            )
+            with self._lock:
+                for record, _ in items:
+                    self._unwritten[record.source_path] -= 1
+            report.written += len(items)
+            print(f"Written {report.written}/{report.chunks} chunks to the vectorstore.")
+
+    def _commit_manifest(self, report):
+        """Deletes stale chunks and records the files whose chunks were all written."""
+        with self._lock:
+            completed = {
+                file_path: update
+                for file_path, update in self._read_files_done.items()
+                if self._unwritten.get(os.path.normpath(file_path), 0) == 0
+            }
+        report.completed = list(completed)
+        if self.manifest is None:
+            return
+        stale_ids = []
+        for file_path, (content_hash, chunk_ids, signature) in completed.items():
+            entry = self.manifest.get(file_path)
+            if entry is not None:
+                current_ids = set(chunk_ids)
+                stale_ids.extend(i for i in entry["chunk_ids"] if i not in current_ids)
+            self.manifest.record(file_path, content_hash, chunk_ids, signature)
+        for i in range(0, len(stale_ids), self.write_batch_size):
+            self.deleter(stale_ids[i : i + self.write_batch_size])
+        report.deleted += len(stale_ids)
+        self.manifest.save()
@@ -0,0 +1,150 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module runs vector store ingestion as a cancellable background job.
+
+It can also be run headless to ingest a file or folder from the command line:
+
+    python -m src.ingest_job data/corpus
+"""
+import sys
+import argparse
+import threading
+
+
+class IngestJob:
+    """
+    This class runs a bulk ingestion in a background thread, so that the
+    caller, e.g. the Qt GUI thread, stays responsive and can poll the
+    progress or cancel the run at any time.
+
+    Args:
+        llm (LLM): The LLM whose vector store the files are ingested into.
+        file_paths (list): The paths of the source files.
+    """
+
+    def __init__(self, llm, file_paths):
+        self.llm = llm
+        self.file_paths = list(file_paths)
+        self.ingestor = llm.create_ingestor()
+        self.error = None
+        self._report = None
+        self._thread = None
+
+    @property
+    def report(self):
+        """IngestReport: The report of the run, or None before it has started."""
+        return self._report or self.ingestor.report
+
+    @property
+    def done(self):
+        """bool: Whether the run has ended, successfully or not."""
+        return self._thread is not None and not self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts the run in a daemon thread.
+
+        Returns:
+            IngestJob: The job itself.
+        """
+        self._thread = threading.Thread(target=self._run, name="ingest-job", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        """Runs the ingestion, keeping any error for the caller."""
+        try:
+            self._report = self.ingestor.ingest(self.file_paths)
+            print(self._report.summary())
+        except Exception as e:
+            print(f"Ingestion failed: {e}")
+            self.error = e
+
+    def cancel(self):
+        """Asks the run to stop; requests already in flight are still written."""
+        self.ingestor.cancel()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the run to end.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: True if the run has ended.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
+    def progress(self):
+        """
+        Returns the progress of the run.
+
+        Returns:
+            dict: The counters of the report, plus the fraction done.
+        """
+        report = self.report
+        if report is None:
+            return {"fraction": 0.0, "eta_seconds": None}
+        return dict(report.as_dict(), fraction=round(report.fraction, 4))
+
+    def finish(self):
+        """
+        Records the completely ingested files as knowledge sources.
+
+        Must be called from the thread that owns the config signals' receivers,
+        i.e. the GUI thread, once the job is done.
+
+        Returns:
+            IngestReport: The report of the run.
+        """
+        if self.error is not None:
+            raise self.error
+        self.llm.record_knowledge_sources(self.report)
+        return self.report
+
+
+def main(argv=None):
+    """
+    Ingests a source file or folder without the GUI, printing progress.
+    Ctrl+C cancels the run cleanly.
+    """
+    # Imported here so that importing IngestJob stays cheap
+    from src.llm import LLM
+
+    parser = argparse.ArgumentParser(description="Ingest sources into the vector store.")
+    parser.add_argument("source_path", help="The source file or folder.")
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="Seconds between progress lines."
+    )
+    args = parser.parse_args(argv)
+
+    llm = LLM()
+    try:
+        # A new vector store is seeded with the sample corpus first, as in the GUI
+        file_paths = llm.take_sample_corpus() + llm.collect_source_files(
+            args.source_path
+        )
+    except ValueError as e:
+        print(e)
+        return 1
+
+    job = IngestJob(llm, file_paths).start()
+    try:
+        while not job.wait(args.interval):
+            if job.report is not None:
+                print(job.report.progress())
+    except KeyboardInterrupt:
+        print("Cancelling, waiting for in-flight requests...")
+        job.cancel()
+        job.wait()
+    if job.error is not None:
+        return 1
+    job.finish()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
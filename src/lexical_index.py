@@ -0,0 +1,293 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides a local BM25 index of the chunks in the vector store.
+
+Keyword lookups, e.g. a character name or a Lua identifier, are often
+missed by dense retrieval but found exactly by their terms. The index is
+kept next to the Chroma store and updated with it, so hybrid retrieval can
+fuse both rankings, and confident keyword matches can be answered without
+embedding the question at all.
+"""
+import os
+import re
+import math
+import sqlite3
+import threading
+from collections import Counter
+
+LEXICAL_INDEX_FILENAME = "lexical.sqlite3"
+
+# CJK ideographs, kana and hangul are indexed as character bigrams
+_CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]+|[^\W{_CJK}]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK}]")
+# The words of an identifier, e.g. 'Get', 'Pig' and 'Token' of 'GetPigToken'
+_IDENTIFIER_PART_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how if in is it "
+    "its of on or so that the their then there these this to was what when where "
+    "which who why will with you your".split()
+)
+
+
+def tokenize(text):
+    """
+    Splits a text into index terms.
+
+    Words are lowercased and stopwords dropped. Identifiers are kept whole
+    and also split into their words, so 'GetPigToken' matches both itself
+    and 'pig token'. Runs of CJK characters, which are not separated by
+    spaces, become overlapping character bigrams.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The terms, with repetitions.
+    """
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text):
+        if _CJK_PATTERN.match(token):
+            if len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[i : i + 2] for i in range(len(token) - 1))
+            continue
+        word = token.lower()
+        if word not in STOPWORDS:
+            terms.append(word)
+        parts = [
+            part.lower()
+            for piece in token.split("_")
+            for part in _IDENTIFIER_PART_PATTERN.findall(piece)
+        ]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part not in STOPWORDS)
+    return terms
+
+
+def is_confident(hits, margin):
+    """
+    Decides whether the best keyword match answers a query on its own.
+
+    Args:
+        hits (list): The (id, score, coverage) hits of the query, best first.
+        margin (float): How many times the score of the runner-up the best
+            hit must score.
+
+    Returns:
+        bool: Whether the best hit matches every query term and clearly
+        outscores the runner-up.
+    """
+    if not hits or hits[0][2] < 1.0:
+        return False
+    return len(hits) == 1 or hits[0][1] >= margin * hits[1][1]
+
+
+class LexicalIndex:
+    """
+    This class keeps an inverted index of chunk terms in SQLite and ranks
+    chunks by their Okapi BM25 score for a query.
+
+    Args:
+        index_filepath (str): The path of the SQLite file.
+        k1 (float): The term frequency saturation of BM25.
+        b (float): The document length normalization of BM25.
+    """
+
+    def __init__(self, index_filepath, k1=1.2, b=0.75):
+        self.index_filepath = index_filepath
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(index_filepath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(index_filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id TEXT PRIMARY KEY, source_path TEXT, length INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_source_path ON chunks (source_path)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, "
+            "PRIMARY KEY (term, id)) WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._connection.commit()
+        self._count, self._total_length = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks"
+        ).fetchone()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, ids, texts, metadatas=None):
+        """
+        Indexes chunks, replacing the chunks with the same IDs.
+
+        Args:
+            ids (list): The IDs of the chunks in the vector store.
+            texts (list): The chunk texts.
+            metadatas (list): The metadata of the chunks, for their 'source_path'.
+        """
+        metadatas = metadatas or [{}] * len(ids)
+        # A chunk given twice is indexed once
+        records = {
+            chunk_id: (text, metadata)
+            for chunk_id, text, metadata in zip(ids, texts, metadatas)
+        }
+        chunks = []
+        postings = []
+        for chunk_id, (text, metadata) in records.items():
+            terms = Counter(tokenize(text))
+            chunks.append(
+                (chunk_id, (metadata or {}).get("source_path"), sum(terms.values()))
+            )
+            postings.extend((term, chunk_id, tf) for term, tf in terms.items())
+        with self._lock:
+            self._delete(records)
+            self._connection.executemany(
+                "INSERT INTO chunks (id, source_path, length) VALUES (?, ?, ?)", chunks
+            )
+            self._connection.executemany(
+                "INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)", postings
+            )
+            self._connection.commit()
+            self._count += len(chunks)
+            self._total_length += sum(length for _, _, length in chunks)
+
+    def delete(self, ids):
+        """
+        Removes chunks from the index.
+
+        Args:
+            ids (list): The IDs of the chunks.
+        """
+        with self._lock:
+            self._delete(ids)
+            self._connection.commit()
+
+    def delete_sources(self, source_paths):
+        """
+        Removes all chunks of source files from the index.
+
+        Args:
+            source_paths (list): The 'source_path' metadata of the chunks.
+        """
+        with self._lock:
+            ids = []
+            for i in range(0, len(source_paths), 500):
+                subset = source_paths[i : i + 500]
+                ids.extend(
+                    row[0]
+                    for row in self._connection.execute(
+                        "SELECT id FROM chunks WHERE source_path IN "
+                        f"({', '.join('?' * len(subset))})",
+                        subset,
+                    )
+                )
+            self._delete(ids)
+            self._connection.commit()
+
+    def _delete(self, ids):
+        """Deletes chunks without committing; the lock must be held."""
+        ids = list(ids)
+        # Stay well below SQLite's limit on the number of host parameters
+        for i in range(0, len(ids), 500):
+            subset = ids[i : i + 500]
+            placeholders = ", ".join("?" * len(subset))
+            count, length = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks "
+                f"WHERE id IN ({placeholders})",
+                subset,
+            ).fetchone()
+            self._connection.execute(
+                f"DELETE FROM postings WHERE id IN ({placeholders})", subset
+            )
+            self._connection.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", subset)
+            self._count -= count
+            self._total_length -= length
+
+    def clear(self):
+        """Removes every chunk from the index."""
+        with self._lock:
+            self._connection.execute("DELETE FROM postings")
+            self._connection.execute("DELETE FROM chunks")
+            self._connection.commit()
+            self._count = 0
+            self._total_length = 0
+
+    def rebuild(self, collection, batch_size=1000):
+        """
+        Indexes every chunk of a Chroma collection from scratch, e.g. for a
+        store built before the index existed.
+
+        Args:
+            collection (Collection): The Chroma collection.
+            batch_size (int): The number of chunks read at once.
+        """
+        self.clear()
+        total = collection.count()
+        for offset in range(0, total, batch_size):
+            batch = collection.get(
+                include=["documents", "metadatas"], limit=batch_size, offset=offset
+            )
+            self.add(batch["ids"], batch["documents"], batch["metadatas"])
+
+    def search(self, query, k=10):
+        """
+        Ranks the chunks by their BM25 score for a query.
+
+        Args:
+            query (str): The query text.
+            k (int): The number of chunks.
+
+        Returns:
+            list: The (id, score, coverage) hits, best first, where coverage
+            is the share of the query terms the chunk contains.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        placeholders = ", ".join("?" * len(terms))
+        with self._lock:
+            if not self._count:
+                return []
+            count = self._count
+            average_length = self._total_length / count or 1.0
+            # Read from the (term, id) key alone, without touching the chunks
+            frequencies = self._connection.execute(
+                "SELECT term, COUNT(*) FROM postings "
+                f"WHERE term IN ({placeholders}) GROUP BY term",
+                terms,
+            ).fetchall()
+            if not frequencies:
+                return []
+            values = ", ".join(["(?, ?)"] * len(frequencies))
+            weights = []
+            for term, df in frequencies:
+                weights += [term, math.log(1 + (count - df + 0.5) / (df + 0.5))]
+            # Scored and ranked by SQLite, so only the k best hits reach Python
+            # however many chunks contain a common term
+            rows = self._connection.execute(
+                f"WITH weights (term, idf) AS (VALUES {values}) "
+                "SELECT postings.id, "
+                "SUM(weights.idf * postings.tf * (? + 1) "
+                "/ (postings.tf + ? * (1 - ? + ? * chunks.length / ?))) AS score, "
+                "COUNT(*) AS matched "
+                "FROM weights "
+                "JOIN postings ON postings.term = weights.term "
+                "JOIN chunks ON chunks.id = postings.id "
+                "GROUP BY postings.id ORDER BY score DESC, postings.id LIMIT ?",
+                weights + [self.k1, self.k1, self.b, self.b, average_length, k],
+            ).fetchall()
+        return [
+            (chunk_id, score, matched / len(terms)) for chunk_id, score, matched in rows
+        ]
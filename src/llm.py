@@ -3,21 +3,62 @@
 This module provides functionality for llm.
 """
 import os
-import asyncio
 import json
-import markdown2
-from bs4 import BeautifulSoup
+import asyncio
+import threading
 from dotenv import load_dotenv
-from PyQt5.QtWidgets import QMessageBox
 from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.vectorstores import Chroma
 from langchain_community.callbacks import get_openai_callback, openai_info
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.documents import Document
-from src.config import load_config, update_config, configUpdater
+from src.config import (
+    load_config,
+    update_config,
+    config_transaction,
+    config_store,
+    configUpdater,
+    connect_direct,
+)
+from src.ingest import SUPPORTED_FILE_TYPES, BulkIngestor, iter_source_files
+from src.chunkers import get_chunker
+from src.manifest import MANIFEST_FILENAME, SourceManifest
+from src.embedding_cache import EmbeddingCache, CachedEmbeddings
+from src.embeddings import (
+    EmbeddingMismatchError,
+    check_signature,
+    embedding_key,
+    embedding_signature,
+    get_embeddings,
+    write_signature,
+)
+from src.answer_cache import AnswerCache
+from src.scheduler import RequestScheduler, LaneEmbeddings, schedule_clients
+from src.http_clients import shared_http_clients
+from src.tokens import count_tokens, count_message_tokens
+from src.startup import startup_timer
+from src.retriever import ConfiguredRetriever, RetrieverStats, merge_filters
+from src.context_packer import ContextPacker, PackerStats
+from src.lexical_index import LEXICAL_INDEX_FILENAME, LexicalIndex
+from src.vector_backends import (
+    LocalVectorStore,
+    migrate,
+    open_vectorstore,
+    vectorstore_filepath,
+)
+
+# The branches answering a question in each RAG mode
+RAG_BRANCHES = {"enabled": ["rag"], "disabled": ["pure"], "both": ["rag", "pure"]}
+
+# The RAG mode of each answer mode accepted by the server and batch answering
+ANSWER_MODES = {
+    "rag": "enabled",
+    "pure": "disabled",
+    "both": "both",
+    "enabled": "enabled",
+    "disabled": "disabled",
+}
 
 
 class LLM:
@@ -27,12 +68,39 @@ class LLM:
     """
 
     def __init__(self):
+        self.retriever = None
+        self.vectorstore_directory = "database"
+        self.embedding_cache = None
+        self.retriever_stats = RetrieverStats()
+        self.packer_stats = PackerStats()
+        self.vectorstore_version = 0
+        self.sample_corpus_pending = False
+        self.config_warning = None  # Why the last settings update was not fully applied
+        # Shared by every request of the process, interactive or bulk
+        self.schedulers = {"chat": RequestScheduler(), "embeddings": RequestScheduler()}
+        # Kept across re-initializations, so are their pooled connections
+        self.http_clients = shared_http_clients()
+        # Serializes settings updates, which may come from any thread
+        self.update_lock = threading.Lock()
         self.load_configs_and_envs()  # Load configurations and environment variables
-        configUpdater.llm_configChanged.connect(self.update_llm_configs)
-        self.init_llm()  # Initialize Large Language Model (LLM)
-        self.init_embeddings()  # Initialize embeddings
-        self.init_vectorstore()  # Initialize vector store
-        self.set_retrieval_chain()
+        with startup_timer.phase("init llm"):
+            self.init_schedulers()
+            self.init_answer_cache()
+            self.init_llm()  # Initialize Large Language Model (LLM)
+        with startup_timer.phase("init embeddings"):
+            self.init_embeddings()  # Initialize embeddings
+        with startup_timer.phase("init vectorstore"):
+            # Reopen the store last chosen in the GUI
+            self.init_vectorstore(self.config.get("VECTORSTORE_DIRECTORY") or "database")
+        with startup_timer.phase("retrieval chain"):
+            self.set_retrieval_chain()
+        self.applied_settings = self.current_settings()
+        # Connected last, so that updates never meet a half-built LLM. LLM is built
+        # on a worker thread without an event loop (LLMLoader, the server's
+        # executor), so a queued slot would never run: it is called directly
+        connect_direct(configUpdater.llm_configChanged, self.update_llm_configs)
+        if load_config() != self.config:
+            self.update_llm_configs()  # Apply the changes made while loading
 
     def load_configs_and_envs(self):
         """Load configuration files and environment variables."""
@@ -41,63 +109,240 @@ class LLM:
 
         self.api_key = os.getenv("OPENAI_API_KEY")
         self.base_url = os.getenv("OPENAI_BASE_URL") or None
-        self.base_model = self.config.get("BASE_MODEL")
-        self.temperature = self.config.get("TEMPERATURE")
-        self.prompt_template = self.config.get("PROMPT_TEMPLATE")
-        self.retrieval_chain = None
+        # Typed, so that values edited by hand, e.g. "4" or "true", still apply
+        config = config_store
+        self.base_model = config.get_str("BASE_MODEL", "gpt-3.5-turbo")
+        self.temperature = config.get_float("TEMPERATURE", 0.7)
+        self.prompt_template = config.get_str("PROMPT_TEMPLATE")
+        self.branch_timeout = config.get_float("BRANCH_TIMEOUT", 120)
+        self.retriever_settings = {
+            "k": config.get_int("RETRIEVER_K", 4),
+            "search_type": config.get_str("RETRIEVER_SEARCH_TYPE", "similarity"),
+            "fetch_k": config.get_int("RETRIEVER_FETCH_K", 20),
+            "lambda_mult": config.get_float("RETRIEVER_MMR_LAMBDA", 0.5),
+            # 0 keeps every chunk, however weak the match
+            "score_threshold": config.get_float("RETRIEVER_SCORE_THRESHOLD", 0) or None,
+            "where": config.get("RETRIEVER_FILTER") or None,
+            "hybrid": config.get_bool("RETRIEVER_HYBRID", True),
+            "rrf_k": config.get_int("RETRIEVER_RRF_K", 60),
+            # 0 always embeds the query, however confident the keyword match
+            "lexical_margin": config.get_float("RETRIEVER_LEXICAL_MARGIN", 2.0),
+        }
+        self.embedding_settings = {
+            "model": config.get_str("EMBEDDING_MODEL", "text-embedding-ada-002"),
+            # 0 keeps the full dimension of the model
+            "dimensions": config.get_int("EMBEDDING_DIMENSIONS", 0),
+            "batch_size": config.get_int("EMBEDDING_BATCH_SIZE", 0),
+            "threads": config.get_int("EMBEDDING_THREADS", 0),
+        }
+        self.rate_limit_settings = {
+            # 0 leaves the requests or tokens per minute unlimited
+            "chat": {
+                "requests_per_minute": config.get_int("RATE_LIMIT_CHAT_RPM", 3500),
+                "tokens_per_minute": config.get_int("RATE_LIMIT_CHAT_TPM", 60000),
+            },
+            "embeddings": {
+                "requests_per_minute": config.get_int("RATE_LIMIT_EMBEDDING_RPM", 3000),
+                "tokens_per_minute": config.get_int("RATE_LIMIT_EMBEDDING_TPM", 1000000),
+            },
+            "max_retries": config.get_int("RATE_LIMIT_MAX_RETRIES", 6),
+            "backoff_base": config.get_float("RATE_LIMIT_BACKOFF_BASE", 0.5),
+            "backoff_max": config.get_float("RATE_LIMIT_BACKOFF_MAX", 30),
+        }
+        self.vectorstore_backend = config.get_str("VECTORSTORE_BACKEND", "chroma")
+        self.index_settings = {
+            "hnsw": {
+                "M": config.get_int("VECTORSTORE_HNSW_M", 16),
+                "ef_construction": config.get_int("VECTORSTORE_HNSW_EF_CONSTRUCTION", 200),
+                "ef": config.get_int("VECTORSTORE_HNSW_EF", 64),
+            },
+            "mmap": {
+                "dtype": config.get_str("VECTORSTORE_MMAP_DTYPE", "int8"),
+                "rescore": config.get_int("VECTORSTORE_MMAP_RESCORE", 4),
+            },
+        }
+        self.context_settings = {
+            "packing": config.get_bool("CONTEXT_PACKING", True),
+            # 0 fills the context window of BASE_MODEL
+            "budget_tokens": config.get_int("CONTEXT_BUDGET_TOKENS", 0),
+            "reserved_tokens": config.get_int("CONTEXT_RESERVED_TOKENS", 1024),
+            "duplicate_similarity": config.get_float("CONTEXT_DUPLICATE_SIMILARITY", 0.9),
+        }
+
+    def init_schedulers(self):
+        """Apply the rate limits to the request schedulers, keeping their queues."""
+        settings = self.rate_limit_settings
+        for kind, scheduler in self.schedulers.items():
+            scheduler.configure(
+                max_retries=settings["max_retries"],
+                backoff_base=settings["backoff_base"],
+                backoff_max=settings["backoff_max"],
+                **settings[kind],
+            )
 
     def init_llm(self):
-        """Initialize LLM."""
+        """
+        Initialize LLM over the shared OpenAI clients, so that changing the
+        model or the temperature keeps the connections. Its requests go
+        through the chat scheduler.
+        """
+        client, async_client = self.http_clients.openai_clients(self.api_key, self.base_url)
         self.llm = ChatOpenAI(
             openai_api_key=self.api_key,
             base_url=self.base_url,
             model=self.base_model,
             temperature=self.temperature,
+            max_retries=0,  # The scheduler retries
+            client=client.chat.completions,
+            async_client=async_client.chat.completions,
         )
+        schedule_clients(self.llm, self.schedulers["chat"])
 
     def init_embeddings(self):
-        """Initialize embeddings."""
-        self.embeddings = OpenAIEmbeddings(
-            model="text-embedding-ada-002",
-            openai_api_key=self.api_key,
+        """Initialize embeddings, wrapped in the persistent embedding cache if enabled."""
+        settings = self.embedding_settings
+        self.embeddings = get_embeddings(
+            settings["model"],
+            settings["dimensions"],
+            api_key=self.api_key,
             base_url=self.base_url,
-            chunk_size=1000,
+            batch_size=settings["batch_size"],
+            threads=settings["threads"],
+            scheduler=self.schedulers["embeddings"],
+            clients=self.http_clients.openai_clients(self.api_key, self.base_url),
         )
+        if config_store.get_bool("EMBEDDING_CACHE", True):
+            if self.embedding_cache is None:
+                self.embedding_cache = EmbeddingCache(
+                    config_store.get_str(
+                        "EMBEDDING_CACHE_FILEPATH",
+                        os.path.join("cache", "embeddings.sqlite3"),
+                    ),
+                    max_entries=config_store.get_int(
+                        "EMBEDDING_CACHE_MAX_ENTRIES", 200000
+                    ),
+                )
+            self.embeddings = CachedEmbeddings(
+                self.embeddings,
+                self.embedding_cache,
+                embedding_key(settings["model"], settings["dimensions"]),
+            )
+
+    def embedding_signature(self):
+        """
+        Returns the embedding model and dimension a store must be built with.
+
+        Returns:
+            dict: The 'model' and 'dimension'.
+        """
+        return embedding_signature(
+            self.embedding_settings["model"], self.embedding_settings["dimensions"]
+        )
+
+    def init_answer_cache(self):
+        """Initialize the semantic answer cache if it is enabled."""
+        self.answer_cache = None
+        if config_store.get_bool("ANSWER_CACHE", True):
+            self.answer_cache = AnswerCache(
+                max_entries=config_store.get_int("ANSWER_CACHE_MAX_ENTRIES", 512),
+                ttl=config_store.get_float("ANSWER_CACHE_TTL", 86400),
+                similarity_threshold=config_store.get_float(
+                    "ANSWER_CACHE_SIMILARITY", 0.95
+                ),
+            )
+
+    def bump_vectorstore_version(self):
+        """Mark the vector store as changed, dropping the answers retrieved from it."""
+        self.vectorstore_version += 1
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(self.vectorstore_version)
 
     def init_vectorstore(self, vectorstore_directory="database"):
         """
         Initializes the vector store with test chunks and metadata.
 
+        A new vector store is seeded with the sample corpus later, by
+        ingesting take_sample_corpus() as a background job. The store is
+        opened with the VECTORSTORE_BACKEND; a local backend that finds
+        only a Chroma store in the directory migrates its chunks first.
+        A store built with another embedding model is refused.
+
         Args:
             vectorstore_directory (str): The directory path for the vector store.
             Default is 'database'.
 
         Returns:
             None
+
+        Raises:
+            EmbeddingMismatchError: If the store was built with another
+            embedding model than EMBEDDING_MODEL.
         """
+        self.vectorstore_directory = vectorstore_directory
+        backend = self.vectorstore_backend
+        index_settings = self.index_settings.get(backend, {})
+        store_filepath = vectorstore_filepath(vectorstore_directory, backend)
+        if backend != "chroma" and not os.path.exists(store_filepath):
+            if os.path.exists(vectorstore_filepath(vectorstore_directory, "chroma")):
+                print(f"Migrating the Chroma vector store to the '{backend}' backend...")
+                migrate(vectorstore_directory, vectorstore_directory, backend, **index_settings)
 
-        vectorstore_filepath = os.path.join(vectorstore_directory, "chroma.sqlite3")
-        if os.path.exists(vectorstore_filepath):
-            self.stored_vectors = Chroma(
-                embedding_function=self.embeddings,
-                persist_directory=vectorstore_directory,
+        self.manifest = SourceManifest(
+            os.path.join(vectorstore_directory, MANIFEST_FILENAME)
+        )
+        self.lexical_index = LexicalIndex(
+            os.path.join(vectorstore_directory, LEXICAL_INDEX_FILENAME)
+        )
+        self.bump_vectorstore_version()
+        if os.path.exists(store_filepath):
+            stored_vectors = open_vectorstore(
+                vectorstore_directory, self.embeddings, backend, **index_settings
             )
+            # pylint: disable=W0212
+            check_signature(
+                vectorstore_directory, stored_vectors._collection, self.embedding_signature()
+            )
+            self.stored_vectors = stored_vectors
         else:
+            # A new database holds none of the chunks recorded by an old manifest
+            self.manifest.clear()
+            self.manifest.save()
+            self.lexical_index.clear()
             test_chunks = ["Initialize a Chroma Database.", "Hello World!"]
 
-            self.stored_vectors = Chroma.from_texts(
-                texts=test_chunks,
-                embedding=self.embeddings,
-                persist_directory=vectorstore_directory,
+            self.stored_vectors = open_vectorstore(
+                vectorstore_directory, self.embeddings, backend, **index_settings
             )
+            write_signature(vectorstore_directory, self.embedding_signature())
+            self.stored_vectors.add_texts(test_chunks)
+            self.sample_corpus_pending = True
 
-            sample_data_filepath = self.config.get("SAMPLE_COURPUS")
-            if os.path.exists(sample_data_filepath):
-                print("Add Sample Data into Database.")
-                self.vecterize_corpus(sample_data_filepath, ".json")
+        # pylint: disable=W0212
+        if len(self.lexical_index) != self.stored_vectors._collection.count():
+            # The store was built before the keyword index, or changed without it
+            print("Building the keyword index of the vector store...")
+            self.lexical_index.rebuild(self.stored_vectors._collection)
+
+    def take_sample_corpus(self):
+        """
+        Returns the sample corpus files that a new vector store still has to be seeded with.
+
+        Returns:
+            list: The paths of the sample files, empty once they are taken.
+        """
+        sample_data_filepath = self.config.get("SAMPLE_COURPUS")
+        if not self.sample_corpus_pending or not sample_data_filepath:
+            return []
+        self.sample_corpus_pending = False
+        if not os.path.exists(sample_data_filepath):
+            return []
+        print("Add Sample Data into Database.")
+        if os.path.isdir(sample_data_filepath):
+            return list(iter_source_files(sample_data_filepath))
+        return [sample_data_filepath]
 
     def set_retrieval_chain(self):
-        """Set up the document chain for retrieval."""
+        """Set up the retriever and the document chain answering from its chunks."""
         retrieval_prompt = ChatPromptTemplate.from_template(self.prompt_template)
 
         self.documents_chain = create_stuff_documents_chain(
@@ -105,33 +350,485 @@ class LLM:
             prompt=retrieval_prompt,
         )
 
-        self.retrieval_chain = create_retrieval_chain(
-            self.stored_vectors.as_retriever(), self.documents_chain
+        self.retriever = self.get_retriever()
+
+    def get_retriever(self, where=None):
+        """
+        Returns a retriever over the vector store, configured by the RETRIEVER_* settings.
+
+        Args:
+            where (dict): A Chroma metadata filter, e.g. {"source_path": "data/x.json"},
+                applied on top of RETRIEVER_FILTER.
+
+        Returns:
+            ConfiguredRetriever: The retriever.
+        """
+        settings = dict(self.retriever_settings)
+        settings["where"] = merge_filters(settings["where"], where)
+        hybrid = settings.pop("hybrid")
+        return ConfiguredRetriever(
+            vectorstore=self.stored_vectors,
+            lexical_index=self.lexical_index if hybrid else None,
+            stats=self.retriever_stats,
+            packer=self.get_context_packer(),
+            **settings,
+        )
+
+    def get_context_packer(self):
+        """
+        Returns the packer assembling the retrieved chunks into the prompt context,
+        configured by the CONTEXT_* settings.
+
+        Returns:
+            ContextPacker: The packer, or None if CONTEXT_PACKING is disabled.
+        """
+        if not self.context_settings["packing"]:
+            return None
+        return ContextPacker(
+            model_name=self.base_model,
+            budget_tokens=self.context_settings["budget_tokens"],
+            reserved_tokens=self.context_settings["reserved_tokens"],
+            prompt_tokens=count_tokens(
+                self.format_retrieval_prompt("", []), self.base_model
+            ),
+            duplicate_similarity=self.context_settings["duplicate_similarity"],
+            stats=self.packer_stats,
         )
 
+    async def retrieve_context(self, question, where=None):
+        """
+        Retrieve the chunks of the rag branch, within BRANCH_TIMEOUT seconds.
+
+        Args:
+            question (str): The question asked by the user.
+            where (dict): A Chroma metadata filter. Default None searches all chunks.
+
+        Returns:
+            tuple: The retrieved documents, the query embedding, None if the
+            retriever answered by keywords alone, and the exception the
+            retrieval failed with or None.
+        """
+        retriever = self.get_retriever(where) if where else self.retriever
+        try:
+            # to_thread() keeps the request lane of the caller
+            documents, question_vector = await asyncio.wait_for(
+                asyncio.to_thread(retriever.retrieve, question), self.branch_timeout
+            )
+            return documents, question_vector, None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint: disable=W0703
+            return [], None, e
+
+    def search(self, query, k=4, where=None):
+        """
+        Searches the vector store for the chunks most similar to a query.
+
+        Args:
+            query (str): The query text.
+            k (int): The number of chunks.
+            where (dict): A Chroma metadata filter.
+
+        Returns:
+            list: The matching documents.
+        """
+        return self.stored_vectors.similarity_search(query, k=k, filter=where)
+
+    def current_settings(self):
+        """
+        Returns the settings that the LLM, embeddings and retrieval chain are built from.
+
+        Returns:
+            dict: The current settings.
+        """
+        return {
+            "api_key": self.api_key,
+            "base_url": self.base_url,
+            "base_model": self.base_model,
+            "temperature": self.temperature,
+            "prompt_template": self.prompt_template,
+            "retriever": json.dumps(self.retriever_settings, sort_keys=True),
+            "context": json.dumps(self.context_settings, sort_keys=True),
+            "embeddings": json.dumps(self.embedding_settings, sort_keys=True),
+            "rate_limits": json.dumps(self.rate_limit_settings, sort_keys=True),
+            "vector_backend": json.dumps(
+                [self.vectorstore_backend, self.index_settings], sort_keys=True
+            ),
+            "vectorstore": id(getattr(self, "stored_vectors", None)),
+        }
+
     def update_llm_configs(self):
-        """Update LLM configurations."""
+        """Update LLM configurations, re-initializing only the parts whose settings changed."""
+        with self.update_lock:
+            self._update_llm_configs()
+
+    def _update_llm_configs(self):
+        """Applies the changed settings; see update_llm_configs()."""
+        previous = self.applied_settings
+        embedding_settings = self.embedding_settings
+        self.config_warning = None
         self.load_configs_and_envs()  # Reload configurations and environment variables
-        self.init_llm()  # Reinitialize LLM
-        self.init_embeddings()  # Reinitialize embeddings
-        self.set_retrieval_chain()  # Reset
+        current = self.current_settings()
+        changed = {key for key, value in current.items() if previous.get(key) != value}
+
+        if "rate_limits" in changed:
+            self.init_schedulers()
+        if changed & {"api_key", "base_url", "base_model", "temperature"}:
+            self.init_llm()  # Reinitialize LLM
+        if changed & {"api_key", "base_url", "embeddings"}:
+            embeddings = self.embeddings
+            self.init_embeddings()  # Reinitialize embeddings
+            if "embeddings" in changed:
+                try:
+                    # pylint: disable=W0212
+                    check_signature(
+                        self.vectorstore_directory,
+                        self.stored_vectors._collection,
+                        self.embedding_signature(),
+                    )
+                    self.bump_vectorstore_version()  # Cached answers used the old model
+                except EmbeddingMismatchError as e:
+                    # Left to the caller to report, e.g. the main window
+                    self.config_warning = str(e)
+                    print(f"Warning: {e}")
+                    # Keep querying with, and signing the store for, the model of the store
+                    self.embeddings = embeddings
+                    self.embedding_settings = embedding_settings
+                    current["embeddings"] = previous.get("embeddings")
+            # pylint: disable=W0212
+            self.stored_vectors._embedding_function = self.embeddings
+        if "vector_backend" in changed:
+            self.init_vectorstore(self.vectorstore_directory)  # Reopen
+            current = self.current_settings()
+        if changed:
+            self.set_retrieval_chain()  # Reset
+        self.applied_settings = current
 
-    async def get_answer_async(self, question, rag_status="enabled"):
-        """Retrieve answer asynchronously for a given question."""
+    def answer_cache_scope(self, rag_status, where=None):
+        """
+        Returns the settings that a cached answer must match.
+
+        Args:
+            rag_status (str): The RAG mode, i.e. 'enabled', 'disabled' or 'both'.
+            where (dict): The metadata filter of the retrieval.
+
+        Returns:
+            tuple: The scope of the answer cache.
+        """
+        return (
+            self.base_model,
+            self.temperature,
+            self.prompt_template,
+            rag_status,
+            json.dumps(self.retriever_settings, sort_keys=True),
+            json.dumps(self.context_settings, sort_keys=True),
+            json.dumps(where, sort_keys=True) if where else None,
+        )
+
+    async def lookup_cached_answer(self, question, rag_status, where=None):
+        """
+        Look up the answer to a question in the answer cache, retrieving the
+        chunks of the rag branch on the way.
+
+        Exact matches are served before the retrieval. Similar questions are
+        then looked up by the query embedding the retrieval computed, so the
+        lookup makes no embedding call of its own; questions the retriever
+        answered by keywords alone are not embedded, and only match exactly.
+        Without a rag branch, the question is embedded for the lookup.
+
+        Args:
+            question (str): The question asked by the user.
+            rag_status (str): The RAG mode, i.e. 'enabled', 'disabled' or 'both'.
+            where (dict): The metadata filter of the retrieval.
+
+        Returns:
+            tuple: The cached answer or None, the lookup to pass to
+            store_cached_answer() once the answer has been generated, and the
+            retrieval of the rag branch as returned by retrieve_context(), or
+            None if there is none.
+        """
+        rag = "rag" in RAG_BRANCHES.get(rag_status, [])
+        if self.answer_cache is None:
+            retrieval = await self.retrieve_context(question, where) if rag else None
+            return None, None, retrieval
+        scope = self.answer_cache_scope(rag_status, where)
+        store_version = None if rag_status == "disabled" else self.vectorstore_version
+        answer = self.answer_cache.lookup_exact(scope, question, store_version)
+        if answer is not None:
+            return dict(answer), None, None
+
+        retrieval = None
+        question_vector = None
+        if rag:
+            retrieval = await self.retrieve_context(question, where)
+            question_vector = retrieval[1]
+        elif self.answer_cache.semantic:
+            question_vector = await self.embeddings.aembed_query(question)
+        answer = self.answer_cache.lookup(
+            scope, question, question_vector, store_version
+        )
+        lookup = (scope, question, question_vector, store_version)
+        return (dict(answer) if answer is not None else None), lookup, retrieval
+
+    def store_cached_answer(self, lookup, answer):
+        """
+        Store a generated answer in the answer cache.
+
+        Args:
+            lookup (tuple): The lookup returned by lookup_cached_answer().
+            answer (dict): The generated answer.
+        """
+        if lookup is None:
+            return
+        scope, question, question_vector, store_version = lookup
+        # The store may have changed while the answer was being generated
+        if store_version is None or store_version == self.vectorstore_version:
+            self.answer_cache.store(
+                scope, question, dict(answer), question_vector, store_version
+            )
+
+    async def get_answer_async(
+        self, question, rag_status="enabled", where=None, usage=None, context=None
+    ):
+        """
+        Retrieve answer asynchronously for a given question.
+
+        Answers are served from the answer cache when the same or a similar
+        question was asked before with the same settings and vector store.
+        In compare mode both branches run concurrently. `where` restricts the
+        retrieval to the chunks whose metadata match a Chroma filter.
+
+        If given, `usage` is filled with the prompt and completion tokens of
+        each branch, and `context` with the documents the rag branch retrieved.
+        """
         answer = {"rag": "", "pure": ""}
-        if rag_status == "enabled":
-            response = await self.retrieval_chain.ainvoke({"input": question})
-            answer["rag"] = response["answer"]
-        elif rag_status == "disabled":
-            response = await self.llm.ainvoke(question)
-            answer["pure"] = response.content
-        elif rag_status == "both":
-            response_rag = await self.retrieval_chain.ainvoke({"input": question})
-            answer["rag"] = response_rag["answer"]
-            response_pure = await self.llm.ainvoke(question)
-            answer["pure"] = response_pure.content
+        async for branch, text, branch_usage, error in self.iter_answers_async(
+            question, rag_status, where, context
+        ):
+            if error is not None:
+                raise error
+            answer[branch] = text
+            if usage is not None:
+                usage[branch] = branch_usage
         return answer
 
+    async def iter_answers_async(
+        self, question, rag_status="enabled", where=None, context=None
+    ):
+        """
+        Answer a question, yielding each branch as soon as it completes.
+
+        The branches of compare mode run concurrently, each with its own
+        timeout of BRANCH_TIMEOUT seconds and its own token usage.
+
+        Args:
+            question (str): The question asked by the user.
+            rag_status (str): The RAG mode, i.e. 'enabled', 'disabled' or 'both'.
+            where (dict): A Chroma metadata filter restricting the retrieval.
+            context (dict): If given, filled with the documents retrieved by
+                the rag branch under the 'rag' key. Cached answers retrieve none.
+
+        Yields:
+            tuple: The branch ('rag' or 'pure'), its answer, a dictionary of
+            its prompt and completion tokens, and the exception it failed
+            with or None.
+        """
+        answer, lookup, retrieval = await self.lookup_cached_answer(
+            question, rag_status, where
+        )
+        if answer is not None:
+            for branch, text in answer.items():
+                if text != "":
+                    no_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+                    yield branch, text, no_usage, None
+            return
+
+        tasks = [
+            asyncio.ensure_future(
+                self._answer_branch(branch, question, retrieval, context)
+            )
+            for branch in RAG_BRANCHES.get(rag_status, [])
+        ]
+        answer = {"rag": "", "pure": ""}
+        failed = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                branch, text, usage, error = await next_done
+                answer[branch] = text
+                failed = failed or error is not None
+                yield branch, text, usage, error
+        finally:
+            # Cancel the remaining branches if the caller stops early
+            for task in tasks:
+                task.cancel()
+        if not failed:
+            self.store_cached_answer(lookup, answer)
+
+    async def _answer_branch(self, branch, question, retrieval=None, context=None):
+        """
+        Answer a question with one branch, measuring its own token usage.
+
+        The rag branch answers from `retrieval`, as returned by retrieve_context().
+        """
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        try:
+            # Each branch runs in its own task, so the callback only counts its tokens
+            with get_openai_callback() as cb:
+                if branch == "rag":
+                    documents, _, error = retrieval
+                    if error is not None:
+                        raise error
+                    text = await asyncio.wait_for(
+                        self.documents_chain.ainvoke(
+                            {"input": question, "context": documents}
+                        ),
+                        self.branch_timeout,
+                    )
+                    if context is not None:
+                        context[branch] = documents
+                else:
+                    response = await asyncio.wait_for(
+                        self.llm.ainvoke(question), self.branch_timeout
+                    )
+                    text = response.content
+            usage = {
+                "prompt_tokens": cb.prompt_tokens,
+                "completion_tokens": cb.completion_tokens,
+            }
+            return branch, text, usage, None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint: disable=W0703
+            return branch, "", usage, e
+
+    async def stream_answer_async(
+        self, question, rag_status="enabled", usage=None, where=None
+    ):
+        """
+        Stream the answer to a question token by token.
+
+        The branches of compare mode are streamed concurrently, each with its
+        own timeout of BRANCH_TIMEOUT seconds. If a branch fails, the other
+        one is still streamed to its end before the error is raised.
+
+        Args:
+            question (str): The question asked by the user.
+            rag_status (str): The RAG mode, i.e. 'enabled', 'disabled' or 'both'.
+            usage (dict): If given, filled with the prompt and completion tokens
+                of each branch once the stream ends, since streamed responses
+                carry no usage figures for get_openai_callback().
+            where (dict): A Chroma metadata filter restricting the retrieval.
+
+        Yields:
+            tuple: The branch ('rag' or 'pure') and the next piece of its answer.
+        """
+        usage = usage if usage is not None else {}
+        answer, lookup, retrieval = await self.lookup_cached_answer(
+            question, rag_status, where
+        )
+        if answer is not None:
+            for branch, text in answer.items():
+                if text != "":
+                    usage[branch] = {"prompt_tokens": 0, "completion_tokens": 0}
+                    yield branch, text
+            return
+
+        branches = RAG_BRANCHES.get(rag_status, [])
+        token_queue = asyncio.Queue()
+        tasks = [
+            asyncio.ensure_future(
+                self._produce_branch(branch, question, usage, token_queue, retrieval)
+            )
+            for branch in branches
+        ]
+        pieces = {branch: [] for branch in branches}
+        errors = []
+        try:
+            remaining = len(tasks)
+            while remaining:
+                branch, token, error = await token_queue.get()
+                if token is not None:
+                    pieces[branch].append(token)
+                    yield branch, token
+                    continue
+                remaining -= 1
+                if error is not None:
+                    errors.append(error)
+        finally:
+            # Cancel the remaining branches if the caller stops early
+            for task in tasks:
+                task.cancel()
+        if errors:
+            raise errors[0]
+        answer = {"rag": "", "pure": ""}
+        answer.update({branch: "".join(tokens) for branch, tokens in pieces.items()})
+        self.store_cached_answer(lookup, answer)
+
+    async def _produce_branch(
+        self, branch, question, usage, token_queue, retrieval=None
+    ):
+        """Stream one branch into the queue, followed by an end marker."""
+
+        async def pump():
+            async for token in self._stream_branch(branch, question, usage, retrieval):
+                await token_queue.put((branch, token, None))
+
+        error = None
+        try:
+            await asyncio.wait_for(pump(), self.branch_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint: disable=W0703
+            error = e
+        await token_queue.put((branch, None, error))
+
+    async def _stream_branch(self, branch, question, usage, retrieval=None):
+        """
+        Stream the answer of one branch and record its token usage.
+
+        The rag branch answers from `retrieval`, as returned by retrieve_context().
+        """
+        pieces = []
+        if branch == "rag":
+            documents, _, error = retrieval
+            if error is not None:
+                raise error
+            prompt_text = self.format_retrieval_prompt(question, documents)
+            async for chunk in self.documents_chain.astream(
+                {"input": question, "context": documents}
+            ):
+                if chunk:
+                    pieces.append(chunk)
+                    yield chunk
+        else:
+            prompt_text = question
+            async for chunk in self.llm.astream(question):
+                if chunk.content:
+                    pieces.append(chunk.content)
+                    yield chunk.content
+        usage[branch] = {
+            "prompt_tokens": count_message_tokens(prompt_text, self.base_model),
+            "completion_tokens": count_tokens("".join(pieces), self.base_model),
+        }
+
+    def format_retrieval_prompt(self, question, documents):
+        """
+        Format the prompt that the retrieval chain sends for the given documents.
+
+        Args:
+            question (str): The question asked by the user.
+            documents (list): The retrieved documents.
+
+        Returns:
+            str: The prompt text.
+        """
+        context = "\n\n".join(document.page_content for document in documents)
+        return (
+            ChatPromptTemplate.from_template(self.prompt_template)
+            .format_messages(context=context, input=question)[0]
+            .content
+        )
+
     def update_vectorstore(self, source_path):
         """
         Update the vector store with data from the specified source file.
@@ -143,107 +840,216 @@ class LLM:
         Returns:
             None
         """
-        vectorstore_filepath = self.config.get("VECTORSTORE_FILEPATH")
-        # database_directory = os.path.dirname(vectorstore_filepath)
+        try:
+            file_paths = self.collect_source_files(source_path)
+        except ValueError as e:
+            # pylint: disable=C0415
+            from PyQt5.QtWidgets import QMessageBox
 
-        if not os.path.exists(vectorstore_filepath):
-            QMessageBox.warning(
-                None,
-                "Warning",
-                "No existing database file! Initialize a VectorStore first.",
-            )
+            QMessageBox.warning(None, "Warning", str(e))
             return
+        self.vectorize_files(file_paths)
+
+    def collect_source_files(self, source_path):
+        """
+        Collects the files to be ingested from a source file or folder.
+
+        Args:
+            source_path (str): The path to the source file or folder.
+
+        Returns:
+            list: The paths of the source files.
+
+        Raises:
+            ValueError: If there is no vector store yet or the file type is invalid.
+        """
+        vectorstore_directory = config_store.get_str("VECTORSTORE_DIRECTORY")
+        if not vectorstore_directory or not os.path.exists(
+            vectorstore_filepath(vectorstore_directory, self.vectorstore_backend)
+        ):
+            raise ValueError("No existing database file! Initialize a VectorStore first.")
 
         if os.path.isdir(source_path):
-            self.vectorize_folder_contents(source_path)
-        else:
-            file_type = os.path.splitext(source_path)[1]
-            if file_type not in [".json", ".txt", ".py", ".md", ".lua"]:
-                QMessageBox.warning(
-                    None, "Warning", f"Invalid source file type: {file_type}!"
-                )
-                return
-            self.vecterize_corpus(source_path, file_type)
+            return list(iter_source_files(source_path))
+        file_type = os.path.splitext(source_path)[1]
+        if file_type not in SUPPORTED_FILE_TYPES:
+            raise ValueError(f"Invalid source file type: {file_type}!")
+        return [source_path]
 
-    def vectorize_folder_contents(self, folder_path):
+    def create_ingestor(self, embeddings=None, writer=None):
         """
-        Vectorizes the contents of all valid files in the given folder path.
+        Creates a bulk ingestor configured from the current settings.
+
+        Its embedding requests go through the bulk lane of the scheduler,
+        behind those of the questions being answered meanwhile.
 
         Args:
-            folder_path (str): The path to the folder containing files to be vectorized.
+            embeddings: The embedding function. Default is self.embeddings.
+            writer (callable): The batch writer. Default writes to self.stored_vectors.
+
+        Returns:
+            BulkIngestor: The configured ingestor.
         """
-        # 遍历指定文件夹下的所有文件和子文件夹
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                # 构建完整的文件路径
-                file_path = os.path.join(root, file)
-                # 提取文件扩展名以判断文件类型
-                _, file_extension = os.path.splitext(file)
-                # 检查是否为支持的文件类型
-                if file_extension in [".json", ".txt", ".md", ".py", ".lua"]:
-                    # 调用重构后的 vecterize_corpus 方法来处理文件
-                    self.vecterize_corpus(file_path, file_extension)
+        return BulkIngestor(
+            embeddings=LaneEmbeddings(embeddings or self.embeddings, "bulk"),
+            writer=writer or self.write_to_vectorstore,
+            deleter=self.delete_from_vectorstore,
+            updater=self.update_vectorstore_metadata,
+            manifest=self.manifest,
+            reader_workers=config_store.get_int("INGEST_READER_WORKERS", 4),
+            embed_batch_size=config_store.get_int("INGEST_EMBED_BATCH_SIZE", 256),
+            max_inflight=config_store.get_int("INGEST_MAX_INFLIGHT", 4),
+            write_batch_size=config_store.get_int("INGEST_WRITE_BATCH_SIZE", 1024),
+            chunker_factory=self.get_chunker,
+            model_name=self.base_model,
+        )
 
-    def vecterize_corpus(self, file_path, file_type):
+    def get_chunker(self, file_type):
         """
-        Vectorizes the corpus data from the specified file.
+        Creates the chunker for a file type from the current settings.
 
         Args:
-            file_path (str): The path to the file.
-            file_type (str): The type of the file (e.g., .json, .txt, .md, .py, .lua).
-        """
-        # 根据文件类型处理文件内容
-        if file_type == ".json":
-            with open(file_path, "r", encoding="utf-8") as file:
-                corpus_data = json.load(file)
-                # 假设 corpus_data 是一个列表，每个元素是一个包含 'text' 键的字典
-                num_elements = len(corpus_data)
-                for i, data in enumerate(corpus_data):
-                    text_content = data["text"]
-                    metadata = [{k: v for k, v in data.items() if k != "text"}]
-                    self.add_to_vectorstore(corpus_data=text_content, metadata=metadata)
-
-                    print(f"Processed {i+1}/{num_elements} from JSON file: {file_path}")
-                    print("")
-
-        elif file_type in [".txt", ".md", ".py", ".lua"]:
-            with open(file_path, "r", encoding="utf-8") as file:
-                text_content = file.read()
-                if file_type == ".md":
-                    text_content = BeautifulSoup(
-                        markdown2.markdown(corpus_data), "html.parser"
-                    ).get_text()
-                self.add_to_vectorstore(corpus_data=text_content)
-                print(f"Processed text-based file: {file_path}")
-
-        print(f"File '{file_path}' is vecterizied.")
-        update_config("KNOWLEDGE_SOURCES", file_path)
-
-    # 示例：向数据库添加矢量化的文本内容的方法
-    def add_to_vectorstore(
-        self, corpus_data, metadata=None, chunk_size=1500, overlap=100
-    ):
+            file_type (str): The extension of the source file, e.g. '.md'.
+
+        Returns:
+            Chunker: The chunker.
+        """
+        return get_chunker(
+            file_type,
+            strategy=config_store.get_str("CHUNKING", "structure"),
+            chunk_tokens=config_store.get_int("CHUNK_TOKENS", 350),
+            overlap_tokens=config_store.get_int("CHUNK_OVERLAP_TOKENS", 35),
+            model_name=self.base_model,
+        )
+
+    def vectorize_files(self, file_paths, ingestor=None):
+        """
+        Vectorizes the given source files with the bulk ingestion pipeline.
+
+        Args:
+            file_paths (iterable): The paths of the source files.
+            ingestor (BulkIngestor): The ingestor to run. Default creates one.
+
+        Returns:
+            IngestReport: The throughput report of the run.
+        """
+        report = (ingestor or self.create_ingestor()).ingest(file_paths)
+        if isinstance(self.stored_vectors, LocalVectorStore):
+            self.stored_vectors.persist()
+        print(report.summary())
+        if self.embedding_cache is not None:
+            print(f"Embedding cache: {self.embedding_cache.stats()}")
+        self.record_knowledge_sources(report)
+        return report
+
+    def record_knowledge_sources(self, report):
+        """
+        Records the completely ingested files of a run as knowledge sources.
+
+        Background jobs call this from the GUI thread once they are done,
+        since config changes are signalled to GUI objects.
+
+        Args:
+            report (IngestReport): The report of the ingestion run.
+        """
+        # Record all new sources with one config write and one change signal
+        knowledge_sources = {
+            os.path.normpath(path) for path in config_store.get_list("KNOWLEDGE_SOURCES")
+        }
+        with config_transaction():
+            for file_path in report.completed:
+                print(f"File '{file_path}' is vecterizied.")
+                if os.path.normpath(file_path) not in knowledge_sources:
+                    update_config("KNOWLEDGE_SOURCES", file_path)
+
+    def write_to_vectorstore(self, texts, embeddings, metadatas, ids):
         """
-        Adds the vectorized text content to the vector store.
+        Writes a batch of already embedded chunks to the vector store.
 
         Args:
-            corpus_data (str): The text content to be vectorized and added.
-        """
-        corpus_length = len(corpus_data)
-        print(f"Processing Text Corpus File with {corpus_length} Characters...")
-        # Splitting text into 1500-character chunks with 100-character overlap
-        chunks = [
-            corpus_data[i : i + chunk_size]
-            for i in range(0, corpus_length, chunk_size - overlap)
+            texts (list): The chunk texts.
+            embeddings (list): The embedding vectors of the chunks.
+            metadatas (list): The metadata dictionaries of the chunks.
+            ids (list): The stable IDs of the chunks.
+        """
+        # pylint: disable=W0212
+        self.stored_vectors._collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=metadatas,
+        )
+        self.lexical_index.add(ids, texts, metadatas)
+        self.bump_vectorstore_version()
+
+    def delete_from_vectorstore(self, ids):
+        """
+        Deletes chunks from the vector store.
+
+        Args:
+            ids (list): The IDs of the chunks to be deleted.
+        """
+        if ids:
+            self.stored_vectors.delete(ids=ids)
+            self.lexical_index.delete(ids)
+            self.bump_vectorstore_version()
+
+    def update_vectorstore_metadata(self, ids, metadatas):
+        """
+        Replaces the metadata of stored chunks without embedding them again.
+
+        Args:
+            ids (list): The IDs of the chunks.
+            metadatas (list): The new metadata dictionaries of the chunks.
+        """
+        # pylint: disable=W0212
+        self.stored_vectors._collection.update(ids=ids, metadatas=metadatas)
+
+    def delete_source(self, source_path):
+        """
+        Deletes all chunks of a source file, or of all files under a folder,
+        from the vector store, the manifest and the knowledge sources.
+
+        Chunks are matched by their indexed 'source_path' metadata, so the
+        collection is not scanned and chunks the manifest missed are removed too.
+
+        Args:
+            source_path (str): The path of the source file or folder.
+
+        Returns:
+            list: The paths of the deleted sources.
+        """
+
+        def normalize(path):
+            # Knowledge sources may have been recorded on another platform
+            return os.path.normpath(path.replace("\\", os.sep))
+
+        source_path = normalize(source_path)
+        folder = source_path + os.sep
+        sources = {
+            normalize(path)
+            for path in list(self.manifest.entries)
+            + config_store.get_list("KNOWLEDGE_SOURCES")
+        }
+        sources = sorted(
+            {path for path in sources if path == source_path or path.startswith(folder)}
+            | (set() if os.path.isdir(source_path) else {source_path})
+        )
+        # pylint: disable=W0212
+        self.stored_vectors._collection.delete(where={"source_path": {"$in": sources}})
+        self.lexical_index.delete_sources(sources)
+        for path in sources:
+            self.manifest.remove(path)
+        self.manifest.save()
+        self.bump_vectorstore_version()
+
+        knowledge_sources = [
+            path
+            for path in config_store.get_list("KNOWLEDGE_SOURCES")
+            if normalize(path) not in sources
         ]
-        num_chunks = len(chunks)
-        for i in range(0, num_chunks, 10):
-            chunk_subset = chunks[i : i + 10]
-            self.stored_vectors.add_texts(
-                texts=chunk_subset,
-                metadatas=metadata,
-            )
-            print(f"Processed {i + len(chunk_subset)}/{num_chunks} Items in Corpus!")
+        update_config("KNOWLEDGE_SOURCES", knowledge_sources)
+        return sources
 
     def calculate_cost(self, dict_tokens):
         """
@@ -260,6 +1066,8 @@ class LLM:
         completion_model_name = prompt_model_name + "-completion"
         prompt_tokens = dict_tokens["prompt_tokens"]
         completion_tokens = dict_tokens["completion_tokens"]
+        prompt_cost = None
+        completion_cost = None
 
         # copy from langchain_community.callbacks.openai_info.py on 2024/2/14
         MODEL_COST_PER_1K_TOKENS = {
@@ -288,7 +1096,7 @@ class LLM:
             elif model == completion_model_name:
                 completion_cost = (completion_tokens / 1000.0) * cost_per_1k_tokens
 
-        if prompt_cost == 0 and completion_cost == 0:
+        if prompt_cost is None or completion_cost is None:
             raise ValueError("Model cost not found for the specified base model")
 
         total_cost = prompt_cost + completion_cost
@@ -8,8 +8,6 @@ import re
 import os
 from dotenv import set_key, find_dotenv
 from qasync import QEventLoop, asyncSlot
-from openai import PermissionDeniedError
-from langchain_community.callbacks import get_openai_callback, openai_info
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -27,14 +25,28 @@ from PyQt5.QtWidgets import (
     QDialog,
     QGridLayout,
     QPushButton,
+    QProgressDialog,
+    QInputDialog,
 )
 from PyQt5.QtGui import QPixmap, QPalette, QBrush, QImage, QPainter, QColor
 from PyQt5.QtCore import Qt, QTimer
 from src.menu_manager import MenuManager
 from src.chat_window import ChatWindow
 from src.input_line import InputLine
-from src.llm import LLM
-from src.config import load_config, update_config, configUpdater
+from src.ingest_job import IngestJob
+from src.startup import LLMLoader, startup_timer
+from src.vector_backends import (
+    VECTORSTORE_FILENAMES,
+    remove_vectorstore,
+    vectorstore_artifacts,
+)
+from src.config import (
+    load_config,
+    update_config,
+    config_transaction,
+    configUpdater,
+    config_store,
+)
 from src.apikey_window import ApiKeyDialog
 from src.prompt_window import PromptInputDialog
 from src.hover_button import HoverButton
@@ -49,16 +61,85 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.config = load_config()
         configUpdater.configChanged.connect(self.displayConfigInfo)
+        config_store.watch()
         self.initUI()
 
-        # Create an instance of LLM class
-        self.llm = LLM()
+        # The LLM is built in the background, so the window responds at once
+        self.llm = None
+        self.ingestJob = None
+        self.setWindowTitle("DST-GPT (loading...)")
+        self.llmLoader = LLMLoader().start()
+        self.loaderTimer = QTimer(self)
+        self.loaderTimer.timeout.connect(self.checkLLMLoaded)
+        self.loaderTimer.start(100)
+
+    def checkLLMLoaded(self):
+        """
+        Takes the LLM once the background loader is done, then seeds a new
+        vectorstore with the sample corpus and prints the startup timing report.
+        """
+        if not self.llmLoader.done:
+            return
+        self.loaderTimer.stop()
+        if self.llmLoader.error is not None:
+            self.setWindowTitle("DST-GPT (failed to load)")
+            QMessageBox.critical(
+                self, "Error", f"Failed to load the LLM: {self.llmLoader.error}"
+            )
+            return
+        self.llm = self.llmLoader.llm
+        # Connected after the LLM's own slot, so runs once the settings are applied
+        configUpdater.llm_configChanged.connect(self.showLLMConfigWarning)
+        startup_timer.mark_ready()
+        print(startup_timer.report())
+        self.setWindowTitle("DST-GPT")
+        QTimer.singleShot(0, self.statusbar.show)
+        self.statusbar.showMessage(
+            f"Ready in {startup_timer.ready_at:.1f} s.", 5000  # 5s
+        )
+        self.seedSampleCorpus()
+
+    def showLLMConfigWarning(self):
+        """
+        Shows why the last settings update of the LLM was not fully applied, if so.
+        """
+        if self.llm.config_warning:
+            QMessageBox.warning(self, "Warning", self.llm.config_warning)
+
+    def requireLLM(self):
+        """
+        Returns whether the LLM is loaded, telling the user to wait otherwise.
+        """
+        if self.llm is None:
+            QMessageBox.information(
+                self, "Loading", "DST-GPT is still loading, please try again shortly."
+            )
+            return False
+        return True
+
+    async def waitForLLM(self):
+        """
+        Waits until the background loader is done.
+
+        Returns:
+            bool: Whether the LLM was loaded.
+        """
+        while not self.llmLoader.done:
+            await asyncio.sleep(0.1)
+        if self.loaderTimer.isActive():
+            self.checkLLMLoaded()
+        return self.llm is not None
 
     def closeEvent(self, event):
         """
         This method is called when the main window is closed.
-        It quits the application.
+        It cancels a running ingestion, closes the chat log and quits the application.
         """
+        if self.ingestJob is not None and not self.ingestJob.done:
+            self.ingestJob.cancel()
+            self.ingestJob.wait()
+        self.chatWindow.closeLog()
+        config_store.flush()
         QApplication.quit()
 
     def initUI(self):
@@ -130,6 +211,7 @@ class MainWindow(QMainWindow):
                 ("Initialize Vectorstore", self.initializeVectorstore),
                 ("Add Corpus to Vectorstore", self.addCorpusToVectorstore),
                 ("Add Corpus Folder to Vectorstore", self.addCorpusFolderToVectorstore),
+                ("Remove Source from Vectorstore", self.removeSourceFromVectorstore),
                 ("Clear Vectorstore", self.clearVectorstore),
             ],
         )
@@ -150,6 +232,21 @@ class MainWindow(QMainWindow):
                 ),
             ],
         )
+        self.menuManager.createActionMenu(
+            "Retriever",
+            [
+                ("Set Top-k", lambda: self.setRetrieverOption("k")),
+                ("Set Search Type", lambda: self.setRetrieverOption("search_type")),
+                ("Set MMR Fetch-k", lambda: self.setRetrieverOption("fetch_k")),
+                ("Set Keyword Search", lambda: self.setRetrieverOption("hybrid")),
+                (
+                    "Set Minimum Similarity",
+                    lambda: self.setRetrieverOption("score_threshold"),
+                ),
+                ("Set Source Filter", lambda: self.setRetrieverOption("source")),
+                ("Show Retriever Stats", self.showRetrieverStats),
+            ],
+        )
         self.menuManager.createActionMenu(
             "Icons",
             [
@@ -174,6 +271,19 @@ class MainWindow(QMainWindow):
                 ),
             ],
         )
+        self.menuManager.createCheckableMenu(
+            "Streaming",
+            [
+                (
+                    "Enabled:Default",
+                    self.config.get("STREAMING", "enabled") == "enabled",
+                ),
+                (
+                    "Disabled",
+                    self.config.get("STREAMING", "enabled") == "disabled",
+                ),
+            ],
+        )
         self.menuManager.createCheckableMenu(
             "Log",
             [
@@ -208,6 +318,10 @@ class MainWindow(QMainWindow):
                 rag_status = actionText.split(":")[0].lower()
                 update_config("RAG", rag_status)
 
+            elif menuName == "Streaming":
+                streaming_status = actionText.split(":")[0].lower()
+                update_config("STREAMING", streaming_status)
+
             elif menuName == "Log":
                 log_status = actionText.split(":")[0].lower()
                 update_config("LOG", log_status)
@@ -235,9 +349,12 @@ class MainWindow(QMainWindow):
                 self, "Select Directory", options=options
             )
             if directory:
+                if not self.requireLLM():
+                    break
                 vectorstore_directory = os.path.relpath(directory)
+                backend = self.config.get("VECTORSTORE_BACKEND", "chroma")
                 vectorstore_filepath = os.path.join(
-                    vectorstore_directory, "chroma.sqlite3"
+                    vectorstore_directory, VECTORSTORE_FILENAMES[backend]
                 )
                 if os.path.exists(vectorstore_filepath):
                     confirm = QMessageBox.question(
@@ -248,14 +365,20 @@ class MainWindow(QMainWindow):
                     )
                     if confirm == QMessageBox.Yes:
                         self.llm.init_vectorstore(vectorstore_directory)
-                        update_config("VECTORSTORE_FILEPATH", vectorstore_filepath)
-                        update_config("VECTORSTORE_DIRECTORY", vectorstore_directory)
+                        with config_transaction():
+                            update_config("VECTORSTORE_FILEPATH", vectorstore_filepath)
+                            update_config(
+                                "VECTORSTORE_DIRECTORY", vectorstore_directory
+                            )
+                        self.seedSampleCorpus()
 
                         break
                 else:
                     self.llm.init_vectorstore(vectorstore_directory)
-                    update_config("VECTORSTORE_FILEPATH", vectorstore_filepath)
-                    update_config("VECTORSTORE_DIRECTORY", vectorstore_directory)
+                    with config_transaction():
+                        update_config("VECTORSTORE_FILEPATH", vectorstore_filepath)
+                        update_config("VECTORSTORE_DIRECTORY", vectorstore_directory)
+                    self.seedSampleCorpus()
 
                     break
             else:
@@ -276,7 +399,7 @@ class MainWindow(QMainWindow):
         )
         if fileName:
             file_path = os.path.relpath(fileName)
-            self.llm.update_vectorstore(file_path)
+            self.startIngestJob(file_path)
 
     def addCorpusFolderToVectorstore(self):
         """
@@ -289,14 +412,111 @@ class MainWindow(QMainWindow):
         )
         if directory:
             folder_path = os.path.relpath(directory)
-            self.llm.update_vectorstore(folder_path)
+            self.startIngestJob(folder_path)
+
+    def startIngestJob(self, source_path):
+        """
+        Ingests a source file or folder in the background, showing a progress
+        dialog with a Cancel button while the GUI stays responsive.
+        """
+        if not self.requireLLM():
+            return
+        if self.ingestJob is not None and not self.ingestJob.done:
+            QMessageBox.warning(self, "Warning", "An ingestion is already running!")
+            return
+        try:
+            file_paths = self.llm.collect_source_files(source_path)
+        except ValueError as e:
+            QMessageBox.warning(self, "Warning", str(e))
+            return
+        self.runIngestJob(file_paths)
+
+    def seedSampleCorpus(self):
+        """
+        Ingests the sample corpus into a new vectorstore as a background job.
+        """
+        file_paths = self.llm.take_sample_corpus()
+        if file_paths:
+            self.runIngestJob(file_paths, "Adding Sample Data")
+
+    def runIngestJob(self, file_paths, title="Updating Vectorstore"):
+        """
+        Starts an ingestion job and polls its progress.
+
+        Args:
+            file_paths (list): The paths of the source files.
+            title (str): The title of the progress dialog.
+        """
+        self.ingestJob = IngestJob(self.llm, file_paths).start()
+        self.ingestDialog = QProgressDialog(
+            "Preparing ingestion...", "Cancel", 0, 1000, self
+        )
+        self.ingestDialog.setWindowTitle(title)
+        self.ingestDialog.setMinimumWidth(480)
+        self.ingestDialog.setAutoClose(False)
+        self.ingestDialog.setAutoReset(False)
+        self.ingestDialog.canceled.connect(self.cancelIngestJob)
+        self.ingestDialog.show()
+
+        # Poll the job from the GUI thread instead of signalling from the worker
+        self.ingestTimer = QTimer(self)
+        self.ingestTimer.timeout.connect(self.updateIngestProgress)
+        self.ingestTimer.start(200)
+
+    def cancelIngestJob(self):
+        """
+        Cancels the running ingestion; embeddings already requested are still written.
+        """
+        if self.ingestJob is not None:
+            self.ingestJob.cancel()
+            self.ingestDialog.setLabelText("Cancelling, waiting for in-flight requests...")
+
+    def updateIngestProgress(self):
+        """
+        Updates the progress dialog and reports the result once the job is done.
+        """
+        job = self.ingestJob
+        if not job.done:
+            if job.report is not None and not self.ingestDialog.wasCanceled():
+                self.ingestDialog.setValue(int(job.report.fraction * 1000))
+                self.ingestDialog.setLabelText(job.report.progress())
+            return
+
+        self.ingestTimer.stop()
+        self.ingestDialog.canceled.disconnect(self.cancelIngestJob)
+        self.ingestDialog.close()
+        if job.error is not None:
+            QMessageBox.warning(self, "Warning", f"Ingestion failed: {job.error}")
+            return
+        report = job.finish()
+        QTimer.singleShot(0, self.statusbar.show)
+        self.statusbar.showMessage(report.summary())
+        QTimer.singleShot(20000, self.statusbar.hide)  # 20s
+
+    def removeSourceFromVectorstore(self):
+        """
+        Lets the user pick a knowledge source and deletes its chunks from the vectorstore.
+        """
+        sources = self.config.get("KNOWLEDGE_SOURCES", [])
+        if not sources:
+            QMessageBox.information(None, "No Sources", "The vectorstore has no sources.")
+            return
+        if self.ingestJob is not None and not self.ingestJob.done:
+            QMessageBox.warning(self, "Warning", "An ingestion is running!")
+            return
+        source, ok = QInputDialog.getItem(
+            self, "Remove Source", "Source to remove:", sources, 0, False
+        )
+        if ok and source and self.requireLLM():
+            removed = self.llm.delete_source(source)
+            self.statusbar.showMessage(f"Removed {', '.join(removed)} from the vectorstore.")
 
     def clearVectorstore(self):
         """
-        Clears the vectorstore by deleting the existing database if it exists.
+        Clears the vectorstore by deleting the files of the existing database, of any backend.
         """
-        vectorstore_filepath = self.config.get("VECTORSTORE_FILEPATH")
-        if os.path.exists(vectorstore_filepath):
+        vectorstore_directory = config_store.get_str("VECTORSTORE_DIRECTORY")
+        if vectorstore_directory and vectorstore_artifacts(vectorstore_directory):
             confirm = QMessageBox.question(
                 self,
                 "Confirm Clear",
@@ -304,13 +524,14 @@ class MainWindow(QMainWindow):
                 QMessageBox.Yes | QMessageBox.No,
             )
             if confirm == QMessageBox.Yes:
-                os.remove(vectorstore_filepath)
+                remove_vectorstore(vectorstore_directory)
                 QMessageBox.information(
                     None, "File Deleted", "Database has been deleted."
                 )
-                update_config("VECTORSTORE_FILEPATH", "")
-                update_config("VECTORSTORE_DIRECTORY", "")
-                update_config("KNOWLEDGE_SOURCES", [])
+                with config_transaction():
+                    update_config("VECTORSTORE_FILEPATH", "")
+                    update_config("VECTORSTORE_DIRECTORY", "")
+                    update_config("KNOWLEDGE_SOURCES", [])
         else:
             QMessageBox.information(None, "File Not Found", "The file does not exist.")
 
@@ -386,8 +607,122 @@ class MainWindow(QMainWindow):
         else:
             raise ValueError(f"Invalid prompt template type: {template_type}")
 
-        update_config("PROMPT_TEMPLATE", new_template)
-        update_config("TEMPLATE_TYPE", template_type)
+        with config_transaction():
+            update_config("PROMPT_TEMPLATE", new_template)
+            update_config("TEMPLATE_TYPE", template_type)
+
+    def setRetrieverOption(self, option):
+        """
+        Asks the user for a retriever setting and saves it to the config.
+
+        Args:
+            option (str): The setting, i.e. 'k', 'search_type', 'fetch_k',
+            'hybrid', 'score_threshold' or 'source'.
+        """
+        config = config_store
+        if option == "k":
+            value, ok = QInputDialog.getInt(
+                self,
+                "Top-k",
+                "Chunks per question:",
+                config.get_int("RETRIEVER_K", 4),
+                1,
+                50,
+            )
+            if ok:
+                update_config("RETRIEVER_K", value)
+        elif option == "search_type":
+            search_types = ["similarity", "mmr"]
+            current = config.get_str("RETRIEVER_SEARCH_TYPE", "similarity")
+            value, ok = QInputDialog.getItem(
+                self,
+                "Search Type",
+                "Similarity, or MMR for diverse chunks:",
+                search_types,
+                search_types.index(current) if current in search_types else 0,
+                False,
+            )
+            if ok:
+                update_config("RETRIEVER_SEARCH_TYPE", value)
+        elif option == "fetch_k":
+            value, ok = QInputDialog.getInt(
+                self,
+                "MMR Fetch-k",
+                "Candidate chunks MMR picks from:",
+                config.get_int("RETRIEVER_FETCH_K", 20),
+                1,
+                200,
+            )
+            if ok:
+                update_config("RETRIEVER_FETCH_K", value)
+        elif option == "hybrid":
+            states = ["enabled", "disabled"]
+            current = states[0 if config.get_bool("RETRIEVER_HYBRID", True) else 1]
+            value, ok = QInputDialog.getItem(
+                self,
+                "Keyword Search",
+                "Combine vector search with BM25 keyword search:",
+                states,
+                states.index(current) if current in states else 0,
+                False,
+            )
+            if ok:
+                update_config("RETRIEVER_HYBRID", value)
+        elif option == "score_threshold":
+            value, ok = QInputDialog.getDouble(
+                self,
+                "Minimum Similarity",
+                "Minimum cosine similarity of a chunk (0 keeps all):",
+                config.get_float("RETRIEVER_SCORE_THRESHOLD", 0),
+                0,
+                1,
+                2,
+            )
+            if ok:
+                update_config("RETRIEVER_SCORE_THRESHOLD", value)
+        elif option == "source":
+            all_sources = "All Sources"
+            sources = [all_sources] + config.get_list("KNOWLEDGE_SOURCES")
+            current = config.get("RETRIEVER_FILTER") or {}
+            source, ok = QInputDialog.getItem(
+                self,
+                "Source Filter",
+                "Only retrieve chunks from:",
+                sources,
+                (
+                    sources.index(current.get("source_path"))
+                    if current.get("source_path") in sources
+                    else 0
+                ),
+                False,
+            )
+            if ok and source == all_sources:
+                update_config("RETRIEVER_FILTER", {})
+            elif ok:
+                # Chunks are stored with the normalized path of their source
+                source_path = os.path.normpath(source.replace("\\", os.sep))
+                update_config("RETRIEVER_FILTER", {"source_path": source_path})
+        else:
+            raise ValueError(f"Invalid retriever option: {option}")
+
+    def showRetrieverStats(self):
+        """
+        Shows the chunks and context tokens per question, and the tokens
+        saved compared to plain top-k retrieval and by the context packer.
+        """
+        if not self.requireLLM():
+            return
+        lines = [
+            f"{key.replace('_', ' ').capitalize()}: {value}"
+            for key, value in self.llm.retriever_stats.as_dict().items()
+        ]
+        lines.append("")
+        lines.append("Context packer:")
+        lines.extend(
+            f"{key.replace('_', ' ').capitalize()}: {value}"
+            for key, value in self.llm.packer_stats.as_dict().items()
+        )
+        QMessageBox.information(self, "Retriever Stats", "\n".join(lines))
 
     def createStatusBar(self):
         """
@@ -569,34 +904,76 @@ class MainWindow(QMainWindow):
             str: The answer to the question.
         """
 
-        load_config()
-        rag_status = self.config.get("RAG")
+        if not await self.waitForLLM():
+            return
+        rag_status = config_store.get_str("RAG", "enabled")
+        if config_store.get_bool("STREAMING", True):
+            await self.streamLLMAnswer(user_text, rag_status)
+            return
+        async for branch, answer, usage, error in self.llm.iter_answers_async(
+            user_text, rag_status
+        ):
+            if error is not None:
+                self.reportLLMError(error)
+                continue
+            tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+            cost = self.llm.calculate_cost(usage)
+            # Each answer is shown as soon as its own branch completes
+            self.chatWindow.addMessage(answer, f"left-{branch}", tokens, cost)
+
+    def reportLLMError(self, error):
+        """
+        Shows the reason why an LLM request failed in the chat window.
+
+        Args:
+            error (Exception): The exception the request failed with.
+        """
+        # pylint: disable=C0415
+        from openai import PermissionDeniedError
+
+        if isinstance(error, asyncio.TimeoutError):
+            error = f"No answer within {self.llm.branch_timeout} seconds."
+        elif not isinstance(error, PermissionDeniedError):
+            raise error
+        print(f"We've got a failed LLM request:\n{error}")
+        self.chatWindow.addMessage(
+            f"LLM responses failed due to following reason, you may try again.\n{error}",
+            "right",
+        )
+
+    async def streamLLMAnswer(self, user_text, rag_status):
+        """
+        Streams the answer from LLM into the chat window token by token.
+
+        Args:
+            user_text (str): The user's input text.
+            rag_status (str): The RAG mode, i.e. 'enabled', 'disabled' or 'both'.
+        """
+        # pylint: disable=C0415
+        from openai import PermissionDeniedError
+
+        usage = {}
+        bubbles = {}
         try:
-            with get_openai_callback() as cb:
-                llm_answers = await self.llm.get_answer_async(user_text, rag_status)
-                tokens = cb.total_tokens
-                dict_tokens = {
-                    "prompt_tokens": cb.prompt_tokens,
-                    "completion_tokens": cb.completion_tokens,
-                }
-                # cost = cb.total_cost
-                cost = self.llm.calculate_cost(dict_tokens)
-            if llm_answers["rag"] != "" and llm_answers["pure"] != "":
-                self.chatWindow.addMessage(llm_answers["rag"], "left-rag", tokens, cost)
-                self.chatWindow.addMessage(llm_answers["pure"], "left-pure")
-
-            elif llm_answers["pure"] != "":
-                self.chatWindow.addMessage(
-                    llm_answers["pure"], "left-pure", tokens, cost
+            async for branch, token in self.llm.stream_answer_async(
+                user_text, rag_status, usage
+            ):
+                if branch not in bubbles:
+                    self.chatWindow.removeMessage("Thinking...")
+                    bubbles[branch] = self.chatWindow.addStreamingMessage(
+                        f"left-{branch}"
+                    )
+                self.chatWindow.appendToMessage(bubbles[branch], token)
+        except (PermissionDeniedError, asyncio.TimeoutError) as e:
+            self.reportLLMError(e)
+        finally:
+            for branch, bubble in bubbles.items():
+                branch_usage = usage.get(
+                    branch, {"prompt_tokens": 0, "completion_tokens": 0}
+                )
+                self.chatWindow.finishStreamingMessage(
+                    bubble,
+                    f"left-{branch}",
+                    branch_usage["prompt_tokens"] + branch_usage["completion_tokens"],
+                    self.llm.calculate_cost(branch_usage),
                 )
-
-            elif llm_answers["rag"] != "":
-                self.chatWindow.addMessage(llm_answers["rag"], "left-rag", tokens, cost)
-        except PermissionDeniedError as e:
-            # 在这里处理异常，例如显示错误消息或执行其他适当的错误处理
-            print(f"We've got a PermissionDeniedError:\n{e}")
-            # 可选：更新UI或通知用户，需要确保在适当的线程/上下文中执行UI操作
-            self.chatWindow.addMessage(
-                f"LLM responses failed due to following reason, you may try again.\n{e}",
-                "right",
-            )
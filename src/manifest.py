@@ -0,0 +1,141 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides a manifest of the source files ingested into a vector store.
+"""
+import os
+import json
+import hashlib
+import threading
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def file_hash(file_path):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Args:
+        file_path (str): The path to the file.
+
+    Returns:
+        str: The hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(source, text):
+    """
+    Derives a stable vector store ID for a chunk.
+
+    The same chunk text from the same source always gets the same ID, so
+    re-adding a source overwrites its chunks instead of duplicating them.
+
+    Args:
+        source (str): The source the chunk comes from, e.g. a file path.
+        text (str): The chunk text.
+
+    Returns:
+        str: The chunk ID.
+    """
+    source = os.path.normpath(source) if source else ""
+    return hashlib.sha256(f"{source}\0{text}".encode("utf-8")).hexdigest()
+
+
+class SourceManifest:
+    """
+    This class records, per source file, the mtime, size and content hash
+    the file had when it was ingested, the settings of the chunker that
+    split it, and the IDs of the chunks it produced.
+
+    Args:
+        manifest_filepath (str): The path of the JSON file backing the manifest.
+    """
+
+    def __init__(self, manifest_filepath):
+        self.manifest_filepath = manifest_filepath
+        self._lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        """
+        Loads the manifest from its file.
+
+        Returns:
+            dict: The manifest entries, or an empty dictionary if there is no valid file.
+        """
+        try:
+            with open(self.manifest_filepath, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            print(f"Error decoding manifest file, starting a new one: {e}")
+            return {}
+
+    def save(self):
+        """Writes the manifest to its file atomically."""
+        with self._lock:
+            directory = os.path.dirname(self.manifest_filepath)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_filepath = self.manifest_filepath + ".tmp"
+            with open(temp_filepath, "w", encoding="utf-8") as file:
+                json.dump(self.entries, file, indent=4)
+            os.replace(temp_filepath, self.manifest_filepath)
+
+    def get(self, file_path):
+        """Returns the entry of a source file, or None if it was never ingested."""
+        with self._lock:
+            return self.entries.get(os.path.normpath(file_path))
+
+    def is_unchanged(self, file_path, chunker=None):
+        """
+        Checks the file's mtime and size against the manifest without reading it.
+
+        Args:
+            file_path (str): The path to the file.
+            chunker (str): The signature of the chunker the file would be split with.
+
+        Returns:
+            bool: True if the file has been ingested with the same chunker
+            and was not modified since.
+        """
+        entry = self.get(file_path)
+        if entry is None or entry.get("chunker") != chunker:
+            return False
+        stat = os.stat(file_path)
+        return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+    def record(self, file_path, content_hash, chunk_ids, chunker=None):
+        """
+        Records a source file as ingested with its current mtime and size.
+
+        Args:
+            file_path (str): The path to the file.
+            content_hash (str): The SHA-256 hash of the file's content.
+            chunk_ids (list): The IDs of the chunks stored for the file.
+            chunker (str): The signature of the chunker that split the file.
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            self.entries[os.path.normpath(file_path)] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "sha256": content_hash,
+                "chunk_ids": list(chunk_ids),
+                "chunker": chunker,
+            }
+
+    def remove(self, file_path):
+        """Removes a source file from the manifest."""
+        with self._lock:
+            self.entries.pop(os.path.normpath(file_path), None)
+
+    def clear(self):
+        """Removes all entries, e.g. after the vector store has been re-created."""
+        with self._lock:
+            self.entries = {}
@@ -0,0 +1,334 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module provides the configurable retriever over the Chroma vector store.
+
+Besides the number of chunks, it supports maximal marginal relevance (MMR)
+over a larger candidate set, a minimum similarity below which chunks are
+not stuffed into the prompt, metadata filters, and hybrid search fusing
+the vector ranking with a local BM25 keyword index. It counts the context
+tokens it returns against plain top-k retrieval, so the savings can be
+measured.
+"""
+import threading
+from typing import Any, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from src.tokens import count_tokens
+from src.lexical_index import is_confident
+
+SEARCH_TYPES = ["similarity", "mmr"]
+
+
+def cosine_similarity(distance, space="l2"):
+    """
+    Converts a Chroma distance into the cosine similarity of unit vectors.
+
+    Args:
+        distance (float): The distance returned by Chroma.
+        space (str): The distance function of the collection: 'l2' (squared
+            euclidean, the default), 'cosine' or 'ip'.
+
+    Returns:
+        float: The cosine similarity, from -1 to 1.
+    """
+    if space == "l2":
+        # |a - b|² = 2 - 2·cos(a, b) for unit-normalized embeddings
+        return 1.0 - distance / 2.0
+    return 1.0 - distance
+
+
+def merge_filters(*filters):
+    """
+    Combines Chroma metadata filters, all of which must match.
+
+    Args:
+        *filters (dict): The filters; empty ones are ignored.
+
+    Returns:
+        dict: The combined filter, or None if there is none.
+    """
+    conditions = [
+        {key: value} for where in filters if where for key, value in where.items()
+    ]
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses rankings by reciprocal rank fusion (RRF).
+
+    Args:
+        rankings (list): The rankings, each a list of IDs, best first.
+        k (int): The rank constant; larger values flatten the rank weights.
+
+    Returns:
+        list: The (id, score) pairs, best first, where the score is the sum
+        of 1 / (k + rank) over the rankings holding the ID.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class RetrieverStats:
+    """
+    This class counts the chunks and context tokens of retrievals, and the
+    tokens plain top-k retrieval would have put into the prompts instead.
+
+    The queries answered by keywords alone run no vector search, so they
+    have no top-k baseline and are left out of the comparison.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.chunks = 0
+        self.context_tokens = 0
+        self.compared_context_tokens = 0
+        self.top_k_tokens = 0
+        self.lexical_only = 0
+        self._lock = threading.Lock()
+
+    def record(self, chunks, context_tokens, top_k_tokens=None, lexical_only=False):
+        """Records a retrieval; `top_k_tokens` is None for lexical-only ones."""
+        with self._lock:
+            self.queries += 1
+            self.chunks += chunks
+            self.context_tokens += context_tokens
+            self.lexical_only += lexical_only
+            if not lexical_only:
+                self.compared_context_tokens += context_tokens
+                self.top_k_tokens += top_k_tokens
+
+    def as_dict(self):
+        """
+        Returns the counters.
+
+        Returns:
+            dict: The totals and per-query means, including the context
+            tokens saved per query compared to plain top-k retrieval, over
+            the queries with a vector search, and the queries answered by
+            keywords without a query embedding.
+        """
+        with self._lock:
+            queries = self.queries or 1
+            compared = (self.queries - self.lexical_only) or 1
+            return {
+                "queries": self.queries,
+                "lexical_only_queries": self.lexical_only,
+                "chunks_per_query": round(self.chunks / queries, 2),
+                "context_tokens_per_query": round(self.context_tokens / queries, 1),
+                "saved_tokens_per_query": round(
+                    (self.top_k_tokens - self.compared_context_tokens) / compared, 1
+                ),
+            }
+
+
+class ConfiguredRetriever(BaseRetriever):
+    """
+    This class retrieves the chunks most similar to a query from a Chroma store.
+
+    Chunks whose cosine similarity to the query is below `score_threshold`,
+    if set, are dropped, so fewer than `k` chunks, or none, are returned
+    when fewer relevant chunks exist. With the 'mmr' search type, the `k`
+    chunks are picked among the `fetch_k` most similar ones, trading
+    relevance for diversity by `lambda_mult` (1 is pure relevance).
+
+    With a `lexical_index`, the search is hybrid: the `fetch_k` best BM25
+    matches are fused with the vector ranking by reciprocal rank fusion.
+    The keyword matches are held to `score_threshold` too, by their own
+    similarity to the query.
+    If the best keyword match contains every query term and scores at least
+    `lexical_margin` times the runner-up, the keyword ranking is used alone
+    and the query is not embedded at all.
+
+    The retrieval score of every chunk is put into its 'score' metadata,
+    and its cosine similarity into 'similarity' where known. The chunks are
+    assembled into the prompt context by `packer`, a ContextPacker, if given.
+    """
+
+    vectorstore: Any
+    k: int = 4
+    search_type: str = "similarity"
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    score_threshold: Optional[float] = None
+    where: Optional[dict] = None
+    lexical_index: Any = None
+    rrf_k: int = 60
+    lexical_margin: float = 2.0
+    stats: Any = None
+    packer: Any = None
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        """Retrieves the relevant chunks for a query."""
+        return self.retrieve(query)[0]
+
+    def retrieve(self, query):
+        """
+        Retrieves the relevant chunks for a query.
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            tuple: The chunks, and the query embedding, None if the query
+            was answered by keywords alone and not embedded.
+        """
+        lexical = []
+        if self.lexical_index is not None:
+            lexical = self._lexical_search(query)
+            if self.lexical_margin and is_confident(
+                [(key, score, coverage) for key, _, score, coverage in lexical],
+                self.lexical_margin,
+            ):
+                documents = [document for _, document, _, _ in lexical[: self.k]]
+                return self._finish(query, documents, lexical_only=True), None
+
+        store = self.vectorstore
+        vector = store._embedding_function.embed_query(query)
+        mmr = self.search_type == "mmr"
+        include = ["documents", "metadatas", "distances"]
+        if mmr:
+            include.append("embeddings")
+        result = store._collection.query(
+            query_embeddings=[vector],
+            n_results=max(self.k, self.fetch_k) if mmr or lexical else self.k,
+            where=self.where or None,
+            include=include,
+        )
+        space = (store._collection.metadata or {}).get("hnsw:space", "l2")
+        similarities = {}
+        candidates = []
+        for index, (key, text, metadata, distance) in enumerate(
+            zip(
+                result["ids"][0],
+                result["documents"][0],
+                result["metadatas"][0],
+                result["distances"][0],
+            )
+        ):
+            similarity = round(cosine_similarity(distance, space), 4)
+            similarities[key] = similarity
+            if self.score_threshold is None or similarity >= self.score_threshold:
+                metadata = dict(metadata or {}, similarity=similarity, score=similarity)
+                candidates.append((key, Document(page_content=text, metadata=metadata), index))
+
+        if mmr and candidates:
+            picked = maximal_marginal_relevance(
+                np.asarray(vector, dtype=np.float32),
+                [result["embeddings"][0][index] for _, _, index in candidates],
+                lambda_mult=self.lambda_mult,
+                k=self.k,
+            )
+            candidates = [candidates[position] for position in picked]
+        top_k = [
+            Document(page_content=text) for text in result["documents"][0][: self.k]
+        ]
+
+        if not lexical:
+            documents = [document for _, document, _ in candidates[: self.k]]
+            return self._finish(query, documents, top_k), vector
+
+        if self.score_threshold is not None:
+            lexical = self._above_threshold(lexical, vector, similarities)
+        documents = {key: document for key, document, _, _ in lexical}
+        documents.update((key, document) for key, document, _ in candidates)
+        fused = reciprocal_rank_fusion(
+            [[key for key, _, _ in candidates], [key for key, _, _, _ in lexical]],
+            self.rrf_k,
+        )
+        picked = []
+        for key, score in fused[: self.k]:
+            document = documents[key]
+            document.metadata["score"] = round(score, 6)
+            picked.append(document)
+        return self._finish(query, picked, top_k), vector
+
+    def _lexical_search(self, query):
+        """
+        Ranks the chunks matching the filter by their BM25 score.
+
+        Returns:
+            list: The (id, document, score, coverage) hits, best first.
+        """
+        hits = self.lexical_index.search(query, max(self.k, self.fetch_k))
+        if not hits:
+            return []
+        found = self.vectorstore._collection.get(
+            ids=[key for key, _, _ in hits],
+            where=self.where or None,
+            include=["documents", "metadatas"],
+        )
+        documents = {
+            key: (text, metadata)
+            for key, text, metadata in zip(
+                found["ids"], found["documents"], found["metadatas"]
+            )
+        }
+        # Chunks the filter excludes, or deleted from the store, drop out
+        return [
+            (
+                key,
+                Document(
+                    page_content=documents[key][0],
+                    metadata=dict(documents[key][1] or {}, score=round(score, 4)),
+                ),
+                score,
+                coverage,
+            )
+            for key, score, coverage in hits
+            if key in documents
+        ]
+
+    def _above_threshold(self, lexical, vector, similarities):
+        """
+        Drops the keyword hits whose similarity to the query is below `score_threshold`.
+
+        Args:
+            lexical (list): The (id, document, score, coverage) hits.
+            vector (list): The query embedding.
+            similarities (dict): The cosine similarities known from the
+                vector search, by ID; the others are computed.
+
+        Returns:
+            list: The hits kept, with their similarity in their metadata.
+        """
+        unknown = [key for key, _, _, _ in lexical if key not in similarities]
+        if unknown:
+            found = self.vectorstore._collection.get(ids=unknown, include=["embeddings"])
+            query = np.asarray(vector, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1.0
+            for key, embedding in zip(found["ids"], found["embeddings"]):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                similarity = float(embedding @ query) / (np.linalg.norm(embedding) or 1.0)
+                similarities[key] = round(similarity, 4)
+        kept = []
+        for key, document, score, coverage in lexical:
+            similarity = similarities.get(key)
+            if similarity is not None and similarity >= self.score_threshold:
+                document.metadata["similarity"] = similarity
+                kept.append((key, document, score, coverage))
+        return kept
+
+    def _finish(self, query, documents, top_k=None, lexical_only=False):
+        """Packs the retrieved chunks and records the retrieval."""
+        if self.packer is not None:
+            documents = self.packer.pack(documents, query)
+        if self.stats is not None:
+            self.stats.record(
+                len(documents),
+                sum(count_tokens(document.page_content) for document in documents),
+                None
+                if top_k is None
+                else sum(count_tokens(document.page_content) for document in top_k),
+                lexical_only,
+            )
+        return documents
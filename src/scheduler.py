@@ -0,0 +1,593 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0902,R0913,W0703
+"""
+This module schedules the requests sent to the OpenAI API.
+
+Requests wait in priority lanes for token buckets holding the requests and
+the tokens per minute of the account, so a large ingestion does not run
+into 429 errors and interactive questions go ahead of bulk embedding.
+Failed requests are retried with jittered exponential backoff, waiting at
+least as long as a Retry-After header asks.
+
+The scheduler is shared by the threads and the event loops of the process.
+The resources of the OpenAI clients of ChatOpenAI and OpenAIEmbeddings are
+wrapped, so every HTTP request, including each batch of an embedding call,
+goes through it.
+"""
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextlib
+import contextvars
+from email.utils import parsedate_to_datetime
+import openai
+from langchain_core.embeddings import Embeddings
+from src.tokens import count_tokens, count_message_tokens
+
+# The lanes in the order their requests are sent
+LANES = ["interactive", "bulk"]
+
+# The seconds of requests or tokens the buckets hold: the API enforces its
+# per-minute limits over shorter intervals, so a minute's worth at once fails
+BURST_SECONDS = 1.0
+
+# The completion tokens counted for a chat request before its usage is known
+DEFAULT_COMPLETION_TOKENS = 256
+
+_lane = contextvars.ContextVar("request_lane", default="interactive")
+
+
+@contextlib.contextmanager
+def request_lane(lane):
+    """
+    Sends the requests made in the block, and in the tasks it creates, through a lane.
+
+    Args:
+        lane (str): 'interactive' or 'bulk'.
+    """
+    if lane not in LANES:
+        raise ValueError(f"Invalid request lane: {lane}! Choose one of {', '.join(LANES)}.")
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def is_retryable(error):
+    """Checks whether a failed request may succeed when sent again."""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def retry_after(error):
+    """
+    Reads the seconds a failed request asks to wait before the next attempt.
+
+    Args:
+        error (Exception): The error of the request.
+
+    Returns:
+        float: The seconds from the Retry-After-Ms or Retry-After header,
+        or None if there is none.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:  # An HTTP date
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    This class is a bucket refilled at a constant rate, e.g. with the
+    requests or tokens per minute of the API.
+
+    Args:
+        per_minute (float): The units added per minute.
+        burst_seconds (float): The seconds of units the bucket holds.
+    """
+
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        """Adds the units accrued since the last refill."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Returns the seconds until `amount` units are available."""
+        self.refill(now)
+        # A request larger than the bucket waits for a full one, then leaves a debt
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        """Takes units, going into debt if there are not enough."""
+        self.level -= amount
+
+    def give(self, amount):
+        """Returns units, e.g. those of a request that was never sent."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class SchedulerStats:
+    """
+    This class counts the requests, queue depth, waits and retries of
+    every lane of a scheduler.
+    """
+
+    def __init__(self):
+        self._lanes = {
+            lane: {
+                "requests": 0,
+                "queued": 0,
+                "max_queued": 0,
+                "wait_seconds": 0.0,
+                "max_wait_seconds": 0.0,
+                "retries": 0,
+                "rate_limited": 0,
+                "failed": 0,
+            }
+            for lane in LANES
+        }
+        self._lock = threading.Lock()
+
+    def enqueued(self, lane):
+        """Records a request joining the queue."""
+        with self._lock:
+            counters = self._lanes[lane]
+            counters["queued"] += 1
+            counters["max_queued"] = max(counters["max_queued"], counters["queued"])
+
+    def dequeued(self, lane, waited=None):
+        """Records a request leaving the queue, sent after `waited` seconds or cancelled."""
+        with self._lock:
+            counters = self._lanes[lane]
+            counters["queued"] -= 1
+            if waited is not None:
+                counters["requests"] += 1
+                counters["wait_seconds"] += waited
+                counters["max_wait_seconds"] = max(counters["max_wait_seconds"], waited)
+
+    def count(self, lane, key):
+        """Increments a counter, i.e. 'retries', 'rate_limited' or 'failed'."""
+        with self._lock:
+            self._lanes[lane][key] += 1
+
+    def as_dict(self):
+        """
+        Returns the counters.
+
+        Returns:
+            dict: Per lane, the requests sent, the current and the largest
+            queue depth, the mean and the longest wait in milliseconds, the
+            retries, the 429 responses and the requests that failed for good.
+        """
+        with self._lock:
+            return {
+                lane: {
+                    "requests": counters["requests"],
+                    "queue_depth": counters["queued"],
+                    "max_queue_depth": counters["max_queued"],
+                    "mean_wait_ms": round(
+                        1000 * counters["wait_seconds"] / (counters["requests"] or 1), 1
+                    ),
+                    "max_wait_ms": round(1000 * counters["max_wait_seconds"], 1),
+                    "retries": counters["retries"],
+                    "rate_limited": counters["rate_limited"],
+                    "failed": counters["failed"],
+                }
+                for lane, counters in self._lanes.items()
+            }
+
+
+class _Ticket:
+    """A request waiting for its turn; `wake` nudges its waiter to check again."""
+
+    def __init__(self, tokens, lane, wake):
+        self.tokens = tokens
+        self.lane = lane
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+
+
+class RequestScheduler:
+    """
+    This class lets requests through in the order of their lanes, first
+    come first served within a lane, as fast as the request and token
+    buckets allow, and retries the failed ones.
+
+    Args:
+        requests_per_minute (int): The requests per minute; 0 is unlimited.
+        tokens_per_minute (int): The prompt and completion tokens per
+            minute; 0 is unlimited.
+        max_retries (int): The attempts after the first one.
+        backoff_base (float): The seconds the first retry waits at most.
+        backoff_max (float): The seconds a retry waits at most, unless a
+            Retry-After header asks for longer.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=0,
+        tokens_per_minute=0,
+        max_retries=6,
+        backoff_base=0.5,
+        backoff_max=30.0,
+    ):
+        self.stats = SchedulerStats()
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self.configure(
+            requests_per_minute, tokens_per_minute, max_retries, backoff_base, backoff_max
+        )
+
+    def configure(
+        self,
+        requests_per_minute=0,
+        tokens_per_minute=0,
+        max_retries=6,
+        backoff_base=0.5,
+        backoff_max=30.0,
+    ):
+        """Applies new limits, keeping the queue and the counters."""
+        with self._lock:
+            self.requests = None
+            if requests_per_minute:
+                self.requests = TokenBucket(requests_per_minute)
+            self.tokens = None
+            if tokens_per_minute:
+                self.tokens = TokenBucket(tokens_per_minute)
+            self.max_retries = max_retries
+            self.backoff_base = backoff_base
+            self.backoff_max = backoff_max
+            self._wake_head()
+
+    def _enqueue(self, tokens, lane, wake):
+        """Adds a request to the queue of its lane."""
+        lane = lane or _lane.get()
+        ticket = _Ticket(tokens, lane, wake)
+        with self._lock:
+            heapq.heappush(
+                self._waiting, (LANES.index(lane), next(self._sequence), ticket)
+            )
+            self.stats.enqueued(lane)
+        return ticket
+
+    def _dispatch(self):
+        """
+        Lets through the requests at the head of the queue that the buckets allow.
+
+        Returns:
+            float: The seconds until the head of the queue may go, or None
+            if the queue is empty.
+        """
+        now = time.monotonic()
+        while self._waiting:
+            ticket = self._waiting[0][2]
+            if ticket.cancelled:
+                heapq.heappop(self._waiting)
+                continue
+            wait = self._paused_until - now
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(ticket.tokens, now))
+            if wait > 0:
+                return wait
+            heapq.heappop(self._waiting)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(ticket.tokens)
+            ticket.granted = True
+            self.stats.dequeued(ticket.lane, now - ticket.enqueued)
+            ticket.wake()
+        return None
+
+    def _wake_head(self):
+        """Nudges the head of the queue, whose wait may have changed."""
+        while self._waiting and self._waiting[0][2].cancelled:
+            heapq.heappop(self._waiting)
+        if self._waiting:
+            self._waiting[0][2].wake()
+
+    def _cancel(self, ticket):
+        """Takes a request out of the queue, e.g. when its task is cancelled."""
+        with self._lock:
+            if ticket.granted:
+                # Never sent: return what it took
+                if self.requests is not None:
+                    self.requests.give(1)
+                if self.tokens is not None:
+                    self.tokens.give(ticket.tokens)
+            else:
+                ticket.cancelled = True
+                self.stats.dequeued(ticket.lane)
+            self._wake_head()
+
+    def acquire(self, tokens=0, lane=None):
+        """
+        Waits until a request may be sent.
+
+        Args:
+            tokens (int): The tokens the request is estimated to use.
+            lane (str): The lane of the request. Default is the lane set
+                with request_lane(), or 'interactive'.
+
+        Returns:
+            _Ticket: The ticket of the request, to be passed to settle().
+        """
+        event = threading.Event()
+        ticket = self._enqueue(tokens, lane, event.set)
+        try:
+            while True:
+                event.clear()
+                with self._lock:
+                    wait = self._dispatch()
+                    if ticket.granted:
+                        return ticket
+                event.wait(wait)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+
+    async def aacquire(self, tokens=0, lane=None):
+        """Waits until a request may be sent, without blocking the loop. See acquire()."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        ticket = self._enqueue(tokens, lane, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                event.clear()
+                with self._lock:
+                    wait = self._dispatch()
+                    if ticket.granted:
+                        return ticket
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._cancel(ticket)
+            raise
+
+    def settle(self, ticket, used_tokens):
+        """
+        Corrects the estimated tokens of a sent request once its usage is known.
+
+        Args:
+            ticket (_Ticket): The ticket of the request.
+            used_tokens (int): The tokens the request used, or None if unknown.
+        """
+        if used_tokens is None or self.tokens is None:
+            return
+        with self._lock:
+            self.tokens.take(used_tokens - ticket.tokens)
+
+    def pause(self, seconds):
+        """Holds back every request for the given seconds, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt, wait=None):
+        """
+        Returns the seconds to wait before a retry.
+
+        Args:
+            attempt (int): The number of the retry, from 0.
+            wait (float): The seconds asked for by a Retry-After header.
+
+        Returns:
+            float: A random delay up to the exponential backoff (full
+            jitter), or the Retry-After wait plus up to `backoff_base`, so
+            the requests held back together do not all come back at once.
+        """
+        if wait is not None:
+            return wait + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _retry_delay(self, error, attempt, lane):
+        """Returns the seconds before retrying a failed request, or None to give up."""
+        if not is_retryable(error) or attempt >= self.max_retries:
+            self.stats.count(lane, "failed")
+            return None
+        wait = retry_after(error)
+        if getattr(error, "status_code", None) == 429:
+            self.stats.count(lane, "rate_limited")
+            if wait is not None:
+                # The limit is shared: hold back the other requests as well
+                self.pause(wait)
+        self.stats.count(lane, "retries")
+        return self.backoff(attempt, wait)
+
+    def call(self, request, tokens=0, lane=None, used_tokens=None):
+        """
+        Sends a request when the limits allow, retrying it if it fails.
+
+        Args:
+            request (callable): Sends the request and returns its response.
+            tokens (int): The tokens the request is estimated to use.
+            lane (str): The lane of the request; see acquire().
+            used_tokens (callable): Returns the tokens a response used, or None.
+
+        Returns:
+            The response.
+        """
+        lane = lane or _lane.get()
+        for attempt in itertools.count():
+            ticket = self.acquire(tokens, lane)
+            try:
+                response = request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, lane)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.settle(ticket, used_tokens(response) if used_tokens else None)
+            return response
+
+    async def acall(self, request, tokens=0, lane=None, used_tokens=None):
+        """Sends a request from a coroutine function. See call()."""
+        lane = lane or _lane.get()
+        for attempt in itertools.count():
+            ticket = await self.aacquire(tokens, lane)
+            try:
+                response = await request()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, lane)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.settle(ticket, used_tokens(response) if used_tokens else None)
+            return response
+
+
+def estimate_tokens(request):
+    """
+    Estimates the tokens of a chat completion or embedding request.
+
+    Args:
+        request (dict): The arguments of the request.
+
+    Returns:
+        int: The prompt tokens, plus the completion tokens of a chat request
+        (max_tokens, or DEFAULT_COMPLETION_TOKENS).
+    """
+    model = request.get("model") or "gpt-3.5-turbo"
+    if "messages" in request:
+        tokens = sum(
+            count_message_tokens(
+                message.get("content") if isinstance(message.get("content"), str) else "",
+                model,
+            )
+            for message in request["messages"]
+        )
+        return tokens + (request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+    inputs = request.get("input") or []
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    # The embedding clients may send token IDs instead of texts
+    return sum(
+        count_tokens(item) if isinstance(item, str) else len(item) for item in inputs
+    )
+
+
+def response_tokens(response):
+    """Returns the tokens a response used, or None for a stream."""
+    return getattr(getattr(response, "usage", None), "total_tokens", None)
+
+
+class ScheduledResource:
+    """
+    This class sends the requests of an OpenAI client resource, e.g.
+    `client.chat.completions` or `client.embeddings`, through a scheduler.
+
+    Args:
+        resource: The resource of a synchronous client.
+        scheduler (RequestScheduler): The scheduler.
+    """
+
+    def __init__(self, resource, scheduler):
+        self.resource = resource
+        self.scheduler = scheduler
+
+    def create(self, **kwargs):
+        """Creates a chat completion or embeddings, streamed or not."""
+        return self.scheduler.call(
+            lambda: self.resource.create(**kwargs),
+            estimate_tokens(kwargs),
+            used_tokens=response_tokens,
+        )
+
+
+class AsyncScheduledResource(ScheduledResource):
+    """This class sends the requests of an asynchronous client resource the same way."""
+
+    async def create(self, **kwargs):
+        """Creates a chat completion or embeddings, streamed or not."""
+        return await self.scheduler.acall(
+            lambda: self.resource.create(**kwargs),
+            estimate_tokens(kwargs),
+            used_tokens=response_tokens,
+        )
+
+
+def schedule_clients(model, scheduler):
+    """
+    Sends the requests of ChatOpenAI or OpenAIEmbeddings through a scheduler.
+
+    The model should be created with max_retries=0, so that the retries
+    are left to the scheduler.
+
+    Args:
+        model: The ChatOpenAI or OpenAIEmbeddings.
+        scheduler (RequestScheduler): The scheduler.
+
+    Returns:
+        The model.
+    """
+    model.client = ScheduledResource(model.client, scheduler)
+    model.async_client = AsyncScheduledResource(model.async_client, scheduler)
+    return model
+
+
+class LaneEmbeddings(Embeddings):
+    """
+    This class sends the requests of an embedding function through a lane
+    of the schedulers, e.g. those of an ingestion through the bulk lane.
+
+    Args:
+        embeddings (Embeddings): The embedding function.
+        lane (str): The lane.
+    """
+
+    def __init__(self, embeddings, lane="bulk"):
+        self.embeddings = embeddings
+        self.lane = lane
+
+    def embed_documents(self, texts):
+        """Embed search docs."""
+        with request_lane(self.lane):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        """Embed query text."""
+        with request_lane(self.lane):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        """Asynchronous Embed search docs."""
+        with request_lane(self.lane):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        """Asynchronous Embed query text."""
+        with request_lane(self.lane):
+            return await self.embeddings.aembed_query(text)
@@ -0,0 +1,510 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0703
+"""
+This module serves the LLM retrieval pipeline over HTTP, without the GUI.
+
+One warm LLM, and thus one Chroma handle, is shared by all requests. At most
+SERVER_MAX_CONCURRENCY questions are answered at once; the others wait up to
+SERVER_QUEUE_TIMEOUT seconds for a slot before they are refused with 503.
+
+    python server.py --port 8000
+
+Endpoints:
+    POST   /ask             {"question": "...", "mode": "rag", "where": {...}}
+    POST   /ask/stream      Same body, answers as newline-delimited JSON events
+    POST   /ingest          {"source_path": "data/corpus"}
+    GET    /ingest/{id}     The progress of an ingestion job
+    DELETE /ingest/{id}     Cancels an ingestion job
+    GET    /stats           The vector store and server statistics
+"""
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import collections
+from aiohttp import web
+from src.config import config_store
+from src.ingest_job import IngestJob
+from src.llm import LLM, ANSWER_MODES
+
+# The number of request timings kept per endpoint for the statistics
+TIMING_WINDOW = 1000
+
+
+class RequestStats:
+    """
+    This class keeps the request counters and recent timings of the server.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = collections.Counter()
+        self.failures = collections.Counter()
+        self.rejected = 0
+        self.timings = collections.defaultdict(
+            lambda: collections.deque(maxlen=TIMING_WINDOW)
+        )
+
+    def record(self, endpoint, status, seconds):
+        """Records a finished request."""
+        self.requests[endpoint] += 1
+        if status >= 500:
+            self.failures[endpoint] += 1
+        self.timings[endpoint].append(seconds)
+
+    def as_dict(self):
+        """
+        Returns the statistics.
+
+        Returns:
+            dict: The counters and the latency percentiles per endpoint.
+        """
+        endpoints = {}
+        for endpoint, timings in self.timings.items():
+            ordered = sorted(timings)
+            endpoints[endpoint] = {
+                "requests": self.requests[endpoint],
+                "failures": self.failures[endpoint],
+                "mean_ms": round(1000 * sum(ordered) / len(ordered), 1),
+                "p50_ms": round(1000 * percentile(ordered, 50), 1),
+                "p95_ms": round(1000 * percentile(ordered, 95), 1),
+            }
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "endpoints": endpoints,
+        }
+
+
+def percentile(ordered, q):
+    """
+    Returns a percentile of sorted values by linear interpolation.
+
+    Args:
+        ordered (list): The sorted values.
+        q (float): The percentile, from 0 to 100.
+
+    Returns:
+        float: The percentile, or 0.0 if there are no values.
+    """
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def endpoint_name(request):
+    """Returns the route of a request, e.g. 'GET /ingest/{job_id}'."""
+    resource = request.match_info.route.resource
+    path = resource.canonical if resource is not None else request.path
+    return f"{request.method} {path}"
+
+
+@web.middleware
+async def timing_middleware(request, handler):
+    """Times every request and reports it in the Server-Timing header."""
+    started = time.perf_counter()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        request.app["stats"].record(
+            endpoint_name(request), e.status, time.perf_counter() - started
+        )
+        raise
+    except Exception:
+        request.app["stats"].record(
+            endpoint_name(request), 500, time.perf_counter() - started
+        )
+        raise
+    seconds = time.perf_counter() - started
+    request.app["stats"].record(endpoint_name(request), response.status, seconds)
+    # Streamed responses have sent their headers already
+    if not response.prepared:
+        timing = f"total;dur={1000 * seconds:.1f}"
+        if "queue_seconds" in request:
+            timing = f"queue;dur={1000 * request['queue_seconds']:.1f}, " + timing
+        response.headers["Server-Timing"] = timing
+    return response
+
+
+class AnswerSlot:
+    """
+    This class holds one of the concurrent answer slots of the server for a
+    request, waiting up to the queue timeout for it.
+
+    Args:
+        request (web.Request): The request answered in the slot.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.app = request.app
+
+    async def __aenter__(self):
+        stats = self.app["stats"]
+        started = time.perf_counter()
+        stats.waiting += 1
+        try:
+            await asyncio.wait_for(
+                self.app["slots"].acquire(), self.app["queue_timeout"]
+            )
+        except asyncio.TimeoutError:
+            stats.rejected += 1
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({"error": "The server is busy, try again later."}),
+                content_type="application/json",
+                headers={"Retry-After": "1"},
+            ) from None
+        finally:
+            stats.waiting -= 1
+        self.request["queue_seconds"] = time.perf_counter() - started
+        stats.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.app["stats"].in_flight -= 1
+        self.app["slots"].release()
+
+
+def json_error(status, message):
+    """Returns a JSON error response."""
+    return web.json_response({"error": message}, status=status)
+
+
+async def read_question(request):
+    """
+    Reads and validates the body of an ask request.
+
+    Returns:
+        tuple: The question, the RAG mode and the metadata filter.
+
+    Raises:
+        web.HTTPBadRequest: If the body is invalid.
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": "The body must be JSON."}),
+            content_type="application/json",
+        ) from None
+    body = body if isinstance(body, dict) else {}
+    question = body.get("question")
+    mode = ANSWER_MODES.get(str(body.get("mode", "rag")))
+    where = body.get("where") or None
+    if not isinstance(question, str) or not question.strip() or mode is None or (
+        where is not None and not isinstance(where, dict)
+    ):
+        raise web.HTTPBadRequest(
+            text=json.dumps(
+                {
+                    "error": "Expected {'question': str, 'mode': 'rag'|'pure'|'both',"
+                    " 'where': dict}."
+                }
+            ),
+            content_type="application/json",
+        )
+    return question, mode, where
+
+
+def failure_status(error):
+    """Returns the HTTP status of a failed LLM request."""
+    return 504 if isinstance(error, asyncio.TimeoutError) else 502
+
+
+def describe_error(error, llm):
+    """Returns a message describing a failed LLM request."""
+    if isinstance(error, asyncio.TimeoutError):
+        return f"No answer within {llm.branch_timeout} seconds."
+    return f"{type(error).__name__}: {error}"
+
+
+async def handle_ask(request):
+    """Answers a question with the RAG, pure or both branches."""
+    question, mode, where = await read_question(request)
+    llm = request.app["llm"]
+    answer = {"rag": "", "pure": ""}
+    usage = {}
+    errors = {}
+    async with AnswerSlot(request):
+        started = time.perf_counter()
+        async for branch, text, branch_usage, error in llm.iter_answers_async(
+            question, mode, where
+        ):
+            if error is not None:
+                errors[branch] = error
+                continue
+            answer[branch] = text
+            usage[branch] = branch_usage
+        seconds = time.perf_counter() - started
+
+    if errors and not usage:
+        error = next(iter(errors.values()))
+        return json_error(failure_status(error), describe_error(error, llm))
+    return web.json_response(
+        {
+            "answer": answer,
+            "usage": usage,
+            "cost": sum(llm.calculate_cost(item) for item in usage.values()),
+            "errors": {
+                branch: describe_error(error, llm) for branch, error in errors.items()
+            },
+            "timing": {
+                "queue_ms": round(1000 * request["queue_seconds"], 1),
+                "answer_ms": round(1000 * seconds, 1),
+            },
+        }
+    )
+
+
+async def handle_ask_stream(request):
+    """
+    Streams the answer to a question as newline-delimited JSON events:
+    {"branch", "token"} for every piece, then a final {"done": true} event
+    with the usage, or {"error"} if a branch failed.
+    """
+    question, mode, where = await read_question(request)
+    llm = request.app["llm"]
+    async with AnswerSlot(request):
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "application/x-ndjson",
+                "Cache-Control": "no-cache",
+                "Server-Timing": f"queue;dur={1000 * request['queue_seconds']:.1f}",
+            }
+        )
+        await response.prepare(request)
+        started = time.perf_counter()
+        first_token = None
+        usage = {}
+        final = {"done": True}
+        try:
+            async for branch, token in llm.stream_answer_async(
+                question, mode, usage, where
+            ):
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                line = json.dumps({"branch": branch, "token": token}, ensure_ascii=False)
+                await response.write(line.encode("utf-8") + b"\n")
+        except ConnectionResetError:
+            # The client went away; stop generating its answer
+            raise
+        except Exception as e:
+            final = {"done": True, "error": describe_error(e, llm)}
+        final.update(
+            usage=usage,
+            cost=sum(llm.calculate_cost(item) for item in usage.values()),
+            timing={
+                "queue_ms": round(1000 * request["queue_seconds"], 1),
+                "first_token_ms": (
+                    round(1000 * first_token, 1) if first_token is not None else None
+                ),
+                "answer_ms": round(1000 * (time.perf_counter() - started), 1),
+            },
+        )
+        await response.write(json.dumps(final).encode("utf-8") + b"\n")
+        await response.write_eof()
+    return response
+
+
+async def handle_ingest(request):
+    """Starts ingesting a source file or folder into the vector store."""
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return json_error(400, "The body must be JSON.")
+    source_path = body.get("source_path") if isinstance(body, dict) else None
+    if not isinstance(source_path, str) or not source_path:
+        return json_error(400, "Expected {'source_path': str}.")
+
+    app = request.app
+    running = [job for job in app["jobs"].values() if not job.done]
+    if running:
+        return json_error(409, "An ingestion is already running.")
+    try:
+        file_paths = app["llm"].collect_source_files(source_path)
+    except ValueError as e:
+        return json_error(400, str(e))
+
+    job_id, job = start_job(app, file_paths)
+    return web.json_response(
+        {"id": job_id, "files": len(file_paths), "progress": job.progress()},
+        status=202,
+    )
+
+
+def start_job(app, file_paths):
+    """
+    Starts an ingestion job.
+
+    Returns:
+        tuple: The ID of the job and the job.
+    """
+    job_id = str(next(app["job_ids"]))
+    job = IngestJob(app["llm"], file_paths).start()
+    app["jobs"][job_id] = job
+    app["job_tasks"].add(asyncio.ensure_future(finish_job(job)))
+    return job_id, job
+
+
+async def finish_job(job):
+    """Waits for a job in a worker thread, then records its sources on the loop."""
+    await asyncio.get_running_loop().run_in_executor(None, job.wait)
+    if job.error is None:
+        job.finish()
+
+
+def job_status(job_id, job):
+    """Returns the state of an ingestion job."""
+    status = "running"
+    if job.done:
+        status = "failed" if job.error is not None else "done"
+    return {
+        "id": job_id,
+        "status": status,
+        "error": str(job.error) if job.error is not None else None,
+        "progress": job.progress(),
+    }
+
+
+async def handle_ingest_status(request):
+    """Returns the progress of an ingestion job."""
+    job_id = request.match_info["job_id"]
+    job = request.app["jobs"].get(job_id)
+    if job is None:
+        return json_error(404, f"No ingestion job {job_id}.")
+    return web.json_response(job_status(job_id, job))
+
+
+async def handle_ingest_cancel(request):
+    """Cancels an ingestion job; chunks already embedded are still written."""
+    job_id = request.match_info["job_id"]
+    job = request.app["jobs"].get(job_id)
+    if job is None:
+        return json_error(404, f"No ingestion job {job_id}.")
+    job.cancel()
+    return web.json_response(job_status(job_id, job))
+
+
+async def handle_stats(request):
+    """Returns the vector store and server statistics."""
+    app = request.app
+    llm = app["llm"]
+    # pylint: disable=W0212
+    chunks = await asyncio.get_running_loop().run_in_executor(
+        None, llm.stored_vectors._collection.count
+    )
+    store = {
+        "chunks": chunks,
+        "files": len(llm.manifest.entries),
+        "knowledge_sources": config_store.get_list("KNOWLEDGE_SOURCES"),
+        "version": llm.vectorstore_version,
+    }
+    if llm.embedding_cache is not None:
+        store["embedding_cache"] = llm.embedding_cache.stats()
+    return web.json_response(
+        {
+            "model": llm.base_model,
+            "store": store,
+            "retriever": llm.retriever_stats.as_dict(),
+            "context_packer": llm.packer_stats.as_dict(),
+            "scheduler": {
+                kind: scheduler.stats.as_dict() for kind, scheduler in llm.schedulers.items()
+            },
+            "http": llm.http_clients.stats.as_dict(),
+            "server": dict(
+                app["stats"].as_dict(), max_concurrency=app["max_concurrency"]
+            ),
+        }
+    )
+
+
+async def load_llm(app):
+    """Builds the shared LLM once, off the event loop, if none was given."""
+    if app["llm"] is None:
+        app["llm"] = await asyncio.get_running_loop().run_in_executor(None, LLM)
+    # A new vector store is seeded with the sample corpus in the background
+    file_paths = app["llm"].take_sample_corpus()
+    if file_paths:
+        start_job(app, file_paths)
+
+
+async def cancel_jobs(app):
+    """Cancels the running ingestion jobs on shutdown."""
+    for job in app["jobs"].values():
+        if not job.done:
+            job.cancel()
+    if app["job_tasks"]:
+        await asyncio.gather(*app["job_tasks"], return_exceptions=True)
+
+
+def create_app(llm=None, max_concurrency=None, queue_timeout=None):
+    """
+    Creates the HTTP application.
+
+    Args:
+        llm (LLM): The LLM shared by all requests. Default builds one on startup.
+        max_concurrency (int): The maximum number of questions answered at once.
+            Default is SERVER_MAX_CONCURRENCY.
+        queue_timeout (float): The maximum number of seconds a question waits
+            for a slot. Default is SERVER_QUEUE_TIMEOUT.
+
+    Returns:
+        web.Application: The application.
+    """
+    max_concurrency = max_concurrency or config_store.get_int(
+        "SERVER_MAX_CONCURRENCY", 8
+    )
+    app = web.Application(middlewares=[timing_middleware])
+    app["llm"] = llm
+    app["max_concurrency"] = max_concurrency
+    app["queue_timeout"] = (
+        queue_timeout
+        if queue_timeout is not None
+        else config_store.get_float("SERVER_QUEUE_TIMEOUT", 30)
+    )
+    app["slots"] = asyncio.Semaphore(max_concurrency)
+    app["stats"] = RequestStats()
+    app["jobs"] = {}
+    app["job_ids"] = itertools.count(1)
+    app["job_tasks"] = set()
+    app.on_startup.append(load_llm)
+    app.on_shutdown.append(cancel_jobs)
+    app.router.add_post("/ask", handle_ask)
+    app.router.add_post("/ask/stream", handle_ask_stream)
+    app.router.add_post("/ingest", handle_ingest)
+    app.router.add_get("/ingest/{job_id}", handle_ingest_status)
+    app.router.add_delete("/ingest/{job_id}", handle_ingest_cancel)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+def main(argv=None):
+    """Runs the HTTP server."""
+    parser = argparse.ArgumentParser(description="Serve DST-GPT over HTTP.")
+    parser.add_argument(
+        "--host", default=config_store.get_str("SERVER_HOST", "127.0.0.1")
+    )
+    parser.add_argument(
+        "--port", type=int, default=config_store.get_int("SERVER_PORT", 8000)
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="The maximum number of questions answered at once.",
+    )
+    args = parser.parse_args(argv)
+    web.run_app(
+        create_app(max_concurrency=args.max_concurrency), host=args.host, port=args.port
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides the lazy startup of the application.
+
+The window is shown before the heavy modules (langchain, openai, chromadb)
+are imported. LLMLoader imports them and builds the LLM in a background
+thread, and every phase is timed by the startup timer:
+
+    python main.py
+    Startup timing (3.41 s to ready):
+      import gui              0.21 s
+      window                  0.08 s
+      import llm              2.37 s
+      ...
+"""
+import time
+import threading
+import contextlib
+
+# The time the process started importing the application
+_START = time.perf_counter()
+
+
+class StartupTimer:
+    """
+    This class records the duration of the startup phases.
+
+    Phases may run on different threads; they are reported in the order
+    they started.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.ready_at = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times a startup phase.
+
+        Args:
+            name (str): The name of the phase, e.g. 'import llm'.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, started - _START, time.perf_counter() - started))
+
+    def mark_ready(self):
+        """Records that the application is ready to answer questions."""
+        self.ready_at = time.perf_counter() - _START
+
+    def as_dict(self):
+        """
+        Returns the timings.
+
+        Returns:
+            dict: The seconds to ready and the (name, start, seconds) of each phase.
+        """
+        with self._lock:
+            phases = sorted(self.phases, key=lambda item: item[1])
+        return {
+            "ready_seconds": self.ready_at,
+            "phases": [
+                {"name": name, "start": round(start, 3), "seconds": round(seconds, 3)}
+                for name, start, seconds in phases
+            ],
+        }
+
+    def report(self):
+        """
+        Formats the timings as a table.
+
+        Returns:
+            str: One line per phase, after the total time to ready.
+        """
+        timings = self.as_dict()
+        ready = timings["ready_seconds"]
+        lines = [
+            f"Startup timing ({ready:.2f} s to ready):"
+            if ready is not None
+            else "Startup timing (not ready yet):"
+        ]
+        for phase in timings["phases"]:
+            lines.append(f"  {phase['name']:<22}{phase['seconds']:>6.2f} s")
+        return "\n".join(lines)
+
+
+# Global instance of StartupTimer shared by the startup phases
+startup_timer = StartupTimer()
+
+
+class LLMLoader:
+    """
+    This class imports the LLM module and builds the LLM in a background
+    thread, so that the window responds while the models and the vector
+    store are loaded. The GUI thread polls `done` and then takes `llm`.
+    """
+
+    def __init__(self):
+        self.llm = None
+        self.error = None
+        self._thread = None
+
+    @property
+    def done(self):
+        """bool: Whether loading has ended, successfully or not."""
+        return self._thread is not None and not self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts loading in a daemon thread.
+
+        Returns:
+            LLMLoader: The loader itself.
+        """
+        self._thread = threading.Thread(target=self._run, name="llm-loader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        """Imports the LLM module and builds the LLM, keeping the error if any."""
+        try:
+            with startup_timer.phase("import llm"):
+                # pylint: disable=C0415
+                from src.llm import LLM
+            self.llm = LLM()
+        except Exception as e:  # pylint: disable=W0703
+            self.error = e
+
+    def wait(self, timeout=None):
+        """
+        Waits for loading to end.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            bool: Whether loading has ended.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
@@ -0,0 +1,111 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903
+"""
+This module provides functionality for counting model tokens.
+"""
+import re
+import functools
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken ships with langchain-openai, but stay usable without it
+    tiktoken = None
+
+_encoding_lock = threading.Lock()
+
+# CJK characters and punctuation are roughly one token each in OpenAI tokenizers
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name):
+    """
+    Get the tiktoken encoding used by the given model.
+
+    Args:
+        model_name (str): The name of the model, e.g. 'gpt-3.5-turbo-0125'.
+
+    Returns:
+        Encoding: The tiktoken encoding, or None if tiktoken is not installed
+        or its encoding files cannot be downloaded.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        with _encoding_lock:
+            try:
+                return tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Failed to load tiktoken encoding, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text, model_name="gpt-3.5-turbo"):
+    """
+    Count the number of model tokens in the given text.
+
+    Args:
+        text (str): The text to be counted.
+        model_name (str): The name of the model whose tokenizer is used.
+
+    Returns:
+        int: The number of tokens, estimated as 4 characters or 1 CJK
+        character per token when tiktoken is not available.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        cjk = len(_CJK_PATTERN.findall(text))
+        return max(1, cjk + (len(text) - cjk) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(text, model_name="gpt-3.5-turbo"):
+    """
+    Count the prompt tokens of a single chat message, including the tokens
+    the chat format adds for the message and for priming the reply.
+
+    Args:
+        text (str): The content of the message.
+        model_name (str): The name of the model whose tokenizer is used.
+
+    Returns:
+        int: The number of prompt tokens.
+    """
+    # 3 tokens per message, 1 for the role and 3 priming the assistant reply
+    return count_tokens(text, model_name) + 7
+
+
+# The context windows of the chat models, longest name prefix first
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-3.5-turbo-instruct", 4096),
+    ("gpt-3.5-turbo-0301", 4096),
+    ("gpt-3.5-turbo-0613", 4096),
+    ("gpt-3.5-turbo", 16385),
+    ("gpt-4-32k", 32768),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-1106", 128000),
+    ("gpt-4-0125", 128000),
+    ("gpt-4o", 128000),
+    ("gpt-4", 8192),
+]
+
+
+def context_window(model_name, default=4096):
+    """
+    Look up the number of tokens that fit into the context of a chat model.
+
+    Args:
+        model_name (str): The name of the model, e.g. 'gpt-3.5-turbo-0125'.
+        default (int): The context window of unknown models.
+
+    Returns:
+        int: The context window in tokens, shared by the prompt and the answer.
+    """
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if (model_name or "").startswith(prefix):
+            return window
+    return default
@@ -0,0 +1,1204 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,R0913,W0212
+"""
+This module provides the vector store backends behind LLM.init_vectorstore.
+
+Besides Chroma, three local backends keep the chunks in a SQLite file of
+their own and search them with an index: 'hnsw', an approximate hnswlib
+graph with tunable M, ef_construction and ef, 'numpy', an exact search
+over a float32 matrix for small stores, and 'mmap', a scan of bfloat16
+or int8 vectors in memory-mapped files shared by all processes of a host,
+rescored with the float32 vectors. They implement the part of the Chroma
+collection API the pipeline uses (get, query, upsert, update, delete and
+count with metadata filters), so the retriever, the ingestor and the
+keyword index work with any backend.
+
+Existing Chroma stores are migrated without embedding the chunks again:
+
+    python -m src.vector_backends database --backend hnsw
+"""
+import os
+import sys
+import json
+import uuid
+import atexit
+import shutil
+import sqlite3
+import argparse
+import threading
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from src.embeddings import EMBEDDINGS_FILENAME
+from src.lexical_index import LEXICAL_INDEX_FILENAME
+from src.manifest import MANIFEST_FILENAME
+
+try:
+    import hnswlib
+except ImportError:  # hnswlib ships with chromadb as chroma-hnswlib
+    hnswlib = None
+
+VECTOR_BACKENDS = ["chroma", "hnsw", "numpy", "mmap"]
+
+# The file holding the chunks of each backend; the local backends share theirs
+VECTORSTORE_FILENAMES = {
+    "chroma": "chroma.sqlite3",
+    "hnsw": "vectors.sqlite3",
+    "numpy": "vectors.sqlite3",
+    "mmap": "vectors.sqlite3",
+}
+
+HNSW_INDEX_FILENAME = "hnsw.bin"
+
+MMAP_DTYPES = ["bfloat16", "int8"]
+
+# The files the indexes of the local backends are saved in
+INDEX_FILENAMES = [HNSW_INDEX_FILENAME] + [
+    f"mmap_{dtype}_{part}.npy"
+    for dtype in MMAP_DTYPES
+    for part in ("vectors", "labels", "norms", "scales")
+]
+
+_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def vectorstore_filepath(vectorstore_directory, backend="chroma"):
+    """
+    Returns the path of the file holding the chunks of a vector store.
+
+    Args:
+        vectorstore_directory (str): The directory of the vector store.
+        backend (str): The backend, 'chroma', 'hnsw' or 'numpy'.
+
+    Returns:
+        str: The path of the file.
+    """
+    if backend not in VECTORSTORE_FILENAMES:
+        raise ValueError(f"Invalid vector store backend: {backend}")
+    return os.path.join(vectorstore_directory, VECTORSTORE_FILENAMES[backend])
+
+
+def where_clause(where):
+    """
+    Translates a Chroma metadata filter into SQL over the JSON metadata.
+
+    Args:
+        where (dict): The filter, e.g. {"source_path": {"$in": ["a.md"]}},
+            with $and, $or, $eq, $ne, $gt, $gte, $lt, $lte, $in and $nin.
+
+    Returns:
+        str: The SQL condition.
+        list: The parameters of the condition.
+    """
+    clauses = []
+    params = []
+    for key, condition in (where or {}).items():
+        if key in ("$and", "$or"):
+            parts = [where_clause(part) for part in condition]
+            joined = f" {key[1:].upper()} ".join(f"({sql})" for sql, _ in parts)
+            clauses.append(f"({joined})" if parts else "1")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        path = '$."' + key.replace('"', '\\"') + '"'
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, value in condition.items():
+            if operator in ("$in", "$nin"):
+                negation = "NOT " if operator == "$nin" else ""
+                clauses.append(
+                    f"json_extract(metadata, ?) {negation}IN ({', '.join('?' * len(value))})"
+                )
+                params.extend([path, *value])
+            elif operator in _OPERATORS:
+                clauses.append(f"json_extract(metadata, ?) {_OPERATORS[operator]} ?")
+                params.extend([path, value])
+            else:
+                raise ValueError(f"Unsupported filter operator: {operator}")
+    return " AND ".join(clauses) or "1", params
+
+
+class NumpyIndex:
+    """
+    This class searches vectors exactly, by squared euclidean distance,
+    in a float32 matrix that grows by doubling its capacity.
+    """
+
+    def __init__(self):
+        self._matrix = None
+        self._norms = None
+        self._labels = None
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, labels, vectors):
+        """Adds vectors, replacing those with the same labels."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self._matrix is None:
+            capacity = max(1024, len(labels))
+            self._matrix = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            self._norms = np.empty(capacity, dtype=np.float32)
+            self._labels = np.empty(capacity, dtype=np.int64)
+        needed = len(self._rows) + len(labels)
+        if needed > len(self._matrix):
+            capacity = max(needed, 2 * len(self._matrix))
+            size = len(self._rows)
+            for name in ("_matrix", "_norms", "_labels"):
+                old = getattr(self, name)
+                new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:size] = old[:size]
+                setattr(self, name, new)
+        for label, vector in zip(labels, vectors):
+            row = self._rows.get(label)
+            if row is None:
+                row = len(self._rows)
+                self._rows[label] = row
+                self._labels[row] = label
+            self._matrix[row] = vector
+            self._norms[row] = vector @ vector
+
+    def remove(self, labels):
+        """Removes vectors, moving the last row into each freed row."""
+        for label in labels:
+            row = self._rows.pop(label, None)
+            if row is None:
+                continue
+            last = len(self._rows)
+            if row != last:
+                moved = int(self._labels[last])
+                self._matrix[row] = self._matrix[last]
+                self._norms[row] = self._norms[last]
+                self._labels[row] = moved
+                self._rows[moved] = row
+
+    def search(self, vector, k, allowed=None):
+        """
+        Finds the nearest vectors.
+
+        Args:
+            vector (list): The query vector.
+            k (int): The number of neighbours.
+            allowed (list): The labels to search among, or None for all.
+
+        Returns:
+            list: The labels of the neighbours, nearest first.
+            list: Their squared euclidean distances.
+        """
+        if not self._rows:
+            return [], []
+        query = np.asarray(vector, dtype=np.float32)
+        if allowed is None:
+            rows = slice(0, len(self._rows))
+        else:
+            rows = np.fromiter(
+                (self._rows[label] for label in allowed if label in self._rows),
+                dtype=np.int64,
+            )
+        distances = self._norms[rows] - 2 * (self._matrix[rows] @ query) + query @ query
+        k = min(k, len(distances))
+        if k <= 0:
+            return [], []
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        labels = self._labels[rows][nearest]
+        return labels.tolist(), np.maximum(distances[nearest], 0.0).tolist()
+
+
+class HnswIndex:
+    """
+    This class searches vectors approximately in an hnswlib graph, by
+    squared euclidean distance, and saves the graph next to the chunks.
+
+    Args:
+        index_filepath (str): The path of the saved graph.
+        M (int): The number of links per node; more is more accurate and larger.
+        ef_construction (int): The candidate list size while building.
+        ef (int): The candidate list size while searching; more is more
+            accurate and slower.
+    """
+
+    def __init__(self, index_filepath, M=16, ef_construction=200, ef=64):
+        if hnswlib is None:
+            raise ImportError("The 'hnsw' vector store backend requires hnswlib.")
+        self.index_filepath = index_filepath
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.generation_key = "index_generation"
+        self._index = None
+        self._labels = set()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def _create(self, dimension, capacity):
+        self._index = hnswlib.Index(space="l2", dim=dimension)
+        self._index.init_index(
+            max_elements=capacity,
+            M=self.M,
+            ef_construction=self.ef_construction,
+            allow_replace_deleted=True,
+        )
+
+    def load(self, dimension, labels):
+        """
+        Loads the saved graph.
+
+        Args:
+            dimension (int): The number of dimensions of the vectors.
+            labels (list): The labels of the vectors the graph holds.
+
+        Returns:
+            bool: Whether the graph was loaded; False if it has to be rebuilt,
+            e.g. because it was built with other settings.
+        """
+        if not os.path.exists(self.index_filepath):
+            return False
+        index = hnswlib.Index(space="l2", dim=dimension)
+        try:
+            index.load_index(self.index_filepath, allow_replace_deleted=True)
+        except RuntimeError:
+            return False
+        if index.M != self.M or index.ef_construction != self.ef_construction:
+            return False
+        self._index = index
+        self._labels = set(labels)
+        return True
+
+    def save(self):
+        """Saves the graph."""
+        if self._index is not None:
+            self._index.save_index(self.index_filepath)
+
+    def add(self, labels, vectors):
+        """Adds vectors, replacing those with the same labels."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self._index is None:
+            self._create(vectors.shape[1], max(1024, len(labels)))
+        needed = self._index.element_count + len(labels)
+        if needed > self._index.max_elements:
+            self._index.resize_index(max(needed, 2 * self._index.max_elements))
+        self._index.add_items(vectors, labels, replace_deleted=True)
+        self._labels.update(labels)
+
+    def remove(self, labels):
+        """Removes vectors."""
+        for label in labels:
+            if label in self._labels:
+                self._index.mark_deleted(label)
+                self._labels.discard(label)
+
+    def search(self, vector, k, allowed=None):
+        """
+        Finds the nearest vectors, exactly among few allowed ones.
+
+        Args:
+            vector (list): The query vector.
+            k (int): The number of neighbours.
+            allowed (list): The labels to search among, or None for all.
+
+        Returns:
+            list: The labels of the neighbours, nearest first.
+            list: Their squared euclidean distances.
+        """
+        candidates = self._labels if allowed is None else self._labels.intersection(allowed)
+        k = min(k, len(candidates))
+        if k <= 0:
+            return [], []
+        query = np.asarray(vector, dtype=np.float32)
+        if allowed is not None and len(candidates) <= max(1000, 10 * k):
+            return self._exact_search(query, k, list(candidates))
+        self._index.set_ef(max(self.ef, k))
+        try:
+            labels, distances = self._index.knn_query(
+                query,
+                k=k,
+                filter=None if allowed is None else candidates.__contains__,
+            )
+        except RuntimeError:
+            # Too few neighbours were reachable, e.g. after many deletions
+            return self._exact_search(query, k, list(candidates))
+        return labels[0].tolist(), distances[0].tolist()
+
+    def _exact_search(self, query, k, labels):
+        """Finds the nearest of the given vectors by brute force."""
+        vectors = np.asarray(self._index.get_items(labels), dtype=np.float32)
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        nearest = np.argsort(distances)[:k]
+        return [labels[i] for i in nearest], distances[nearest].tolist()
+
+
+class MmapIndex:
+    """
+    This class searches compact bfloat16 or int8 copies of the vectors in
+    read-only memory-mapped files, which the processes of a host share
+    through the page cache instead of each holding a float32 matrix.
+
+    bfloat16 keeps the upper half of each float32, so it is widened by a
+    shift, where NumPy converts IEEE float16 several times slower than it
+    scans the rows. The int8 codes are quantized per dimension between the
+    smallest and the largest stored value. The distances of either type are
+    approximate, so
+    the collection rescores `rescore` times as many candidates as it returns
+    with the float32 vectors in SQLite. Vectors written since the files were
+    built are kept in memory and searched exactly until the next build.
+
+    Args:
+        directory (str): The directory of the files.
+        dtype (str): The compact type, 'bfloat16' or 'int8'.
+        rescore (int): The candidates rescored per returned vector.
+        block_rows (int): The number of rows scored at once; small blocks
+            stay in the CPU cache while they are widened and scored.
+    """
+
+    def __init__(self, directory, dtype="int8", rescore=4, block_rows=256):
+        if dtype not in MMAP_DTYPES:
+            raise ValueError(f"Invalid memory-mapped vector type: {dtype}")
+        self.directory = directory
+        self.dtype = dtype
+        self.rescore = max(1, rescore)
+        self.block_rows = block_rows
+        self.generation_key = f"{dtype}_generation"
+        self._vectors = None
+        self._labels = np.empty(0, dtype=np.int64)
+        self._norms = None
+        self._scales = None
+        self._masked = np.zeros(0, dtype=bool)
+        # The vectors written since the files were built
+        self._delta = NumpyIndex()
+
+    def __len__(self):
+        return int(len(self._labels) - self._masked.sum()) + len(self._delta)
+
+    @property
+    def parts(self):
+        """The names of the files of the index."""
+        return ["vectors", "labels", "norms"] + (["scales"] if self.dtype == "int8" else [])
+
+    def filepath(self, part):
+        """Returns the path of a file of the index."""
+        return os.path.join(self.directory, f"mmap_{self.dtype}_{part}.npy")
+
+    def _map(self):
+        """Maps the files, dropping the vectors kept in memory."""
+        mapped = {part: np.load(self.filepath(part), mmap_mode="r") for part in self.parts}
+        self._vectors = mapped["vectors"]
+        self._labels = np.asarray(mapped["labels"])
+        self._norms = mapped["norms"]
+        self._scales = np.asarray(mapped["scales"]) if "scales" in mapped else None
+        self._masked = np.zeros(len(self._labels), dtype=bool)
+        self._delta = NumpyIndex()
+
+    def load(self, dimension, labels):
+        """
+        Maps the built files.
+
+        Args:
+            dimension (int): The number of dimensions of the vectors.
+            labels (list): The labels of the stored vectors.
+
+        Returns:
+            bool: Whether the files hold exactly these vectors.
+        """
+        if not all(os.path.exists(self.filepath(part)) for part in self.parts):
+            return False
+        try:
+            self._map()
+        except (OSError, ValueError):
+            return False
+        if self._vectors.shape[1:] != (dimension,) or not np.array_equal(
+            self._labels, np.sort(np.asarray(labels, dtype=np.int64))
+        ):
+            self._vectors = None
+            self._labels = np.empty(0, dtype=np.int64)
+            self._masked = np.zeros(0, dtype=bool)
+            return False
+        return True
+
+    def build(self, dimension, count, batches):
+        """
+        Writes the files from the stored vectors and maps them.
+
+        Args:
+            dimension (int): The number of dimensions of the vectors.
+            count (int): The number of vectors.
+            batches (callable): Returns an iterator of (labels, vectors)
+                batches in label order; it is called twice for int8.
+
+        Returns:
+            bool: Whether the files were replaced; they are not while
+            another process maps them on Windows.
+        """
+        scales = None
+        if self.dtype == "int8":
+            low = np.full(dimension, np.inf, dtype=np.float32)
+            high = np.full(dimension, -np.inf, dtype=np.float32)
+            for _, vectors in batches():
+                low = np.minimum(low, vectors.min(axis=0))
+                high = np.maximum(high, vectors.max(axis=0))
+            # The value of code -128 and the step between codes, per dimension
+            scales = np.stack([low, np.maximum(high - low, 1e-12) / 255]).astype(np.float32)
+
+        written = {
+            part: np.lib.format.open_memmap(
+                self.filepath(part) + ".tmp", mode="w+", dtype=dtype, shape=shape
+            )
+            for part, dtype, shape in (
+                ("vectors", np.int8 if scales is not None else np.uint16, (count, dimension)),
+                ("labels", np.int64, (count,)),
+                ("norms", np.float32, (count,)),
+            )
+        }
+        row = 0
+        for labels, vectors in batches():
+            rows = slice(row, row + len(labels))
+            if scales is None:
+                # Round the upper half of each float32 to the nearest, ties to even
+                bits = vectors.view(np.uint32)
+                written["vectors"][rows] = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+            else:
+                codes = np.rint((vectors - scales[0]) / scales[1]) - 128
+                written["vectors"][rows] = np.clip(codes, -128, 127)
+            written["labels"][rows] = labels
+            written["norms"][rows] = (vectors * vectors).sum(axis=1)
+            row += len(labels)
+        for array in written.values():
+            array.flush()
+        written.clear()
+        if scales is not None:
+            with open(self.filepath("scales") + ".tmp", "wb") as file:
+                np.save(file, scales)
+
+        # Unmap the old files; other processes keep theirs until they reload
+        self._vectors = self._norms = None
+        try:
+            for part in self.parts:
+                os.replace(self.filepath(part) + ".tmp", self.filepath(part))
+        except OSError as e:
+            print(f"Failed to replace the memory-mapped vectors: {e}")
+            for part in self.parts:
+                if os.path.exists(self.filepath(part) + ".tmp"):
+                    os.remove(self.filepath(part) + ".tmp")
+            masked, delta = self._masked, self._delta
+            if all(os.path.exists(self.filepath(part)) for part in self.parts):
+                self._map()
+            self._masked, self._delta = masked, delta
+            return False
+        self._map()
+        return True
+
+    def _rows(self, labels):
+        """Returns the file rows of those labels that are in the files."""
+        labels = np.asarray(list(labels), dtype=np.int64)
+        if not len(self._labels) or not len(labels):
+            return np.empty(0, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self._labels, labels), len(self._labels) - 1)
+        return rows[self._labels[rows] == labels]
+
+    def add(self, labels, vectors):
+        """Adds vectors in memory, hiding the file rows with the same labels."""
+        self._masked[self._rows(labels)] = True
+        self._delta.add(labels, vectors)
+
+    def remove(self, labels):
+        """Removes vectors."""
+        self._masked[self._rows(labels)] = True
+        self._delta.remove(labels)
+
+    def search(self, vector, k, allowed=None):
+        """
+        Finds the nearest vectors by their approximate distances.
+
+        Args:
+            vector (list): The query vector.
+            k (int): The number of neighbours.
+            allowed (list): The labels to search among, or None for all.
+
+        Returns:
+            list: The labels of the neighbours, nearest first.
+            list: Their squared euclidean distances, approximate for the
+            vectors in the files.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        labels, distances = self._delta.search(query, k, allowed)
+        if self._vectors is None or not len(self._labels) or k <= 0:
+            return labels, distances
+
+        if self._scales is None:
+            weights, offset = query, 0.0
+        else:
+            # x = low + (code + 128) * step, so x.q = code.(step * q) + (low + 128 * step).q
+            weights = self._scales[1] * query
+            offset = float((self._scales[0] + 128 * self._scales[1]) @ query)
+        if allowed is None:
+            rows = None if not self._masked.any() else np.flatnonzero(~self._masked)
+        else:
+            rows = np.sort(self._rows(allowed))
+            rows = rows[~self._masked[rows]]
+        total = len(self._labels) if rows is None else len(rows)
+
+        candidate_labels = [np.asarray(labels, dtype=np.int64)]
+        candidate_distances = [np.asarray(distances, dtype=np.float32)]
+        widened = np.empty((self.block_rows, self._vectors.shape[1]), dtype=np.float32)
+        for start in range(0, total, self.block_rows):
+            if rows is None:
+                block = slice(start, min(start + self.block_rows, total))
+            else:
+                block = rows[start : start + self.block_rows]
+            codes = self._vectors[block]
+            buffer = widened[: len(codes)]
+            if self._scales is None:
+                np.left_shift(codes, 16, out=buffer.view(np.uint32), dtype=np.uint32)
+            else:
+                np.copyto(buffer, codes)
+            products = buffer @ weights + offset
+            block_distances = self._norms[block] - 2 * products + query @ query
+            block_labels = self._labels[block]
+            if len(block_distances) > k:
+                nearest = np.argpartition(block_distances, k - 1)[:k]
+                block_distances = block_distances[nearest]
+                block_labels = block_labels[nearest]
+            candidate_labels.append(block_labels)
+            candidate_distances.append(block_distances)
+        all_labels = np.concatenate(candidate_labels)
+        all_distances = np.concatenate(candidate_distances)
+        nearest = np.argsort(all_distances, kind="stable")[:k]
+        return all_labels[nearest].tolist(), np.maximum(all_distances[nearest], 0.0).tolist()
+
+
+class LocalCollection:
+    """
+    This class keeps chunks, their metadata and float32 vectors in SQLite,
+    and searches them with a NumpyIndex, HnswIndex or MmapIndex rebuilt
+    from, or saved next to, the SQLite file.
+
+    Args:
+        vectorstore_directory (str): The directory of the vector store.
+        backend (str): The index, 'hnsw', 'numpy' or 'mmap'.
+        **index_settings: The settings of the HnswIndex, i.e. M,
+            ef_construction and ef, or of the MmapIndex, i.e. dtype and rescore.
+    """
+
+    name = "langchain"
+
+    def __init__(self, vectorstore_directory, backend="numpy", **index_settings):
+        self.directory = vectorstore_directory
+        self.backend = backend
+        self.metadata = {"hnsw:space": "l2"}
+        self._lock = threading.RLock()
+
+        if vectorstore_directory and not os.path.isdir(vectorstore_directory):
+            os.makedirs(vectorstore_directory)
+        self._connection = sqlite3.connect(
+            vectorstore_filepath(vectorstore_directory, backend), check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "label INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "id TEXT NOT NULL UNIQUE, "
+            "document TEXT, "
+            "metadata TEXT NOT NULL, "
+            "vector BLOB NOT NULL)"
+        )
+        # Every write bumps the generation, so a saved index can be matched to the chunks
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._connection.commit()
+        self._generation = self._info("generation")
+
+        if backend == "hnsw":
+            self.index = HnswIndex(
+                os.path.join(vectorstore_directory, HNSW_INDEX_FILENAME), **index_settings
+            )
+            atexit.register(self.persist)
+        elif backend == "numpy":
+            self.index = NumpyIndex()
+        elif backend == "mmap":
+            self.index = MmapIndex(vectorstore_directory, **index_settings)
+            atexit.register(self.persist)
+        else:
+            raise ValueError(f"Invalid local vector store backend: {backend}")
+        self._load_index()
+
+    def _info(self, key):
+        """Reads a counter of the info table."""
+        row = self._connection.execute(
+            "SELECT value FROM info WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _set_info(self, key, value):
+        """Writes a counter of the info table, without committing."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def _changed(self):
+        """Bumps the generation of the chunks, without committing."""
+        self._generation += 1
+        self._set_info("generation", self._generation)
+
+    def _dimension(self):
+        """Returns the number of dimensions of the stored vectors, or None."""
+        row = self._connection.execute("SELECT vector FROM records LIMIT 1").fetchone()
+        return None if row is None else len(row[0]) // 4
+
+    def _batches(self, batch_size=4096):
+        """Yields the (labels, vectors) of the stored vectors in label order."""
+        dimension = self._dimension()
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT label, vector FROM records ORDER BY label")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield (
+                [label for label, _ in rows],
+                np.frombuffer(b"".join(vector for _, vector in rows), dtype=np.float32)
+                .reshape(len(rows), dimension),
+            )
+
+    def _load_index(self):
+        """Loads the saved index, or builds it from the stored vectors."""
+        dimension = self._dimension()
+        if dimension is None:
+            return
+        if isinstance(self.index, (HnswIndex, MmapIndex)):
+            if self._info(self.index.generation_key) == self._generation:
+                labels = [
+                    label
+                    for (label,) in self._connection.execute("SELECT label FROM records")
+                ]
+                if self.index.load(dimension, labels):
+                    return
+        if isinstance(self.index, MmapIndex):
+            print(f"Writing the {self.index.dtype} vectors of the vector store...")
+            self._save_index()
+            return
+        if isinstance(self.index, HnswIndex):
+            print("Building the HNSW index of the vector store...")
+        for labels, vectors in self._batches():
+            self.index.add(labels, vectors)
+
+    def _save_index(self):
+        """Saves the index and records the generation it holds, with the lock held."""
+        if isinstance(self.index, MmapIndex):
+            dimension = self._dimension()
+            if dimension is None or not self.index.build(
+                dimension, self.count(), self._batches
+            ):
+                return
+        else:
+            self.index.save()
+        self._set_info(self.index.generation_key, self._generation)
+        self._connection.commit()
+
+    def persist(self):
+        """Saves the index if the chunks changed since it was last saved."""
+        with self._lock:
+            if not isinstance(self.index, (HnswIndex, MmapIndex)):
+                return
+            if self._info(self.index.generation_key) != self._generation:
+                self._save_index()
+
+    def count(self):
+        """Returns the number of chunks."""
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def _select(self, columns, ids=None, where=None, limit=None, offset=None):
+        """Selects the records matching IDs and a metadata filter."""
+        sql, params = where_clause(where)
+        if ids is not None:
+            ids = list(ids)
+            sql = f"({sql}) AND id IN ({', '.join('?' * len(ids))})"
+            params = params + ids
+        query = f"SELECT {columns} FROM records WHERE {sql} ORDER BY label"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else limit, offset or 0]
+        return self._connection.execute(query, params).fetchall()
+
+    @staticmethod
+    def _result(rows, include, ids=None):
+        """Builds a Chroma-style result from (id, document, metadata, vector) rows."""
+        if ids is not None:
+            # Chunks are returned in the order they were asked for
+            by_id = {row[0]: row for row in rows}
+            rows = [by_id[key] for key in dict.fromkeys(ids) if key in by_id]
+        return {
+            "ids": [row[0] for row in rows],
+            "documents": [row[1] for row in rows] if "documents" in include else None,
+            "metadatas": (
+                [json.loads(row[2]) or None for row in rows]
+                if "metadatas" in include
+                else None
+            ),
+            "embeddings": (
+                [np.frombuffer(row[3], dtype=np.float32).tolist() for row in rows]
+                if "embeddings" in include
+                else None
+            ),
+        }
+
+    def get(
+        self,
+        ids=None,
+        where=None,
+        limit=None,
+        offset=None,
+        include=("metadatas", "documents"),
+    ):
+        """
+        Reads chunks by their IDs and metadata.
+
+        Args:
+            ids (list): The IDs of the chunks, or None for all.
+            where (dict): A metadata filter.
+            limit (int): The most chunks returned.
+            offset (int): The number of chunks skipped.
+            include (list): What to return of 'documents', 'metadatas' and
+                'embeddings'; the IDs are always returned.
+
+        Returns:
+            dict: The 'ids' and the included lists.
+        """
+        if isinstance(ids, str):
+            ids = [ids]
+        with self._lock:
+            rows = []
+            # Stay well below SQLite's limit on the number of host parameters
+            for i in range(0, len(ids), 500) if ids is not None else [None]:
+                rows.extend(
+                    self._select(
+                        "id, document, metadata, vector",
+                        None if i is None else ids[i : i + 500],
+                        where,
+                        limit,
+                        offset,
+                    )
+                )
+        return self._result(rows, include, ids)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        """
+        Adds chunks, replacing the chunks with the same IDs.
+
+        Args:
+            ids (list): The IDs of the chunks.
+            embeddings (list): The vectors of the chunks.
+            documents (list): The chunk texts.
+            metadatas (list): The metadata dictionaries of the chunks.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO records (id, document, metadata, vector) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET document = excluded.document, "
+                "metadata = excluded.metadata, vector = excluded.vector",
+                [
+                    (key, document, json.dumps(metadata or {}), vector.tobytes())
+                    for key, document, metadata, vector in zip(
+                        ids, documents, metadatas, vectors
+                    )
+                ],
+            )
+            self._changed()
+            self._connection.commit()
+            labels = dict(self._select("id, label", ids=ids))
+            self.index.add([labels[key] for key in ids], vectors)
+
+    add = upsert
+
+    def update(self, ids, metadatas=None, documents=None, embeddings=None):
+        """
+        Replaces the metadata, texts or vectors of stored chunks.
+
+        Args:
+            ids (list): The IDs of the chunks.
+            metadatas (list): The new metadata dictionaries, if any.
+            documents (list): The new chunk texts, if any.
+            embeddings (list): The new vectors, if any.
+        """
+        with self._lock:
+            if metadatas is not None:
+                self._connection.executemany(
+                    "UPDATE records SET metadata = ? WHERE id = ?",
+                    [(json.dumps(metadata or {}), key) for key, metadata in zip(ids, metadatas)],
+                )
+            if documents is not None:
+                self._connection.executemany(
+                    "UPDATE records SET document = ? WHERE id = ?",
+                    list(zip(documents, ids)),
+                )
+            if embeddings is not None:
+                vectors = np.asarray(embeddings, dtype=np.float32)
+                self._connection.executemany(
+                    "UPDATE records SET vector = ? WHERE id = ?",
+                    [(vector.tobytes(), key) for key, vector in zip(ids, vectors)],
+                )
+                labels = dict(self._select("id, label", ids=ids))
+                stored = [i for i, key in enumerate(ids) if key in labels]
+                self.index.add([labels[ids[i]] for i in stored], vectors[stored])
+                self._changed()
+            self._connection.commit()
+
+    def delete(self, ids=None, where=None):
+        """
+        Deletes chunks by their IDs, or all chunks matching a metadata filter.
+
+        Args:
+            ids (list): The IDs of the chunks.
+            where (dict): A metadata filter.
+        """
+        if ids is None and not where:
+            return
+        with self._lock:
+            labels = []
+            for i in range(0, len(ids), 500) if ids is not None else [None]:
+                labels.extend(
+                    label
+                    for (label,) in self._select(
+                        "label", None if i is None else ids[i : i + 500], where
+                    )
+                )
+            for i in range(0, len(labels), 500):
+                subset = labels[i : i + 500]
+                self._connection.execute(
+                    f"DELETE FROM records WHERE label IN ({', '.join('?' * len(subset))})",
+                    subset,
+                )
+            self._changed()
+            self._connection.commit()
+            self.index.remove(labels)
+
+    def query(
+        self,
+        query_embeddings,
+        n_results=10,
+        where=None,
+        include=("metadatas", "documents", "distances"),
+    ):
+        """
+        Finds the chunks nearest to query vectors.
+
+        Args:
+            query_embeddings (list): The query vectors.
+            n_results (int): The number of chunks per query.
+            where (dict): A metadata filter.
+            include (list): What to return of 'documents', 'metadatas',
+                'distances' and 'embeddings'; the IDs are always returned.
+
+        Returns:
+            dict: The 'ids' and the included lists, with one list per query.
+        """
+        result = {key: [] for key in ("ids", "documents", "metadatas", "embeddings")}
+        result["distances"] = []
+        with self._lock:
+            allowed = None
+            if where:
+                allowed = [label for (label,) in self._select("label", where=where)]
+            # Approximate distances are rescored with the stored float32 vectors
+            rescore = getattr(self.index, "rescore", 1)
+            for vector in query_embeddings:
+                labels, distances = self.index.search(vector, n_results * rescore, allowed)
+                rows = {}
+                for i in range(0, len(labels), 500):
+                    subset = labels[i : i + 500]
+                    rows.update(
+                        (row[0], row[1:])
+                        for row in self._connection.execute(
+                            "SELECT label, id, document, metadata, vector FROM records "
+                            f"WHERE label IN ({', '.join('?' * len(subset))})",
+                            subset,
+                        )
+                    )
+                if rescore > 1 and labels:
+                    query = np.asarray(vector, dtype=np.float32)
+                    exact = (
+                        (
+                            np.frombuffer(
+                                b"".join(rows[label][3] for label in labels), dtype=np.float32
+                            ).reshape(len(labels), -1)
+                            - query
+                        )
+                        ** 2
+                    ).sum(axis=1)
+                    nearest = np.argsort(exact, kind="stable")[:n_results]
+                    labels = [labels[i] for i in nearest]
+                    distances = exact[nearest].tolist()
+                found = self._result([rows[label] for label in labels], include)
+                for key in ("ids", "documents", "metadatas", "embeddings"):
+                    result[key].append(found[key])
+                result["distances"].append(distances)
+        for key in ("documents", "metadatas", "embeddings", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
+
+
+class LocalVectorStore(VectorStore):
+    """
+    This class is the LangChain vector store over a LocalCollection.
+
+    Args:
+        collection (LocalCollection): The collection.
+        embedding_function (Embeddings): The embedding function.
+    """
+
+    def __init__(self, collection, embedding_function):
+        self._collection = collection
+        self._embedding_function = embedding_function
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def persist(self):
+        """Saves the index of the collection."""
+        self._collection.persist()
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embeds and stores texts, returning their IDs."""
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        self._collection.upsert(
+            ids=ids,
+            embeddings=self._embedding_function.embed_documents(texts),
+            documents=texts,
+            metadatas=metadatas,
+        )
+        return ids
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        """Reads stored chunks, like Chroma.get."""
+        return self._collection.get(
+            ids=ids,
+            where=where,
+            limit=limit,
+            offset=offset,
+            include=["metadatas", "documents"] if include is None else include,
+        )
+
+    def delete(self, ids=None, **kwargs):
+        """Deletes chunks by their IDs."""
+        self._collection.delete(ids=ids)
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        """Returns the chunks nearest to a query with their distances."""
+        # pylint: disable=W0622
+        result = self._collection.query(
+            query_embeddings=[self._embedding_function.embed_query(query)],
+            n_results=k,
+            where=filter,
+        )
+        return [
+            (Document(page_content=text, metadata=metadata or {}), distance)
+            for text, metadata, distance in zip(
+                result["documents"][0], result["metadatas"][0], result["distances"][0]
+            )
+        ]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        """Returns the chunks nearest to a query."""
+        # pylint: disable=W0622
+        return [
+            document
+            for document, _ in self.similarity_search_with_score(query, k, filter)
+        ]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        """
+        Creates a store from texts.
+
+        Args:
+            texts (list): The texts.
+            embedding (Embeddings): The embedding function.
+            metadatas (list): The metadata of the texts.
+            ids (list): The IDs of the texts.
+            **kwargs: 'persist_directory', 'backend' and the index settings.
+
+        Returns:
+            LocalVectorStore: The store.
+        """
+        store = open_vectorstore(
+            kwargs.pop("persist_directory", "database"),
+            embedding,
+            kwargs.pop("backend", "numpy"),
+            **kwargs,
+        )
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+
+def open_vectorstore(vectorstore_directory, embeddings, backend="chroma", **index_settings):
+    """
+    Opens, or creates, the vector store in a directory.
+
+    Args:
+        vectorstore_directory (str): The directory of the vector store.
+        embeddings (Embeddings): The embedding function.
+        backend (str): The backend, 'chroma', 'hnsw', 'numpy' or 'mmap'.
+        **index_settings: The settings of the HNSW or memory-mapped index.
+
+    Returns:
+        VectorStore: The store, whose `_collection` follows the Chroma API.
+    """
+    if backend == "chroma":
+        # pylint: disable=C0415
+        from langchain_community.vectorstores import Chroma
+
+        return Chroma(embedding_function=embeddings, persist_directory=vectorstore_directory)
+    return LocalVectorStore(
+        LocalCollection(vectorstore_directory, backend, **index_settings), embeddings
+    )
+
+
+def migrate(source_directory, target_directory, backend, batch_size=1000, **index_settings):
+    """
+    Copies the chunks of a Chroma store, with their vectors, into a local backend.
+
+    Args:
+        source_directory (str): The directory of the Chroma store.
+        target_directory (str): The directory of the new store; may be the same.
+        backend (str): The local backend, 'hnsw', 'numpy' or 'mmap'.
+        batch_size (int): The number of chunks copied at once.
+
+    Returns:
+        int: The number of chunks copied.
+    """
+    # pylint: disable=C0415
+    import chromadb
+
+    if not os.path.exists(vectorstore_filepath(source_directory, "chroma")):
+        raise FileNotFoundError(f"No Chroma store in {source_directory}")
+    client = chromadb.PersistentClient(path=source_directory)
+    target = LocalCollection(target_directory, backend, **index_settings)
+    copied = 0
+    for collection in client.list_collections():
+        total = collection.count()
+        for offset in range(0, total, batch_size):
+            batch = collection.get(
+                include=["documents", "metadatas", "embeddings"],
+                limit=batch_size,
+                offset=offset,
+            )
+            target.upsert(
+                ids=batch["ids"],
+                embeddings=batch["embeddings"],
+                documents=batch["documents"],
+                metadatas=batch["metadatas"],
+            )
+            copied += len(batch["ids"])
+            print(f"Copied {copied} chunks of collection '{collection.name}'.")
+    target.persist()
+    signature_filepath = os.path.join(source_directory, EMBEDDINGS_FILENAME)
+    if os.path.exists(signature_filepath) and not os.path.exists(
+        os.path.join(target_directory, EMBEDDINGS_FILENAME)
+    ):
+        shutil.copy(signature_filepath, target_directory)
+    return copied
+
+
+def vectorstore_artifacts(vectorstore_directory):
+    """
+    Lists the files and folders of the vector stores of any backend in a directory.
+
+    These are the chunk files with their SQLite journals, the saved indexes,
+    the keyword index, the manifest, the embedding signature and the segment
+    folders Chroma names by UUID.
+
+    Args:
+        vectorstore_directory (str): The directory of the vector stores.
+
+    Returns:
+        list: The paths that exist.
+    """
+    if not os.path.isdir(vectorstore_directory):
+        return []
+    databases = sorted(set(VECTORSTORE_FILENAMES.values())) + [LEXICAL_INDEX_FILENAME]
+    filenames = [
+        filename + suffix
+        for filename in databases
+        for suffix in ("", "-wal", "-shm", "-journal")
+    ]
+    filenames += [
+        filename + suffix
+        for filename in INDEX_FILENAMES + [MANIFEST_FILENAME]
+        for suffix in ("", ".tmp")
+    ]
+    filenames.append(EMBEDDINGS_FILENAME)
+    paths = [os.path.join(vectorstore_directory, filename) for filename in filenames]
+    for name in sorted(os.listdir(vectorstore_directory)):
+        path = os.path.join(vectorstore_directory, name)
+        try:
+            uuid.UUID(name)
+        except ValueError:
+            continue
+        if os.path.isdir(path):
+            paths.append(path)
+    return [path for path in paths if os.path.exists(path)]
+
+
+def remove_vectorstore(vectorstore_directory):
+    """
+    Deletes the vector stores of any backend in a directory, keeping the directory.
+
+    Args:
+        vectorstore_directory (str): The directory of the vector stores.
+
+    Returns:
+        list: The deleted paths, empty if there was no vector store.
+    """
+    removed = vectorstore_artifacts(vectorstore_directory)
+    for path in removed:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return removed
+
+
+def main(argv=None):
+    """Migrates a Chroma store to a local backend."""
+    parser = argparse.ArgumentParser(
+        description="Migrate a Chroma vector store to a local backend."
+    )
+    parser.add_argument("source", help="The directory holding chroma.sqlite3.")
+    parser.add_argument(
+        "--target", help="The directory of the new store. Default is the source."
+    )
+    parser.add_argument("--backend", default="hnsw", choices=VECTOR_BACKENDS[1:])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--M", type=int, default=16, help="The HNSW graph degree.")
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef", type=int, default=64, help="The HNSW search breadth.")
+    parser.add_argument(
+        "--dtype", default="int8", choices=MMAP_DTYPES, help="The memory-mapped vector type."
+    )
+    parser.add_argument(
+        "--rescore", type=int, default=4, help="The mmap candidates rescored per result."
+    )
+    args = parser.parse_args(argv)
+
+    target = args.target or args.source
+    index_settings = {}
+    if args.backend == "hnsw":
+        index_settings = {"M": args.M, "ef_construction": args.ef_construction, "ef": args.ef}
+    elif args.backend == "mmap":
+        index_settings = {"dtype": args.dtype, "rescore": args.rescore}
+    copied = migrate(args.source, target, args.backend, args.batch_size, **index_settings)
+    print(
+        f"Migrated {copied} chunks to {vectorstore_filepath(target, args.backend)}; "
+        f'set "VECTORSTORE_BACKEND": "{args.backend}" in config/configs.json to use it.'
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
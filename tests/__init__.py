@@ -0,0 +1,6 @@
+"""
+This package provides the tests of DST-GPT, run offline against the fake
+OpenAI API:
+
+    python -m unittest discover -s tests -t .
+"""
@@ -0,0 +1,104 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the semantic answer cache.
+"""
+import unittest
+from unittest import mock
+from src.answer_cache import AnswerCache, normalize_question
+
+SCOPE = ("gpt-3.5-turbo", 0.0, "template", "enabled")
+
+
+class AnswerCacheTest(unittest.TestCase):
+    """Tests the exact and semantic lookups, the TTL, the LRU and the invalidation."""
+
+    def test_normalize_question(self):
+        self.assertEqual(
+            normalize_question("  How do I  craft a SPEAR?! "), "how do i craft a spear"
+        )
+        self.assertEqual(normalize_question("怎么做长矛？"), "怎么做长矛")
+
+    def test_exact_hit(self):
+        cache = AnswerCache()
+        answer = "Twigs, rope, flint."
+        cache.store(SCOPE, "How do I craft a spear?", answer)
+        self.assertEqual(cache.lookup(SCOPE, "how do i craft a spear"), answer)
+        self.assertEqual(cache.lookup_exact(SCOPE, "HOW DO I CRAFT A SPEAR"), answer)
+        # Another scope, e.g. another model, misses
+        other_scope = ("gpt-4",) + SCOPE[1:]
+        self.assertIsNone(cache.lookup(other_scope, "How do I craft a spear?"))
+        self.assertEqual(cache.stats()["exact_hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lookup_exact_counts_no_miss(self):
+        cache = AnswerCache()
+        self.assertIsNone(cache.lookup_exact(SCOPE, "What is a beefalo?"))
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    def test_semantic_hit(self):
+        cache = AnswerCache(similarity_threshold=0.95)
+        cache.store(SCOPE, "How do I craft a spear?", "Twigs.", [1.0, 0.0])
+        # Cosine similarity 0.995
+        self.assertEqual(cache.lookup(SCOPE, "Spear recipe?", [1.0, 0.1]), "Twigs.")
+        # Cosine similarity 0.707
+        self.assertIsNone(cache.lookup(SCOPE, "Beefalo food?", [1.0, 1.0]))
+        # Without a vector, only exact matches are served
+        self.assertIsNone(cache.lookup(SCOPE, "Spear recipe?"))
+        self.assertEqual(cache.stats()["semantic_hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_semantic_disabled(self):
+        cache = AnswerCache(similarity_threshold=1)
+        self.assertFalse(cache.semantic)
+        cache.store(SCOPE, "How do I craft a spear?", "Twigs.", [1.0, 0.0])
+        self.assertIsNone(cache.lookup(SCOPE, "Spear recipe?", [1.0, 0.0]))
+
+    def test_ttl(self):
+        cache = AnswerCache(ttl=60)
+        with mock.patch("src.answer_cache.time.time", return_value=1000.0):
+            cache.store(SCOPE, "How do I craft a spear?", "Twigs.", [1.0, 0.0])
+        with mock.patch("src.answer_cache.time.time", return_value=1059.0):
+            self.assertEqual(cache.lookup(SCOPE, "How do I craft a spear?"), "Twigs.")
+        with mock.patch("src.answer_cache.time.time", return_value=1061.0):
+            self.assertIsNone(cache.lookup(SCOPE, "How do I craft a spear?"))
+            self.assertIsNone(cache.lookup(SCOPE, "Spear recipe?", [1.0, 0.0]))
+
+    def test_lru(self):
+        cache = AnswerCache(max_entries=2)
+        cache.store(SCOPE, "first", "1")
+        cache.store(SCOPE, "second", "2")
+        cache.lookup(SCOPE, "first")  # Recently used
+        cache.store(SCOPE, "third", "3")
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.lookup(SCOPE, "first"), "1")
+        self.assertIsNone(cache.lookup(SCOPE, "second"))
+        self.assertEqual(cache.lookup(SCOPE, "third"), "3")
+
+    def test_store_version(self):
+        cache = AnswerCache()
+        cache.store(SCOPE, "retrieved", "From the store.", store_version=1)
+        cache.store(SCOPE, "pure", "From the model.")
+        self.assertEqual(
+            cache.lookup(SCOPE, "retrieved", store_version=1), "From the store."
+        )
+        # The store has changed since the answer was retrieved from it
+        self.assertIsNone(cache.lookup(SCOPE, "retrieved", store_version=2))
+        # Answers that do not depend on the store are valid for any version
+        self.assertEqual(
+            cache.lookup(SCOPE, "pure", store_version=2), "From the model."
+        )
+
+    def test_invalidate(self):
+        cache = AnswerCache()
+        cache.store(SCOPE, "old", "1", store_version=1)
+        cache.store(SCOPE, "new", "2", store_version=2)
+        cache.store(SCOPE, "pure", "3")
+        cache.invalidate(2)
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertIsNone(cache.lookup(SCOPE, "old", store_version=1))
+        cache.invalidate()
+        self.assertEqual(cache.stats()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
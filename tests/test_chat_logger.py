@@ -0,0 +1,86 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the chat log and its writer thread.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from src.chat_logger import ChatLogger, read_events, render_markdown
+
+
+class ChatLoggerTest(unittest.TestCase):
+    """Tests the logged events, the running totals and the writer thread."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.log_filepath = os.path.join(directory, "log", "chatlog.jsonl")
+        self.logger = ChatLogger(self.log_filepath, fsync_interval=0, flush_interval=0)
+        self.addCleanup(self.logger.close)
+
+    def messages(self):
+        """Returns the message events written to the log."""
+        self.logger.flush()
+        return [
+            event
+            for event in read_events(self.log_filepath)
+            if event["type"] == "message"
+        ]
+
+    def meta(self):
+        """Returns the metadata file."""
+        self.logger.flush()
+        with open(self.logger.meta_filepath, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def test_log_messages(self):
+        self.logger.add_chat_to_log("How do I craft a spear?", "right", 0, 0)
+        self.logger.add_chat_to_log("Thinking...", "left", 0, 0)
+        self.logger.add_chat_to_log("Twigs, rope and flint.", "left-rag", 12, 0.002)
+        messages = self.messages()
+        self.assertEqual(
+            [message["text"] for message in messages],
+            ["How do I craft a spear?", "Twigs, rope and flint."],
+        )
+        self.assertEqual(self.meta()["message_counts"], 2)
+        self.assertEqual(self.meta()["chat_tokens"], 12)
+        self.assertAlmostEqual(self.meta()["cost"], 0.002)
+
+    def test_values_are_coerced(self):
+        self.logger.add_chat_to_log("Unknown cost", "left", "7", None)
+        self.logger.add_chat_to_log("Not numbers", "left", "many", "free")
+        self.logger.add_chat_to_log("Priced", "left", 3.0, "0.5")
+        messages = self.messages()
+        self.assertEqual([message["tokens"] for message in messages], [7, 0, 3])
+        self.assertEqual([message["cost"] for message in messages], [None, None, 0.5])
+        self.assertEqual(self.meta()["chat_tokens"], 10)
+        self.assertEqual(self.meta()["cost"], 0.5)
+
+    def test_writer_survives_an_error(self):
+        with mock.patch.object(
+            self.logger, "write_events", side_effect=[RuntimeError("disk"), None]
+        ), mock.patch("builtins.print"):
+            self.logger.add_chat_to_log("Lost", "right", 1, 0)
+            self.logger.flush()
+        self.assertTrue(self.logger.writer.is_alive())
+        self.logger.add_chat_to_log("Kept", "left", 2, 0)
+        self.assertEqual([message["text"] for message in self.messages()], ["Kept"])
+
+    def test_render_markdown(self):
+        events = [
+            {"type": "meta", "start_time": "2024-02-14 12:00:00"},
+            {"time": "t", "side": "right", "text": "Hi", "tokens": 1, "cost": 0},
+            # Logged before the cost of the model was known
+            {"time": "t", "side": "left", "text": "Hello", "tokens": 2, "cost": None},
+        ]
+        markdown = render_markdown(events)
+        self.assertIn("- Chat Tokens: 3\n", markdown)
+        self.assertIn("- Cost: 0\n", markdown)
+        self.assertTrue(markdown.endswith("## Chat Log\nUser:Hi\nDST-GPT: Hello\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
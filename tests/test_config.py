@@ -0,0 +1,201 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the configuration store and the batched updates.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+import src.config
+from src.config import (
+    ConfigStore,
+    Signal,
+    config_transaction,
+    configUpdater,
+    update_config,
+)
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the server with PyQt5 missing, and checks that the config signals work
+WITHOUT_QT = """
+import sys
+
+class NoQt:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in ("PyQt5", "qasync"):
+            raise ImportError(name)
+
+sys.meta_path.insert(0, NoQt())
+import src.server
+from src.config import _emit_config_changed, configUpdater, connect_direct
+
+calls = []
+connect_direct(configUpdater.llm_configChanged, lambda: calls.append("llm"))
+_emit_config_changed(["TEMPERATURE"])
+assert calls == ["llm"], calls
+assert not [name for name in sys.modules if name.startswith("PyQt5")]
+"""
+
+CONFIG = {
+    "BASE_MODEL": "gpt-3.5-turbo",
+    "TEMPERATURE": "0.7",
+    "RETRIEVER_K": 4,
+    "STREAMING": "enabled",
+    "KNOWLEDGE_SOURCES": ["data/a.json"],
+    "LOG_MAX_BYTES": "many",
+}
+
+
+class ConfigTestCase(unittest.TestCase):
+    """This class writes CONFIG to a temporary file for every test."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.config_path = os.path.join(directory, "configs.json")
+        with open(self.config_path, "w", encoding="utf-8") as file:
+            json.dump(CONFIG, file)
+
+    def read_file(self):
+        """Returns the configuration in the file."""
+        with open(self.config_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+
+class ConfigStoreTest(ConfigTestCase):
+    """Tests the reads, the updates and the batched writes of ConfigStore."""
+
+    def test_typed_getters(self):
+        store = ConfigStore(self.config_path)
+        self.assertEqual(store.get_str("BASE_MODEL"), "gpt-3.5-turbo")
+        self.assertEqual(store.get_float("TEMPERATURE"), 0.7)
+        self.assertEqual(store.get_int("RETRIEVER_K"), 4)
+        self.assertTrue(store.get_bool("STREAMING"))
+        self.assertEqual(store.get_list("KNOWLEDGE_SOURCES"), ["data/a.json"])
+        # Invalid or missing values fall back to the defaults
+        self.assertEqual(store.get_int("LOG_MAX_BYTES", 1024), 1024)
+        self.assertEqual(store.get_float("MISSING", 0.5), 0.5)
+        self.assertEqual(store.get_str("MISSING", "x"), "x")
+        self.assertFalse(store.get_bool("MISSING"))
+        self.assertEqual(store.get_list("BASE_MODEL", ["y"]), ["y"])
+
+    def test_missing_file(self):
+        store = ConfigStore(self.config_path + ".missing")
+        self.assertEqual(store.snapshot(), {})
+
+    def test_batched_write(self):
+        store = ConfigStore(self.config_path, write_delay=60)
+        store.update("TEMPERATURE", 0.1)
+        store.update("KNOWLEDGE_SOURCES", "data/b.json")
+        self.assertEqual(store.get("TEMPERATURE"), 0.1)
+        # Not written before the delay or a flush
+        self.assertEqual(self.read_file(), CONFIG)
+        self.assertTrue(store.flush())
+        written = self.read_file()
+        self.assertEqual(written["TEMPERATURE"], 0.1)
+        self.assertEqual(written["KNOWLEDGE_SOURCES"], ["data/a.json", "data/b.json"])
+        self.assertFalse(os.path.exists(self.config_path + ".tmp"))
+
+    def test_snapshot_is_a_copy(self):
+        store = ConfigStore(self.config_path, write_delay=0)
+        snapshot = store.snapshot()
+        store.update("KNOWLEDGE_SOURCES", "data/b.json")
+        self.assertEqual(snapshot["KNOWLEDGE_SOURCES"], ["data/a.json"])
+        self.assertEqual(
+            store.get_list("KNOWLEDGE_SOURCES"), ["data/a.json", "data/b.json"]
+        )
+
+    def test_reload_keeps_pending_updates(self):
+        store = ConfigStore(self.config_path, write_delay=60)
+        store.update("TEMPERATURE", 0.1)
+        edited = dict(CONFIG, BASE_MODEL="gpt-4", TEMPERATURE="0.9")
+        with open(self.config_path, "w", encoding="utf-8") as file:
+            json.dump(edited, file)
+
+        self.assertEqual(store.reload(), {"BASE_MODEL"})
+        self.assertEqual(store.get("BASE_MODEL"), "gpt-4")
+        self.assertEqual(store.get("TEMPERATURE"), 0.1)
+        store.flush()
+
+
+class ConfigTransactionTest(ConfigTestCase):
+    """Tests that a transaction writes and signals its updates once."""
+
+    def setUp(self):
+        super().setUp()
+        self.store = ConfigStore(self.config_path, write_delay=60)
+        patcher = mock.patch.object(src.config, "config_store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.signals = []
+        for signal, name in (
+            (configUpdater.configChanged, "config"),
+            (configUpdater.llm_configChanged, "llm"),
+        ):
+            slot = lambda name=name: self.signals.append(name)
+            signal.connect(slot)
+            self.addCleanup(signal.disconnect, slot)
+
+    def test_update_config(self):
+        update_config("STREAMING", "disabled")
+        self.assertEqual(self.signals, ["config"])
+        update_config("TEMPERATURE", 0.2)
+        self.assertEqual(self.signals, ["config", "config", "llm"])
+
+    def test_nested_transaction(self):
+        with config_transaction():
+            update_config("KNOWLEDGE_SOURCES", "data/b.json")
+            with config_transaction():
+                update_config("KNOWLEDGE_SOURCES", "data/c.json")
+                update_config("STREAMING", "disabled")
+            self.assertEqual(self.signals, [])
+            self.assertEqual(self.read_file(), CONFIG)
+        # One write and one signal of each kind, once the outermost one ends
+        self.assertEqual(self.signals, ["config", "llm"])
+        self.assertEqual(
+            self.read_file()["KNOWLEDGE_SOURCES"],
+            ["data/a.json", "data/b.json", "data/c.json"],
+        )
+
+    def test_empty_transaction(self):
+        with config_transaction():
+            pass
+        self.assertEqual(self.signals, [])
+
+
+class WithoutQtTest(unittest.TestCase):
+    """Tests the configuration without PyQt5, as used by the server."""
+
+    def test_signal(self):
+        signal = Signal()
+        calls = []
+        slot = lambda: calls.append(len(calls))
+        signal.connect(slot)
+        signal.emit()
+        signal.emit()
+        self.assertEqual(calls, [0, 1])
+        signal.disconnect(slot)
+        signal.emit()
+        self.assertEqual(calls, [0, 1])
+        with self.assertRaises(TypeError):
+            signal.disconnect(slot)
+
+    def test_server_imports_without_qt(self):
+        result = subprocess.run(
+            [sys.executable, "-c", WITHOUT_QT],
+            cwd=REPOSITORY_DIR,
+            capture_output=True,
+            text=True,
+            timeout=120,
+            check=False,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the packing of retrieved chunks into the prompt context.
+"""
+import unittest
+from langchain_core.documents import Document
+from src.context_packer import (
+    ContextPacker,
+    PackerStats,
+    DOCUMENT_SEPARATOR,
+    containment,
+    merge_texts,
+    shingles,
+)
+from src.manifest import chunk_id
+
+
+def chunk(text, source_path="data/spear.txt", index=None, start=None, score=0.5):
+    """Returns a retrieved chunk, at a position of its document if given."""
+    metadata = {"source_path": source_path, "score": score}
+    if index is not None:
+        metadata.update(chunk_index=index, start_byte=start, end_byte=start + len(text))
+    return Document(page_content=text, metadata=metadata)
+
+
+class MergeTextsTest(unittest.TestCase):
+    """Tests joining the texts of consecutive chunks."""
+
+    def test_overlap_once(self):
+        self.assertEqual(
+            merge_texts("Craft a spear with twigs and rope", "and rope and flint"),
+            "Craft a spear with twigs and rope and flint",
+        )
+
+    def test_title_once(self):
+        self.assertEqual(
+            merge_texts("Spear: Craft it.", "Spear: Wield it.", overlapping=False),
+            "Spear: Craft it. Wield it.",
+        )
+
+    def test_code_lines(self):
+        self.assertEqual(
+            merge_texts("local a = 1\nlocal b = 2", "return a + b", overlapping=False),
+            "local a = 1\nlocal b = 2\nreturn a + b",
+        )
+
+    def test_shingles(self):
+        a = shingles("the spear is made of twigs")
+        b = shingles("The spear is made of twigs, rope")
+        self.assertEqual(containment(a, b), 1.0)
+        self.assertEqual(containment(a, shingles("Beefalo wool")), 0.0)
+        self.assertEqual(shingles("spear"), {("spear",)})
+
+
+class ContextPackerTest(unittest.TestCase):
+    """Tests the merging, deduplication, ranking and budget of the packer."""
+
+    def test_merge_adjacent_chunks(self):
+        first = "Craft a spear with two twigs and one rope."
+        second = "two twigs and one rope. Then add a flint."
+        documents = [
+            chunk(second, index=1, start=20, score=0.9),
+            chunk(first, index=0, start=0, score=0.7),
+        ]
+        packed = ContextPacker().pack(documents)
+
+        self.assertEqual(len(packed), 1)
+        self.assertEqual(
+            packed[0].page_content,
+            "Craft a spear with two twigs and one rope. Then add a flint.",
+        )
+        metadata = packed[0].metadata
+        self.assertEqual(metadata["score"], 0.9)
+        self.assertEqual(
+            metadata["chunk_ids"],
+            [chunk_id("data/spear.txt", first), chunk_id("data/spear.txt", second)],
+        )
+
+    def test_distant_chunks_are_not_merged(self):
+        documents = [
+            chunk("The spear breaks after 150 hits.", index=0, start=0),
+            chunk("Beefalos can be ridden once tamed.", index=5, start=500),
+        ]
+        self.assertEqual(len(ContextPacker().pack(documents)), 2)
+
+    def test_ranking_and_duplicates(self):
+        text = "A spear is crafted from two twigs, one rope and one flint."
+        documents = [
+            chunk("Beefalo wool is shaved off beefalos.", "data/b.txt", score=0.4),
+            chunk(text, "data/wiki.txt", score=0.8),
+            chunk(text + " It deals 34 damage.", "data/guide.txt", score=0.6),
+        ]
+        stats = PackerStats()
+        packed = ContextPacker(stats=stats).pack(documents)
+
+        self.assertEqual(
+            [document.metadata["source_path"] for document in packed],
+            ["data/wiki.txt", "data/b.txt"],
+        )
+        self.assertEqual(stats.as_dict()["duplicate_chunks"], 1)
+
+    def test_budget(self):
+        texts = [f"Chunk number {i} about spears and twigs." for i in range(5)]
+        documents = [
+            chunk(text, f"data/{i}.txt", score=1 - i / 10)
+            for i, text in enumerate(texts)
+        ]
+        packer = ContextPacker(duplicate_similarity=1.1)  # No duplicates
+        # Room for two chunks and their separator
+        separator_tokens = packer.count(DOCUMENT_SEPARATOR)
+        packer.budget_tokens = 2 * packer.count(texts[0]) + separator_tokens
+
+        packed = packer.pack(documents)
+        self.assertEqual([document.page_content for document in packed], texts[:2])
+
+    def test_budget_counts_the_question(self):
+        packer = ContextPacker(model_name="gpt-3.5-turbo", reserved_tokens=0)
+        self.assertGreater(packer.budget(), packer.budget("How do I craft a spear?"))
+        packer.budget_tokens = 100
+        self.assertEqual(packer.budget(), 100)
+
+    def test_long_best_chunk_is_truncated(self):
+        text = " ".join(["spear"] * 400)
+        packer = ContextPacker(budget_tokens=50)
+        packed = packer.pack([chunk(text)])
+        self.assertEqual(len(packed), 1)
+        self.assertLessEqual(packer.count(packed[0].page_content), 50)
+        self.assertGreater(len(packed[0].page_content), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the persistent embedding cache.
+"""
+import os
+import shutil
+import asyncio
+import itertools
+import tempfile
+import unittest
+from unittest import mock
+from langchain_core.embeddings import Embeddings
+from src.embedding_cache import EmbeddingCache, CachedEmbeddings
+
+
+class CountingEmbeddings(Embeddings):
+    """This class embeds texts by their length, recording the texts it is sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def embed_documents(self, texts):
+        self.sent.extend(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    """Tests the embedding cache and the cached embedding function."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache_filepath = os.path.join(directory, "cache", "embeddings.sqlite3")
+
+    def open_cache(self, max_entries=200000):
+        """Opens the cache file, closing it after the test."""
+        cache = EmbeddingCache(self.cache_filepath, max_entries)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_round_trip(self):
+        cache = self.open_cache()
+        cache.put_many("model", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+        self.assertEqual(
+            cache.get_many("model", ["b", "c", "a"]), [[3.0, 4.0], None, [1.0, 2.0]]
+        )
+        # The vectors are scoped by model
+        self.assertEqual(cache.get_many("other", ["a"]), [None])
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_persistence(self):
+        self.open_cache().put_many("model", ["a"], [[1.0]])
+        reopened = self.open_cache()
+        self.assertEqual(reopened.get_many("model", ["a"]), [[1.0]])
+        self.assertEqual(reopened.stats()["entries"], 1)
+
+    def test_lru_eviction(self):
+        cache = self.open_cache(max_entries=10)
+        clock = itertools.count(1000)
+        with mock.patch("src.embedding_cache.time.time", lambda: next(clock)):
+            texts = [f"text {i}" for i in range(10)]
+            for text in texts:
+                cache.put_many("model", [text], [[1.0]])
+            cache.get_many("model", texts[:2])  # Recently used
+            cache.put_many("model", ["text 10"], [[1.0]])
+
+        # Down to 90% of max_entries, dropping the least recently used
+        self.assertEqual(cache.stats()["entries"], 9)
+        vectors = cache.get_many("model", texts + ["text 10"])
+        kept = [text for text, vector in zip(texts + ["text 10"], vectors) if vector]
+        self.assertEqual(kept, texts[:2] + texts[4:] + ["text 10"])
+
+    def test_cached_embeddings(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, self.open_cache(), "model")
+        self.assertEqual(cached.embed_documents(["ab", "c"]), [[2.0, 0.5], [1.0, 0.5]])
+        # Only the texts not cached yet are sent, each once
+        vectors = cached.embed_documents(["c", "def", "def"])
+        self.assertEqual(vectors, [[1.0, 0.5], [3.0, 0.5], [3.0, 0.5]])
+        self.assertEqual(embeddings.sent, ["ab", "c", "def"])
+        self.assertEqual(cached.embed_query("ab"), [2.0, 0.5])
+        self.assertEqual(asyncio.run(cached.aembed_query("ghij")), [4.0, 0.5])
+        self.assertEqual(asyncio.run(cached.aembed_documents(["ghij"])), [[4.0, 0.5]])
+        self.assertEqual(embeddings.sent, ["ab", "c", "def", "ghij"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the bulk ingestion pipeline with a fake embedding
+function and an in-memory vector store.
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from src.chunkers import get_chunker
+from src.ingest import BulkIngestor
+from src.manifest import SourceManifest
+
+
+class FakeEmbeddings:
+    """
+    This class embeds texts by their length, counting its calls and the
+    most calls it had in flight at once.
+
+    Args:
+        delay (float): The seconds every call takes.
+    """
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.calls = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.inflight -= 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+class MemoryStore:
+    """This class stores the written chunks in a dictionary, by ID."""
+
+    def __init__(self):
+        self.chunks = {}
+        self.writes = []
+        self.deleted = []
+
+    def write(self, texts, embeddings, metadatas, ids):
+        """The writer of BulkIngestor."""
+        self.writes.append(len(ids))
+        for key, text, vector, metadata in zip(ids, texts, embeddings, metadatas):
+            self.chunks[key] = (text, vector, metadata)
+
+    def delete(self, ids):
+        """The deleter of BulkIngestor."""
+        self.deleted.extend(ids)
+        for key in ids:
+            self.chunks.pop(key, None)
+
+
+class IngestTestCase(unittest.TestCase):
+    """
+    This class writes one-chunk text files to a temporary directory, with
+    a manifest next to them, for every test.
+    """
+
+    files = 12
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.file_paths = [
+            self.write_file(f"file{i:02d}.txt", f"Chunk number {i} of the corpus.")
+            for i in range(self.files)
+        ]
+        self.manifest = SourceManifest(os.path.join(self.directory, "manifest.json"))
+        self.store = MemoryStore()
+
+    def write_file(self, filename, text):
+        """Writes a source file and returns its path."""
+        file_path = os.path.join(self.directory, filename)
+        with open(file_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return file_path
+
+    def ingestor(self, embeddings, **settings):
+        """Returns an ingestor writing to the in-memory store and the manifest."""
+        return BulkIngestor(
+            embeddings,
+            self.store.write,
+            deleter=self.store.delete,
+            manifest=self.manifest,
+            **settings,
+        )
+
+
+class BatchingTest(IngestTestCase):
+    """Tests the batches and the concurrency of the embedding requests."""
+
+    def test_batches(self):
+        embeddings = FakeEmbeddings()
+        report = self.ingestor(
+            embeddings, embed_batch_size=5, max_inflight=2, write_batch_size=4
+        ).ingest(self.file_paths)
+
+        self.assertEqual(report.errors, {})
+        self.assertEqual(report.written, self.files)
+        self.assertEqual(report.embedded, self.files)
+        self.assertEqual(len(self.store.chunks), self.files)
+        self.assertEqual(sorted(len(call) for call in embeddings.calls), [2, 5, 5])
+        self.assertEqual(report.embed_calls, 3)
+        self.assertTrue(all(size <= 4 for size in self.store.writes))
+        self.assertEqual(sorted(report.completed), self.file_paths)
+
+    def test_max_inflight(self):
+        embeddings = FakeEmbeddings(delay=0.05)
+        self.ingestor(embeddings, embed_batch_size=1, max_inflight=3).ingest(
+            self.file_paths
+        )
+        self.assertEqual(len(embeddings.calls), self.files)
+        self.assertLessEqual(embeddings.max_inflight, 3)
+        self.assertGreater(embeddings.max_inflight, 1)
+
+
+class CancelTest(IngestTestCase):
+    """Tests cancelling a run."""
+
+    def test_cancel(self):
+        embeddings = FakeEmbeddings()
+        ingestor = self.ingestor(embeddings, embed_batch_size=2, max_inflight=1)
+        embed_documents = embeddings.embed_documents
+
+        def cancel_on_second_call(texts):
+            if len(embeddings.calls) == 1:
+                ingestor.cancel()
+            return embed_documents(texts)
+
+        embeddings.embed_documents = cancel_on_second_call
+        report = ingestor.ingest(self.file_paths)
+
+        self.assertTrue(report.cancelled)
+        # The requests in flight are paid for, so their chunks are written
+        self.assertEqual(report.written, report.embedded)
+        self.assertLess(report.written, self.files)
+        self.assertEqual(len(self.store.chunks), report.written)
+        # Only the files whose chunks were all written are in the manifest
+        self.assertEqual(len(self.manifest.entries), len(report.completed))
+        self.assertLess(len(report.completed), self.files)
+        for entry in self.manifest.entries.values():
+            for key in entry["chunk_ids"]:
+                self.assertIn(key, self.store.chunks)
+
+
+class ErrorTest(IngestTestCase):
+    """Tests the files that fail to be ingested."""
+
+    def test_chunker_error(self):
+        broken_path = self.file_paths[3]
+
+        def chunker_factory(file_type):
+            chunker = get_chunker(file_type)
+            records = chunker.records
+
+            def broken_records(text, source_path, metadata=None, first_index=0):
+                if source_path == broken_path:
+                    raise RuntimeError("Broken chunker")
+                return records(text, source_path, metadata, first_index)
+
+            chunker.records = broken_records
+            return chunker
+
+        report = self.ingestor(FakeEmbeddings(), chunker_factory=chunker_factory).ingest(
+            self.file_paths
+        )
+
+        self.assertEqual(report.errors, {broken_path: "Broken chunker"})
+        self.assertEqual(report.files_done, self.files)
+        self.assertEqual(report.written, self.files - 1)
+        self.assertNotIn(broken_path, report.completed)
+        self.assertIsNone(self.manifest.get(broken_path))
+
+    def test_unreadable_file(self):
+        missing_path = os.path.join(self.directory, "missing.txt")
+        report = self.ingestor(FakeEmbeddings()).ingest(self.file_paths + [missing_path])
+        self.assertEqual(list(report.errors), [missing_path])
+        self.assertEqual(report.written, self.files)
+
+
+class ManifestTest(IngestTestCase):
+    """Tests the manifest commit and the incremental re-ingestion."""
+
+    def test_manifest_commit(self):
+        report = self.ingestor(FakeEmbeddings()).ingest(self.file_paths)
+        self.assertEqual(len(report.completed), self.files)
+        reloaded = SourceManifest(self.manifest.manifest_filepath)
+        self.assertEqual(
+            set(reloaded.entries), {os.path.normpath(path) for path in self.file_paths}
+        )
+        for entry in reloaded.entries.values():
+            self.assertEqual(len(entry["chunk_ids"]), 1)
+            self.assertIn(entry["chunk_ids"][0], self.store.chunks)
+
+    def test_unchanged_files_are_skipped(self):
+        self.ingestor(FakeEmbeddings()).ingest(self.file_paths)
+        embeddings = FakeEmbeddings()
+        report = self.ingestor(embeddings).ingest(self.file_paths)
+        self.assertEqual(embeddings.calls, [])
+        self.assertEqual(len(report.skipped), self.files)
+        self.assertEqual(report.written, 0)
+
+    def test_touched_files_are_not_embedded(self):
+        self.ingestor(FakeEmbeddings()).ingest(self.file_paths)
+        stat = os.stat(self.file_paths[0])
+        os.utime(self.file_paths[0], (stat.st_atime, stat.st_mtime + 10))
+        embeddings = FakeEmbeddings()
+        report = self.ingestor(embeddings).ingest(self.file_paths)
+        self.assertEqual(embeddings.calls, [])
+        self.assertEqual(len(report.skipped), self.files)
+        # The new mtime is recorded, so the next run skips the file by its stat
+        signature = get_chunker(".txt").signature
+        self.assertTrue(self.manifest.is_unchanged(self.file_paths[0], signature))
+
+    def test_changed_file_replaces_its_chunks(self):
+        self.ingestor(FakeEmbeddings()).ingest(self.file_paths)
+        old_ids = self.manifest.get(self.file_paths[0])["chunk_ids"]
+        self.write_file("file00.txt", "A rewritten chunk.")
+        embeddings = FakeEmbeddings()
+        report = self.ingestor(embeddings).ingest(self.file_paths)
+
+        self.assertEqual(embeddings.calls, [["A rewritten chunk."]])
+        self.assertEqual(len(report.skipped), self.files - 1)
+        self.assertEqual(self.store.deleted, old_ids)
+        self.assertEqual(report.deleted, 1)
+        new_ids = self.manifest.get(self.file_paths[0])["chunk_ids"]
+        self.assertEqual(self.store.chunks[new_ids[0]][0], "A rewritten chunk.")
+        self.assertEqual(len(self.store.chunks), self.files)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the BM25 keyword index.
+"""
+import os
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+from src.lexical_index import LexicalIndex, is_confident, tokenize
+
+WORDS = "spear twigs rope flint beefalo wool pig token axe log grass".split()
+
+
+def bm25(texts, query, k1=1.2, b=0.75):
+    """Returns the BM25 scores of texts for a query, computed in Python."""
+    documents = {key: Counter(tokenize(text)) for key, text in texts.items()}
+    average_length = sum(sum(terms.values()) for terms in documents.values())
+    average_length = average_length / len(documents)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(1 for terms in documents.values() if term in terms)
+        if not df:
+            continue
+        idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        for key, terms in documents.items():
+            tf = terms[term]
+            if tf:
+                length = sum(terms.values())
+                norm = k1 * (1 - b + b * length / average_length)
+                scores[key] = scores.get(key, 0) + idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+class TokenizeTest(unittest.TestCase):
+    """Tests splitting texts into index terms."""
+
+    def test_words_and_identifiers(self):
+        self.assertEqual(tokenize("How is the Spear made?"), ["spear", "made"])
+        self.assertEqual(
+            tokenize("GetPigToken(max_hp)"),
+            ["getpigtoken", "get", "pig", "token", "max_hp", "max", "hp"],
+        )
+
+    def test_cjk_bigrams(self):
+        self.assertEqual(tokenize("长矛 x"), ["长矛", "x"])
+        self.assertEqual(tokenize("怎么做长矛"), ["怎么", "么做", "做长", "长矛"])
+
+
+class LexicalIndexTest(unittest.TestCase):
+    """Tests the BM25 ranking and the updates of the index."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.index = LexicalIndex(os.path.join(directory, "lexical.sqlite3"))
+        rng = random.Random(3)
+        self.texts = {
+            f"chunk-{i}": " ".join(rng.choices(WORDS, k=rng.randint(3, 30)))
+            for i in range(100)
+        }
+        self.index.add(
+            list(self.texts),
+            list(self.texts.values()),
+            [{"source_path": f"data/{i % 3}.txt"} for i in range(len(self.texts))],
+        )
+
+    def test_scores_match_bm25(self):
+        for query in ("spear rope", "beefalo wool axe", "pig", "log unknownword"):
+            expected = bm25(self.texts, query)
+            hits = self.index.search(query, k=10)
+            self.assertEqual(len(hits), min(10, len(expected)))
+            best = sorted(expected.values(), reverse=True)[:10]
+            for (key, score, _), expected_score in zip(hits, best):
+                self.assertAlmostEqual(score, expected[key])
+                self.assertAlmostEqual(score, expected_score)
+
+    def test_coverage(self):
+        self.index.add(["full"], ["spear flint"])
+        hits = {
+            key: coverage for key, _, coverage in self.index.search("spear flint", 200)
+        }
+        self.assertEqual(hits["full"], 1.0)
+        only_spear = [
+            key
+            for key, text in self.texts.items()
+            if "spear" in text.split() and "flint" not in text.split()
+        ]
+        self.assertEqual(hits[only_spear[0]], 0.5)
+
+    def test_no_match(self):
+        self.assertEqual(self.index.search("unknownword"), [])
+        self.assertEqual(self.index.search("the of"), [])
+
+    def test_updates(self):
+        self.index.add(["chunk-0"], ["GetPigToken"])
+        self.assertEqual(len(self.index), 100)
+        key, _, coverage = self.index.search("GetPigToken")[0]
+        self.assertEqual((key, coverage), ("chunk-0", 1.0))
+        self.index.delete(["chunk-0"])
+        hits = self.index.search("pig", k=100)
+        self.assertNotIn("chunk-0", [key for key, _, _ in hits])
+        self.index.delete_sources(["data/1.txt"])
+        self.assertEqual(len(self.index), 99 - 33)
+        self.index.clear()
+        self.assertEqual(self.index.search("spear"), [])
+
+    def test_is_confident(self):
+        self.assertFalse(is_confident([], 2))
+        self.assertTrue(is_confident([("a", 3.0, 1.0)], 2))
+        self.assertFalse(is_confident([("a", 3.0, 0.5)], 2))
+        self.assertTrue(is_confident([("a", 4.0, 1.0), ("b", 2.0, 1.0)], 2))
+        self.assertFalse(is_confident([("a", 3.0, 1.0), ("b", 2.0, 1.0)], 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the configurable retriever over a local vector store.
+
+The chunks are embedded by a fake embedding function with hand-picked
+vectors, so the similarities of the chunks to the queries are known.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from langchain_core.embeddings import Embeddings
+from src.lexical_index import LexicalIndex
+from src.retriever import (
+    ConfiguredRetriever,
+    RetrieverStats,
+    cosine_similarity,
+    merge_filters,
+    reciprocal_rank_fusion,
+)
+from src.tokens import count_tokens
+from src.vector_backends import open_vectorstore
+
+CHUNKS = {
+    "craft": ("How to craft a spear: two twigs, one rope, one flint.", [1.0, 0.0, 0.0]),
+    "trap": ("Spear traps of the spear pit hurt anything walking by.", [0.0, 1.0, 0.0]),
+    "wool": ("Beefalo wool is shaved off sleeping beefalos.", [0.9, 0.4359, 0.0]),
+}
+QUERY_VECTORS = {"spear": [1.0, 0.0, 0.0]}
+
+
+class FakeEmbeddings(Embeddings):
+    """This class embeds the texts of CHUNKS and QUERY_VECTORS by fixed vectors."""
+
+    def __init__(self):
+        self.vectors = dict(QUERY_VECTORS)
+        self.vectors.update(CHUNKS.values())
+        self.queries = []
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return self.vectors[text]
+
+
+class RetrieverTestCase(unittest.TestCase):
+    """
+    This class stores CHUNKS in a numpy-backed vector store and its BM25
+    index, in a temporary directory, for every test.
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.embeddings = FakeEmbeddings()
+        self.store = open_vectorstore(directory, self.embeddings, "numpy")
+        self.lexical_index = LexicalIndex(os.path.join(directory, "lexical.sqlite3"))
+        ids = list(CHUNKS)
+        texts = [text for text, _ in CHUNKS.values()]
+        metadatas = [{"source_path": f"data/{key}.txt"} for key in ids]
+        self.store.add_texts(texts, metadatas, ids)
+        self.lexical_index.add(ids, texts, metadatas)
+
+    def retriever(self, **settings):
+        """Returns a hybrid retriever over the store, without the lexical fast path."""
+        settings.setdefault("lexical_margin", 0)
+        return ConfiguredRetriever(
+            vectorstore=self.store, lexical_index=self.lexical_index, **settings
+        )
+
+    @staticmethod
+    def ids(documents):
+        """Returns the IDs of the CHUNKS documents, in order."""
+        texts = {text: key for key, (text, _) in CHUNKS.items()}
+        return [texts[document.page_content] for document in documents]
+
+
+class FusionTest(unittest.TestCase):
+    """Tests the helpers of the retriever."""
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+        self.assertEqual([key for key, _ in fused], ["a", "c", "b"])
+        self.assertAlmostEqual(fused[0][1], 1 / 61 + 1 / 62)
+        self.assertAlmostEqual(fused[2][1], 1 / 62)
+
+    def test_merge_filters(self):
+        self.assertIsNone(merge_filters(None, {}))
+        self.assertEqual(merge_filters({"a": 1}, None), {"a": 1})
+        self.assertEqual(
+            merge_filters({"a": 1}, {"b": {"$in": [2, 3]}}),
+            {"$and": [{"a": 1}, {"b": {"$in": [2, 3]}}]},
+        )
+
+    def test_cosine_similarity(self):
+        self.assertAlmostEqual(cosine_similarity(0.0), 1.0)
+        self.assertAlmostEqual(cosine_similarity(2.0), 0.0)
+        self.assertAlmostEqual(cosine_similarity(0.25, "cosine"), 0.75)
+
+
+class HybridTest(RetrieverTestCase):
+    """Tests the fusion of the keyword and vector rankings, and the filters."""
+
+    def test_vector_ranking(self):
+        retriever = ConfiguredRetriever(vectorstore=self.store, k=2)
+        documents, _ = retriever.retrieve("spear")
+        self.assertEqual(self.ids(documents), ["craft", "wool"])
+        self.assertAlmostEqual(documents[0].metadata["similarity"], 1.0)
+
+    def test_fused_ranking(self):
+        # 'trap' leads by keywords, but is last by vector; 'wool' has no keyword
+        documents, _ = self.retriever(k=3).retrieve("spear")
+        self.assertEqual(self.ids(documents), ["craft", "trap", "wool"])
+        scores = [document.metadata["score"] for document in documents]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertAlmostEqual(scores[0], round(1 / 61 + 1 / 62, 6))
+
+    def test_where_filter(self):
+        where = {"source_path": {"$in": ["data/trap.txt", "data/wool.txt"]}}
+        documents, _ = self.retriever(k=3, where=where).retrieve("spear")
+        self.assertEqual(set(self.ids(documents)), {"trap", "wool"})
+        retriever = ConfiguredRetriever(
+            vectorstore=self.store, k=3, where={"source_path": "data/wool.txt"}
+        )
+        self.assertEqual(self.ids(retriever.retrieve("spear")[0]), ["wool"])
+
+
+class ScoreThresholdTest(RetrieverTestCase):
+    """Tests that the score threshold holds in hybrid retrieval."""
+
+    def test_hybrid_without_threshold(self):
+        documents, vector = self.retriever(k=3).retrieve("spear")
+        self.assertEqual(vector, QUERY_VECTORS["spear"])
+        self.assertEqual(set(self.ids(documents)), set(CHUNKS))
+
+    def test_hybrid_threshold_drops_keyword_hits(self):
+        # 'trap' matches the keyword best, but is orthogonal to the query
+        documents, _ = self.retriever(k=3, score_threshold=0.8).retrieve("spear")
+        self.assertEqual(self.ids(documents), ["craft", "wool"])
+        for document in documents:
+            self.assertGreaterEqual(document.metadata["similarity"], 0.8)
+
+    def test_threshold_computes_unknown_similarities(self):
+        # Keyword hits beyond the vector candidates are compared to the query
+        retriever = self.retriever(score_threshold=0.5)
+        hits = retriever._lexical_search("spear")
+        self.assertEqual({key for key, _, _, _ in hits}, {"craft", "trap"})
+        kept = retriever._above_threshold(hits, QUERY_VECTORS["spear"], {})
+        self.assertEqual([key for key, _, _, _ in kept], ["craft"])
+        self.assertAlmostEqual(kept[0][1].metadata["similarity"], 1.0)
+
+
+
+class LexicalOnlyTest(RetrieverTestCase):
+    """Tests the queries answered by keywords alone."""
+
+    def test_lexical_only_query_is_not_embedded(self):
+        stats = RetrieverStats()
+        documents, vector = self.retriever(lexical_margin=2.0, stats=stats).retrieve(
+            "beefalo"
+        )
+        self.assertIsNone(vector)
+        self.assertEqual(self.embeddings.queries, [])
+        self.assertEqual(self.ids(documents), ["wool"])
+        self.assertEqual(stats.as_dict()["lexical_only_queries"], 1)
+
+    def test_lexical_only_query_is_left_out_of_savings(self):
+        stats = RetrieverStats()
+        self.retriever(lexical_margin=2.0, stats=stats).retrieve("beefalo")
+        # Of the top 3 chunks, the threshold saves the tokens of 'trap'
+        ConfiguredRetriever(
+            vectorstore=self.store, k=3, score_threshold=0.8, stats=stats
+        ).retrieve("spear")
+        counters = stats.as_dict()
+        self.assertEqual(counters["queries"], 2)
+        self.assertEqual(
+            counters["saved_tokens_per_query"], count_tokens(CHUNKS["trap"][0])
+        )
+
+if __name__ == "__main__":
+    unittest.main()
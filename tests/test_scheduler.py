@@ -0,0 +1,236 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the request scheduler against a fake client resource
+answering with 429 errors, with and without a Retry-After header.
+"""
+import time
+import asyncio
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import httpx
+import openai
+from src.scheduler import (
+    RequestScheduler,
+    ScheduledResource,
+    AsyncScheduledResource,
+    TokenBucket,
+    request_lane,
+    retry_after,
+)
+
+
+def rate_limit_error(headers=None):
+    """Returns the error of a 429 response with the given headers."""
+    response = httpx.Response(
+        429,
+        headers=headers or {},
+        request=httpx.Request("POST", "http://localhost/v1/embeddings"),
+    )
+    return openai.RateLimitError("Rate limited", response=response, body=None)
+
+
+def bad_request_error():
+    """Returns the error of a 400 response."""
+    response = httpx.Response(
+        400, request=httpx.Request("POST", "http://localhost/v1/embeddings")
+    )
+    return openai.BadRequestError("Bad request", response=response, body=None)
+
+
+class FakeResource:
+    """
+    This class is a client resource that fails with the given errors, in
+    order, and then answers with a response using `total_tokens` tokens.
+    """
+
+    def __init__(self, errors=(), total_tokens=10):
+        self.errors = list(errors)
+        self.total_tokens = total_tokens
+        self.requests = []
+
+    def response(self, kwargs):
+        """Fails with the next error, or returns a response."""
+        self.requests.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=self.total_tokens))
+
+    def create(self, **kwargs):
+        return self.response(kwargs)
+
+
+class AsyncFakeResource(FakeResource):
+    """This class is the asynchronous FakeResource."""
+
+    async def create(self, **kwargs):
+        return self.response(kwargs)
+
+
+class TokenBucketTest(unittest.TestCase):
+    """Tests the token buckets."""
+
+    def test_refill(self):
+        bucket = TokenBucket(600)  # 10 per second, holding 10
+        now = bucket.updated
+        self.assertEqual(bucket.wait_time(10, now), 0)
+        bucket.take(10)
+        self.assertAlmostEqual(bucket.wait_time(5, now), 0.5)
+        self.assertAlmostEqual(bucket.wait_time(5, now + 0.5), 0)
+        # Never more than the capacity
+        self.assertAlmostEqual(bucket.wait_time(10, now + 100), 0)
+        self.assertEqual(bucket.level, bucket.capacity)
+
+    def test_debt(self):
+        bucket = TokenBucket(600)
+        now = bucket.updated
+        # A request larger than the bucket waits for a full one, then leaves a debt
+        self.assertEqual(bucket.wait_time(25, now), 0)
+        bucket.take(25)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 1.6)
+        bucket.give(100)
+        self.assertEqual(bucket.level, bucket.capacity)
+
+
+class RetryAfterTest(unittest.TestCase):
+    """Tests reading the Retry-After headers."""
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(rate_limit_error({"retry-after": "2"})), 2.0)
+        self.assertEqual(retry_after(rate_limit_error({"retry-after-ms": "250"})), 0.25)
+        self.assertIsNone(retry_after(rate_limit_error()))
+        self.assertIsNone(retry_after(ValueError("No response")))
+        date = "Thu, 01 Jan 2015 00:00:00 GMT"  # In the past
+        self.assertEqual(retry_after(rate_limit_error({"retry-after": date})), 0.0)
+
+
+class RetryTest(unittest.TestCase):
+    """Tests retrying the requests that failed with a 429 error."""
+
+    def setUp(self):
+        # Full jitter picks the longest delay
+        patcher = mock.patch("src.scheduler.random.uniform", lambda low, high: high)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sleeps = []
+        patcher = mock.patch("src.scheduler.time.sleep", self.sleeps.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_exponential_backoff(self):
+        scheduler = RequestScheduler(backoff_base=0.5, backoff_max=1.5)
+        resource = FakeResource([rate_limit_error() for _ in range(4)])
+        response = ScheduledResource(resource, scheduler).create(model="m", input=["a"])
+
+        self.assertEqual(response.usage.total_tokens, 10)
+        self.assertEqual(len(resource.requests), 5)
+        self.assertEqual(self.sleeps, [0.5, 1.0, 1.5, 1.5])
+        stats = scheduler.stats.as_dict()["interactive"]
+        self.assertEqual(stats["retries"], 4)
+        self.assertEqual(stats["rate_limited"], 4)
+        self.assertEqual(stats["failed"], 0)
+
+    def test_retry_after(self):
+        scheduler = RequestScheduler(backoff_base=0.5)
+        resource = FakeResource([rate_limit_error({"retry-after-ms": "300"})])
+        ScheduledResource(resource, scheduler).create(model="m", input=["a"])
+
+        # The Retry-After wait, plus up to backoff_base of jitter
+        self.assertEqual(self.sleeps, [0.8])
+        # The scheduler is paused for everyone, so the retry waited in the queue too
+        stats = scheduler.stats.as_dict()["interactive"]
+        self.assertGreaterEqual(stats["max_wait_ms"], 250)
+
+    def test_retry_budget_exhausted(self):
+        scheduler = RequestScheduler(max_retries=2)
+        resource = FakeResource([rate_limit_error() for _ in range(5)])
+        with self.assertRaises(openai.RateLimitError):
+            ScheduledResource(resource, scheduler).create(model="m", input=["a"])
+
+        self.assertEqual(len(resource.requests), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        stats = scheduler.stats.as_dict()["interactive"]
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["failed"], 1)
+
+    def test_not_retryable(self):
+        scheduler = RequestScheduler()
+        resource = FakeResource([bad_request_error()])
+        with self.assertRaises(openai.BadRequestError):
+            ScheduledResource(resource, scheduler).create(model="m", input=["a"])
+        self.assertEqual(len(resource.requests), 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_async_retry(self):
+        scheduler = RequestScheduler(backoff_base=0.01)
+        resource = AsyncFakeResource([rate_limit_error(), rate_limit_error()])
+        response = asyncio.run(
+            AsyncScheduledResource(resource, scheduler).create(model="m", input=["a"])
+        )
+        self.assertEqual(response.usage.total_tokens, 10)
+        self.assertEqual(len(resource.requests), 3)
+        self.assertEqual(scheduler.stats.as_dict()["interactive"]["retries"], 2)
+
+
+class LaneTest(unittest.TestCase):
+    """Tests the priority of the interactive lane over the bulk lane."""
+
+    def test_interactive_goes_first(self):
+        scheduler = RequestScheduler()
+        scheduler.requests = TokenBucket(300, burst_seconds=0.2)  # One per 0.2s
+        scheduler.acquire()  # Empties the bucket
+        granted = []
+
+        def send(lane):
+            with request_lane(lane):
+                scheduler.acquire()
+            granted.append(lane)
+
+        threads = [threading.Thread(target=send, args=("bulk",)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        # Queued behind the bulk requests
+        time.sleep(0.02)
+        threads.append(threading.Thread(target=send, args=("interactive",)))
+        threads[-1].start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(granted, ["interactive", "bulk", "bulk"])
+        stats = scheduler.stats.as_dict()
+        self.assertEqual(stats["bulk"]["requests"], 2)
+        self.assertEqual(stats["bulk"]["max_queue_depth"], 2)
+        self.assertEqual(stats["interactive"]["requests"], 2)
+
+    def test_invalid_lane(self):
+        with self.assertRaises(ValueError):
+            with request_lane("urgent"):
+                pass
+
+
+class ScheduledResourceTest(unittest.TestCase):
+    """Tests the token accounting of scheduled client resources."""
+
+    def test_settles_used_tokens(self):
+        scheduler = RequestScheduler(tokens_per_minute=60000)  # 1000 per second
+        resource = FakeResource(total_tokens=300)
+        ScheduledResource(resource, scheduler).create(model="m", input=["a" * 400])
+
+        self.assertEqual(resource.requests, [{"model": "m", "input": ["a" * 400]}])
+        # The estimate is replaced by the usage of the response
+        self.assertAlmostEqual(scheduler.tokens.level, 700, delta=5)
+
+    def test_tokens_per_minute(self):
+        scheduler = RequestScheduler(tokens_per_minute=6000)  # 100 per second
+        resource = FakeResource(total_tokens=100)
+        scheduled = ScheduledResource(resource, scheduler)
+        started = time.monotonic()
+        for _ in range(3):
+            scheduled.create(model="m", input=["a" * 400])
+        # The first request empties the bucket, the other two wait a second each
+        self.assertGreaterEqual(time.monotonic() - started, 1.9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the HTTP server against the fake OpenAI API.
+
+The server runs with a real LLM in a temporary working directory, so the
+vector store, the caches and the configuration writes of the tests never
+touch those of the repository.
+"""
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+from aiohttp.test_utils import TestClient, TestServer
+import src.config
+import src.llm
+import src.server
+from src.config import ConfigStore, configUpdater
+from src.llm import LLM
+from src.server import create_app
+from src.tokens import get_encoding
+from benchmark import fake_openai
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setUpModule():
+    """Skips the tests when OpenAIEmbeddings cannot split texts into tokens."""
+    if get_encoding("text-embedding-ada-002") is None:
+        raise unittest.SkipTest(
+            "The tiktoken encoding is not available; run online once, or set "
+            "TIKTOKEN_CACHE_DIR to a directory holding it."
+        )
+
+
+class ServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    This class starts the fake OpenAI API and the server, in a temporary
+    working directory with its own configuration and vector store, for
+    every test.
+    """
+
+    max_concurrency = 4
+    queue_timeout = 30
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        with open(
+            os.path.join(REPOSITORY_DIR, "config", "configs.json"), "r", encoding="utf-8"
+        ) as file:
+            config = json.load(file)
+        # Absolute, since Chroma keeps its clients per path for the whole process
+        vectorstore_directory = os.path.join(directory, "database")
+        config.update(
+            VECTORSTORE_DIRECTORY=vectorstore_directory,
+            VECTORSTORE_FILEPATH=os.path.join(vectorstore_directory, "chroma.sqlite3"),
+            VECTORSTORE_BACKEND="chroma",
+            # The store starts empty, and every question reaches the API
+            SAMPLE_COURPUS="",
+            ANSWER_CACHE="disabled",
+            KNOWLEDGE_SOURCES=[],
+        )
+        os.makedirs(os.path.join(directory, "config"))
+        with open(
+            os.path.join(directory, "config", "configs.json"), "w", encoding="utf-8"
+        ) as file:
+            json.dump(config, file, indent=4)
+        os.makedirs(os.path.join(directory, "corpus"))
+        for filename in ("code_sample.lua", "chinese_sample.txt"):
+            shutil.copy(
+                os.path.join(REPOSITORY_DIR, "data", filename),
+                os.path.join(directory, "corpus"),
+            )
+
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+        store = ConfigStore(write_delay=0)
+        for module in (src.config, src.llm, src.server):
+            patcher = mock.patch.object(module, "config_store", store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncSetUp(self):
+        self.fake = TestServer(fake_openai.create_app())
+        await self.fake.start_server()
+        environ = mock.patch.dict(
+            os.environ,
+            {
+                "OPENAI_API_KEY": "fake",
+                "OPENAI_BASE_URL": str(self.fake.make_url("/v1")),
+            },
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.llm = await asyncio.get_running_loop().run_in_executor(None, LLM)
+        self.addCleanup(configUpdater.llm_configChanged.disconnect, self.llm.update_llm_configs)
+        self.client = TestClient(
+            TestServer(
+                create_app(self.llm, self.max_concurrency, self.queue_timeout)
+            )
+        )
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.fake.close()
+
+    async def ask(self, question, mode):
+        """Posts a question and returns the response and its JSON body."""
+        response = await self.client.post(
+            "/ask", json={"question": question, "mode": mode}
+        )
+        return response, await response.json()
+
+
+class AskTest(ServerTestCase):
+    """Tests the answers of /ask and /ask/stream."""
+
+    async def test_ask_rag(self):
+        response, body = await self.ask("How do I craft a spear?", "rag")
+        self.assertEqual(response.status, 200)
+        self.assertTrue(body["answer"]["rag"].startswith(fake_openai.ANSWER_PREFIX))
+        self.assertEqual(body["answer"]["pure"], "")
+        self.assertEqual(set(body["usage"]), {"rag"})
+        self.assertEqual(body["errors"], {})
+        self.assertIn("Server-Timing", response.headers)
+
+    async def test_ask_pure(self):
+        response, body = await self.ask("How do I craft a spear?", "pure")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            body["answer"]["pure"], fake_openai.ANSWER_PREFIX + "How do I craft a spear?"
+        )
+        self.assertEqual(body["answer"]["rag"], "")
+        self.assertEqual(set(body["usage"]), {"pure"})
+
+    async def test_ask_both(self):
+        response, body = await self.ask("How do I craft a spear?", "both")
+        self.assertEqual(response.status, 200)
+        for branch in ("rag", "pure"):
+            self.assertTrue(body["answer"][branch].startswith(fake_openai.ANSWER_PREFIX))
+        self.assertEqual(set(body["usage"]), {"rag", "pure"})
+        self.assertGreater(body["cost"], 0)
+
+    async def test_ask_invalid(self):
+        response, body = await self.ask("How do I craft a spear?", "sometimes")
+        self.assertEqual(response.status, 400)
+        self.assertIn("error", body)
+
+    async def test_ask_stream(self):
+        response = await self.client.post(
+            "/ask/stream", json={"question": "How do I craft a spear?", "mode": "both"}
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        events = [json.loads(line) for line in (await response.text()).splitlines()]
+        final = events.pop()
+        self.assertTrue(final["done"])
+        self.assertNotIn("error", final)
+        self.assertEqual(set(final["usage"]), {"rag", "pure"})
+        self.assertIsNotNone(final["timing"]["first_token_ms"])
+        for branch in ("rag", "pure"):
+            text = "".join(event["token"] for event in events if event["branch"] == branch)
+            self.assertTrue(text.startswith(fake_openai.ANSWER_PREFIX))
+
+
+class BusyTest(ServerTestCase):
+    """Tests that questions waiting too long for a slot are refused."""
+
+    max_concurrency = 1
+    queue_timeout = 0.1
+
+    async def test_busy(self):
+        self.fake.app["delay"] = 1.0  # Holds the only slot well past the timeout
+        first = asyncio.ensure_future(self.ask("What does a beefalo eat?", "pure"))
+        await asyncio.sleep(0.2)
+        response, body = await self.ask("What does a pig eat?", "pure")
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertIn("error", body)
+
+        response, body = await first
+        self.assertEqual(response.status, 200)
+        self.assertTrue(body["answer"]["pure"].startswith(fake_openai.ANSWER_PREFIX))
+        stats = await (await self.client.get("/stats")).json()
+        self.assertEqual(stats["server"]["rejected"], 1)
+
+
+class IngestTest(ServerTestCase):
+    """Tests the ingestion jobs."""
+
+    async def wait_for_job(self, job_id, timeout=60):
+        """Polls a job until it has ended and returns its last state."""
+        for _ in range(int(timeout / 0.1)):
+            response = await self.client.get(f"/ingest/{job_id}")
+            self.assertEqual(response.status, 200)
+            status = await response.json()
+            if status["status"] != "running":
+                return status
+            await asyncio.sleep(0.1)
+        self.fail(f"Ingestion job {job_id} did not end within {timeout} seconds.")
+
+    async def test_ingest_status(self):
+        response = await self.client.post("/ingest", json={"source_path": "corpus"})
+        self.assertEqual(response.status, 202)
+        job = await response.json()
+        self.assertEqual(job["files"], 2)
+
+        status = await self.wait_for_job(job["id"])
+        self.assertEqual(status["status"], "done")
+        self.assertIsNone(status["error"])
+        self.assertEqual(status["progress"]["fraction"], 1.0)
+        self.assertGreater(self.llm.stored_vectors._collection.count(), 0)
+
+        response, body = await self.ask("How do I craft a spear?", "rag")
+        self.assertEqual(response.status, 200)
+        self.assertTrue(body["answer"]["rag"].startswith(fake_openai.ANSWER_PREFIX))
+
+    async def test_ingest_cancel(self):
+        response = await self.client.post("/ingest", json={"source_path": "corpus"})
+        job = await response.json()
+        response = await self.client.delete(f"/ingest/{job['id']}")
+        self.assertEqual(response.status, 200)
+        self.assertEqual((await response.json())["id"], job["id"])
+
+        status = await self.wait_for_job(job["id"])
+        # Files embedded before the cancellation are kept
+        self.assertEqual(status["status"], "done")
+        self.assertIsNone(status["error"])
+
+    async def test_ingest_unknown_job(self):
+        for method in (self.client.get, self.client.delete):
+            response = await method("/ingest/42")
+            self.assertEqual(response.status, 404)
+            self.assertIn("error", await response.json())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+# pylint: disable=E0611,W0611,C0103,C0303,R0903,W0212
+"""
+This module tests the local vector store backends against an exact search.
+"""
+import os
+import uuid
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from src.vector_backends import (
+    LocalCollection,
+    hnswlib,
+    remove_vectorstore,
+    vectorstore_artifacts,
+    where_clause,
+)
+
+BACKENDS = ["numpy", "mmap"] + (["hnsw"] if hnswlib is not None else [])
+
+
+class WhereClauseTest(unittest.TestCase):
+    """Tests translating Chroma filters into SQL."""
+
+    def test_where_clause(self):
+        self.assertEqual(where_clause(None), ("1", []))
+        sql, params = where_clause(
+            {"$or": [{"source_path": "a.md"}, {"page": {"$gte": 2, "$lt": 5}}]}
+        )
+        self.assertEqual(
+            sql,
+            "((json_extract(metadata, ?) = ?) OR "
+            "(json_extract(metadata, ?) >= ? AND json_extract(metadata, ?) < ?))",
+        )
+        self.assertEqual(
+            params, ['$."source_path"', "a.md", '$."page"', 2, '$."page"', 5]
+        )
+
+    def test_unsupported_operator(self):
+        with self.assertRaises(ValueError):
+            where_clause({"page": {"$like": "x"}})
+
+
+class LocalCollectionTest(unittest.TestCase):
+    """Tests every local backend against a brute-force search of the same vectors."""
+
+    count = 200
+    dimension = 16
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.vectors = rng.normal(size=(self.count, self.dimension)).astype(np.float32)
+        self.ids = [f"chunk-{i}" for i in range(self.count)]
+        self.metadatas = [
+            {"source_path": f"data/{i % 4}.txt", "page": i % 10}
+            for i in range(self.count)
+        ]
+        self.queries = rng.normal(size=(5, self.dimension)).astype(np.float32)
+
+    def open(self, backend, directory=None):
+        """Opens a collection of a backend, in a new temporary directory by default."""
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        collection = LocalCollection(directory, backend)
+        # Saved before the directory is removed, leaving nothing to save at exit
+        self.addCleanup(collection.persist)
+        return collection
+
+    def fill(self, collection):
+        """Stores the test vectors in a collection."""
+        collection.upsert(
+            ids=self.ids,
+            embeddings=self.vectors.tolist(),
+            documents=[f"Text of {key}" for key in self.ids],
+            metadatas=self.metadatas,
+        )
+
+    def nearest(self, query, k, allowed=None):
+        """Returns the IDs of the k nearest vectors by an exact search."""
+        distances = ((self.vectors - query) ** 2).sum(axis=1)
+        order = [i for i in np.argsort(distances) if allowed is None or allowed(i)]
+        return [self.ids[i] for i in order[:k]]
+
+    def test_query(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                collection = self.open(backend)
+                self.fill(collection)
+                self.assertEqual(collection.count(), self.count)
+                for query in self.queries:
+                    result = collection.query([query.tolist()], n_results=5)
+                    self.assertEqual(result["ids"][0], self.nearest(query, 5))
+                    distances = result["distances"][0]
+                    self.assertEqual(distances, sorted(distances))
+
+    def test_query_where(self):
+        sources = ("data/1.txt", "data/2.txt")
+        where = {
+            "$and": [
+                {"source_path": {"$in": list(sources)}},
+                {"page": {"$gte": 5}},
+            ]
+        }
+
+        def allowed(i):
+            return i % 4 in (1, 2) and i % 10 >= 5
+
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                collection = self.open(backend)
+                self.fill(collection)
+                for query in self.queries:
+                    result = collection.query(
+                        [query.tolist()], n_results=5, where=where
+                    )
+                    self.assertEqual(result["ids"][0], self.nearest(query, 5, allowed))
+                    for metadata in result["metadatas"][0]:
+                        self.assertIn(metadata["source_path"], sources)
+
+    def test_get_update_delete(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                collection = self.open(backend)
+                self.fill(collection)
+                found = collection.get(
+                    ids=["chunk-3", "chunk-1"], include=["embeddings"]
+                )
+                # In the order asked for
+                self.assertEqual(found["ids"], ["chunk-3", "chunk-1"])
+                np.testing.assert_allclose(found["embeddings"][0], self.vectors[3])
+                self.assertIsNone(found["documents"])
+
+                collection.update(["chunk-1"], metadatas=[{"source_path": "moved.txt"}])
+                found = collection.get(where={"source_path": "moved.txt"})
+                self.assertEqual(found["ids"], ["chunk-1"])
+
+                collection.delete(where={"source_path": {"$nin": ["data/0.txt"]}})
+                self.assertEqual(collection.count(), self.count // 4)
+                result = collection.query([self.queries[0].tolist()], n_results=5)
+                self.assertEqual(
+                    result["ids"][0],
+                    self.nearest(self.queries[0], 5, lambda i: i % 4 == 0),
+                )
+
+    def test_reopen(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+                self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+                collection = self.open(backend, directory)
+                self.fill(collection)
+                collection.delete(ids=["chunk-0"])
+                collection.persist()
+
+                reopened = self.open(backend, directory)
+                self.assertEqual(reopened.count(), self.count - 1)
+                query = self.queries[1]
+                result = reopened.query([query.tolist()], n_results=5)
+                self.assertEqual(
+                    result["ids"][0], self.nearest(query, 5, lambda i: i != 0)
+                )
+
+    def test_remove_vectorstore(self):
+        directory = tempfile.mkdtemp(prefix="dstgpt-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        collection = self.open("mmap", directory)
+        self.fill(collection)
+        collection.persist()
+        # A Chroma store next to it, and a file of the user
+        segment = os.path.join(directory, str(uuid.uuid4()))
+        os.makedirs(segment)
+        for filepath in (
+            os.path.join(directory, "chroma.sqlite3"),
+            os.path.join(directory, "manifest.json"),
+            os.path.join(segment, "data_level0.bin"),
+            os.path.join(directory, "notes.txt"),
+        ):
+            with open(filepath, "w", encoding="utf-8") as file:
+                file.write("")
+
+        self.assertIn(segment, vectorstore_artifacts(directory))
+        removed = remove_vectorstore(directory)
+        self.assertIn(os.path.join(directory, "vectors.sqlite3"), removed)
+        self.assertIn(os.path.join(directory, "mmap_int8_vectors.npy"), removed)
+        self.assertEqual(os.listdir(directory), ["notes.txt"])
+        self.assertEqual(vectorstore_artifacts(directory), [])
+        self.assertEqual(remove_vectorstore(directory + "-missing"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()